@@ -6,6 +6,7 @@ from data.utils import (
     add_dataset_index,
     preprocess_pretraining_instance,
 )
+from data.tokenized_cache import load_tokenized_cache
 
 
 class CompletionDataset(Dataset):
@@ -19,6 +20,7 @@ class CompletionDataset(Dataset):
         max_length=2048,
         predict_with_generate=False,
         insert_space=False,
+        tokenized_cache_dir=None,
     ):
         super(CompletionDataset, self).__init__()
         self.tokenizer = tokenizer
@@ -30,6 +32,12 @@ class CompletionDataset(Dataset):
         self.text_key = text_key
         self.predict_with_generate = predict_with_generate
         self.insert_space = insert_space
+        self.tokenized = None
+        if tokenized_cache_dir is not None:
+            self.tokenized = load_tokenized_cache(
+                tokenized_cache_dir, self, len(self), self._tokenize_item
+            )
+            self.lengths = self.tokenized.lengths
 
     def __len__(self):
         return len(self.data)
@@ -52,12 +60,16 @@ class CompletionDataset(Dataset):
             item_dct["index"] = index
         return item_dct
 
-    def __getitem__(self, idx):
+    def _tokenize_item(self, idx):
         pref = self.data[idx].get(self.prefix_key, "")
         text_content = self.data[idx].get(self.text_key, "")
         index = self.data[idx]["index"]
-        item = self._process_sample(pref, text_content, index)
-        return item
+        return [self._process_sample(pref, text_content, index)], False
+
+    def __getitem__(self, idx):
+        if self.tokenized is not None:
+            return self.tokenized.samples(idx)[0]
+        return self._tokenize_item(idx)[0][0]
 
 
 class PretrainingDataset(Dataset):
@@ -161,6 +173,7 @@ class TripUnlambQADataset(Dataset):
         predict_with_generate: bool = False,
         insert_space: bool = False,
         gold_set: bool = False,
+        tokenized_cache_dir=None,
     ):
         super().__init__()
         self.tokenizer = tokenizer
@@ -200,6 +213,13 @@ class TripUnlambQADataset(Dataset):
         self.answer_key = answers_key
         self.predict_with_generate = predict_with_generate
         self.insert_space = insert_space
+        # all answers are tokenized once, one of them is picked at random per access
+        self.tokenized = None
+        if tokenized_cache_dir is not None:
+            self.tokenized = load_tokenized_cache(
+                tokenized_cache_dir, self, len(self), self._tokenize_item
+            )
+            self.lengths = self.tokenized.lengths
 
     def __len__(self):
         return len(self.data)
@@ -222,7 +242,22 @@ class TripUnlambQADataset(Dataset):
             item["index"] = index
         return item
 
+    def _tokenize_item(self, idx):
+        ex = self.data[idx]
+        question = ex.get(self.question_key, "") or ""
+        ans_val = ex.get(self.answer_key, "")
+        answers = (ans_val or [""]) if isinstance(ans_val, list) else [ans_val or ""]
+        index = ex["index"]
+        samples = [self._process_sample(question, ans, index) for ans in answers]
+        return samples, isinstance(ans_val, list) and len(ans_val) > 0
+
     def __getitem__(self, idx):
+        if self.tokenized is not None:
+            samples = self.tokenized.samples(idx)
+            if self.tokenized.is_multi(idx):
+                return random.choice(samples)
+            return samples[0]
+
         ex = self.data[idx]
         question = ex.get(self.question_key, "") or ""
 
@@ -255,6 +290,7 @@ class MultiAnswerQADataset(Dataset):
         predict_with_generate=False,
         insert_space=False,
         gold_set=False,
+        tokenized_cache_dir=None,
     ):
         super(MultiAnswerQADataset, self).__init__()
         self.tokenizer = tokenizer
@@ -279,6 +315,13 @@ class MultiAnswerQADataset(Dataset):
         self.answers_key = answers_key
         self.predict_with_generate = predict_with_generate
         self.insert_space = insert_space
+        # all answers are tokenized once, one of them is picked at random per access
+        self.tokenized = None
+        if tokenized_cache_dir is not None:
+            self.tokenized = load_tokenized_cache(
+                tokenized_cache_dir, self, len(self), self._tokenize_item
+            )
+            self.lengths = self.tokenized.lengths
 
     def __len__(self):
         return len(self.data)
@@ -301,7 +344,16 @@ class MultiAnswerQADataset(Dataset):
             item_dct["index"] = index
         return item_dct
 
+    def _tokenize_item(self, idx):
+        question = self.data[idx].get(self.question_key, "")
+        answers = self.data[idx].get(self.answers_key, []) or [""]
+        index = self.data[idx]["index"]
+        return [self._process_sample(question, ans, index) for ans in answers], True
+
     def __getitem__(self, idx):
+        if self.tokenized is not None:
+            return random.choice(self.tokenized.samples(idx))
+
         question = self.data[idx].get(self.question_key, "")
         answers = self.data[idx].get(self.answers_key, [])
         if not answers:
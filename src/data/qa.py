@@ -2,6 +2,7 @@ import torch
 from torch.utils.data import Dataset
 
 from data.utils import load_hf_dataset, preprocess_chat_instance, add_dataset_index
+from data.tokenized_cache import load_tokenized_cache
 
 
 class QADataset(Dataset):
@@ -15,6 +16,7 @@ class QADataset(Dataset):
         few_shot_dataset_hf_args=None,
         max_length=512,
         predict_with_generate=False,
+        tokenized_cache_dir=None,
     ):
         super(QADataset, self).__init__()
         self.tokenizer = tokenizer
@@ -31,6 +33,12 @@ class QADataset(Dataset):
         self.question_key = question_key
         self.answer_key = answer_key
         self.predict_with_generate = predict_with_generate
+        self.tokenized = None
+        if tokenized_cache_dir is not None:
+            self.tokenized = load_tokenized_cache(
+                tokenized_cache_dir, self, len(self), self._tokenize_item
+            )
+            self.lengths = self.tokenized.lengths
 
     def __len__(self):
         return len(self.data)
@@ -57,22 +65,29 @@ class QADataset(Dataset):
         }
         return item_dct
 
-    def __getitem__(self, idx):
+    def _tokenize_item(self, idx):
+        """Samples of an item, one per answer, and whether it has a list of answers."""
         question = self.data[idx][self.question_key]
         answer = self.data[idx][self.answer_key]
         index = self.data[idx]["index"]
         if isinstance(answer, str):
-            item = self._process_sample(question=question, answer=answer, index=index)
+            sample = self._process_sample(question=question, answer=answer, index=index)
+            return [sample], False
         elif isinstance(answer, list):
-            item = {}
-            for i, ans in enumerate(answer):
-                sample_item = self._process_sample(
-                    question=question, answer=ans, index=index
-                )
-                item[i] = sample_item
+            samples = [
+                self._process_sample(question=question, answer=ans, index=index)
+                for ans in answer
+            ]
+            return samples, True
         else:
             raise NotImplementedError("answer format not found")
-        return item
+
+    def __getitem__(self, idx):
+        if self.tokenized is not None:
+            samples, multi = self.tokenized.samples(idx), self.tokenized.is_multi(idx)
+        else:
+            samples, multi = self._tokenize_item(idx)
+        return dict(enumerate(samples)) if multi else samples[0]
 
 
 class QAwithIdkDataset(QADataset):
@@ -0,0 +1,107 @@
+from typing import Iterable, List, Optional
+from torch.utils.data import Sampler
+
+
+def _item_length(item):
+    """Token length of a dataset item; for items holding several samples (e.g. multiple
+    answers), the length of the longest one."""
+    if isinstance(item, dict) and "input_ids" in item:
+        return len(item["input_ids"])
+    if isinstance(item, dict):
+        return max(_item_length(sub_item) for sub_item in item.values())
+    raise ValueError(f"Cannot infer the length of a {type(item)} item")
+
+
+def get_lengths(data) -> List[int]:
+    """Token length of every item of a dataset. Datasets can provide a `lengths`
+    attribute to avoid preprocessing every item once more."""
+    lengths = getattr(data, "lengths", None)
+    if lengths is not None:
+        return list(lengths)
+    return [_item_length(data[i]) for i in range(len(data))]
+
+
+def _item_size(item):
+    """Number of samples of a dataset item (its answers for multi-answer items)."""
+    if isinstance(item, dict) and "input_ids" not in item:
+        return sum(_item_size(sub_item) for sub_item in item.values())
+    return 1
+
+
+def get_sizes(data) -> List[int]:
+    """Number of samples of every item of a dataset."""
+    return [_item_size(data[i]) for i in range(len(data))]
+
+
+class LengthBucketedBatchSampler(Sampler):
+    """Batch sampler grouping items of similar length to minimize padding.
+
+    Items are sorted by decreasing length (so that the most memory-hungry batch runs
+    first) and packed greedily into batches of at most `batch_size` items whose padded
+    size (longest item x number of samples) stays within `max_tokens`, if given.
+    `sizes` gives the number of samples of each item when items are collated into
+    several rows (e.g. flattened answers), one sample per item otherwise.
+    Batches are yielded in that order, so consumers must key results by data index."""
+
+    def __init__(
+        self,
+        lengths: List[int],
+        batch_size: int,
+        max_tokens: Optional[int] = None,
+        sizes: Optional[List[int]] = None,
+    ):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.sizes = sizes if sizes is not None else [1] * len(lengths)
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        # stable sort: items of equal length keep their dataset order
+        order = sorted(range(len(self.lengths)), key=lambda i: -self.lengths[i])
+        batches, batch, rows = [], [], 0
+        for idx in order:
+            # sorted by decreasing length, so the first item sets the padded length
+            padded_len = self.lengths[batch[0]] if batch else self.lengths[idx]
+            over_budget = (
+                self.max_tokens is not None
+                and padded_len * (rows + self.sizes[idx]) > self.max_tokens
+            )
+            if batch and (len(batch) >= self.batch_size or over_budget):
+                batches.append(batch)
+                batch, rows = [], 0
+            batch.append(idx)
+            rows += self.sizes[idx]
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def padding_efficiency(self):
+        """Fraction of non-padding tokens over all batches."""
+        real = sum(length * size for length, size in zip(self.lengths, self.sizes))
+        padded = sum(
+            max(self.lengths[i] for i in batch) * sum(self.sizes[i] for i in batch)
+            for batch in self.batches
+        )
+        return real / padded if padded else 1.0
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class ShardedBatchSampler(Sampler):
+    """Batches of `batch_sampler` dealt round-robin to `num_shards` processes; yields the
+    batches of shard `shard`. Unlike DistributedSampler, no sample is repeated to even
+    out the shards, and batches are the same as in a single process."""
+
+    def __init__(self, batch_sampler: Iterable[List[int]], num_shards: int, shard: int):
+        self.batches = list(batch_sampler)[shard::num_shards]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
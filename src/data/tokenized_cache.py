@@ -0,0 +1,187 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import torch
+from transformers import PreTrainedTokenizerBase
+
+logger = logging.getLogger(__name__)
+
+# bump when the stored layout or the preprocessing changes
+CACHE_VERSION = 1
+_ARRAYS = [
+    "input_ids",
+    "input_offsets",
+    "labels",
+    "label_offsets",
+    "item_offsets",
+    "item_index",
+    "item_multi",
+]
+
+
+def _tokenizer_fingerprint(tokenizer):
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        # truncation and padding are call-time settings left over from the last call
+        state = json.loads(backend.to_str())
+        state.pop("truncation", None)
+        state.pop("padding", None)
+        content = json.dumps(state, sort_keys=True)
+    else:
+        content = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    return [
+        type(tokenizer).__name__,
+        tokenizer.name_or_path,
+        len(tokenizer),
+        tokenizer.chat_template,
+        hashlib.sha256(content.encode("utf-8")).hexdigest(),
+    ]
+
+
+def dataset_fingerprint(dataset) -> str:
+    """Fingerprint of a dataset's preprocessing: its class, its configuration attributes
+    (HF datasets by their own fingerprint) and its tokenizer."""
+    state = {}
+    for key, value in vars(dataset).items():
+        if hasattr(value, "_fingerprint"):  # HF datasets.Dataset
+            state[key] = value._fingerprint
+        elif isinstance(value, PreTrainedTokenizerBase):
+            state[key] = _tokenizer_fingerprint(value)
+        else:
+            state[key] = value
+    payload = json.dumps(
+        [CACHE_VERSION, type(dataset).__name__, state], sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TokenizedCache:
+    """Tokenized samples of a dataset, stored as flat token id and label arrays with
+    offsets in memory-mapped .npy files. An item holds one or more samples (e.g. its
+    answers), all sharing the item's data index.
+
+    Samples are served as zero-copy tensor views of the mapped arrays."""
+
+    def __init__(self, path):
+        self.path = path
+        self._arrays = None
+
+    def __repr__(self):
+        return f"TokenizedCache({self.path!r})"
+
+    def __getstate__(self):
+        # mapped arrays are reopened by each process instead of being pickled
+        return {"path": self.path, "_arrays": None}
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        if self._arrays is None:
+            # copy-on-write mapping: writable (hence torch-compatible) without copying
+            self._arrays = {
+                name: np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="c")
+                for name in _ARRAYS
+            }
+        return self._arrays
+
+    def __len__(self):
+        return len(self.arrays["item_index"])
+
+    def is_multi(self, idx) -> bool:
+        return bool(self.arrays["item_multi"][idx])
+
+    def samples(self, idx) -> List[Dict[str, torch.Tensor]]:
+        arrays = self.arrays
+        index = int(arrays["item_index"][idx])
+        samples = []
+        for i in range(arrays["item_offsets"][idx], arrays["item_offsets"][idx + 1]):
+            input_ids = torch.from_numpy(
+                arrays["input_ids"][
+                    arrays["input_offsets"][i] : arrays["input_offsets"][i + 1]
+                ]
+            )
+            labels = torch.from_numpy(
+                arrays["labels"][
+                    arrays["label_offsets"][i] : arrays["label_offsets"][i + 1]
+                ]
+            )
+            samples.append(
+                {
+                    "input_ids": input_ids,
+                    "labels": labels,
+                    "attention_mask": torch.ones_like(input_ids),
+                    "index": index,
+                }
+            )
+        return samples
+
+    @property
+    def lengths(self) -> List[int]:
+        """Token length of every item, the longest of its samples."""
+        arrays = self.arrays
+        sample_lengths = np.diff(arrays["input_offsets"])
+        return [
+            int(sample_lengths[start:end].max()) if end > start else 0
+            for start, end in zip(
+                arrays["item_offsets"][:-1], arrays["item_offsets"][1:]
+            )
+        ]
+
+    @staticmethod
+    def build(
+        path,
+        num_items: int,
+        tokenize_item: Callable[[int], Tuple[List[Dict[str, torch.Tensor]], bool]],
+    ):
+        """Tokenize items 0..num_items-1 with `tokenize_item`, which returns an item's
+        samples and whether the item is multi-sample, and store them at `path`."""
+        input_ids, labels = [], []
+        input_offsets, label_offsets, item_offsets = [0], [0], [0]
+        item_index, item_multi = [], []
+        for idx in range(num_items):
+            samples, multi = tokenize_item(idx)
+            for sample in samples:
+                input_ids.append(np.asarray(sample["input_ids"], dtype=np.int64))
+                labels.append(np.asarray(sample["labels"], dtype=np.int64))
+                input_offsets.append(input_offsets[-1] + len(input_ids[-1]))
+                label_offsets.append(label_offsets[-1] + len(labels[-1]))
+            item_offsets.append(item_offsets[-1] + len(samples))
+            # items without samples (e.g. an empty list of answers) keep an empty range
+            item_index.append(samples[0].get("index", idx) if samples else idx)
+            item_multi.append(multi)
+        arrays = {
+            "input_ids": np.concatenate(input_ids or [np.zeros(0, np.int64)]),
+            "input_offsets": np.asarray(input_offsets, dtype=np.int64),
+            "labels": np.concatenate(labels or [np.zeros(0, np.int64)]),
+            "label_offsets": np.asarray(label_offsets, dtype=np.int64),
+            "item_offsets": np.asarray(item_offsets, dtype=np.int64),
+            "item_index": np.asarray(item_index, dtype=np.int64),
+            "item_multi": np.asarray(item_multi, dtype=bool),
+        }
+        # write to a temporary directory and move it in place, so that concurrent
+        # processes never read a partial cache
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:  # built concurrently by another process
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_tokenized_cache(
+    cache_dir, dataset, num_items: int, tokenize_item
+) -> TokenizedCache:
+    """Tokenized cache of `dataset` in `cache_dir`, built on first use."""
+    path = os.path.join(cache_dir, dataset_fingerprint(dataset))
+    if not os.path.isdir(path):
+        logger.info(f"Building tokenized cache of {type(dataset).__name__} at {path}")
+        TokenizedCache.build(path, num_items, tokenize_item)
+    return TokenizedCache(path)
@@ -4,6 +4,13 @@ from omegaconf import DictConfig
 from trainer.utils import seed_everything
 from model import get_model
 from evals import get_evaluators
+from evals.distributed import init_distributed
+from evals.execution import (
+    apply_execution_profile,
+    benchmark_throughput,
+    prepare_model,
+)
+from evals.precision_drift import evaluate_precision_drift
 
 import torch
 
@@ -15,10 +22,23 @@ def main(cfg: DictConfig):
         cfg (DictConfig): Config to train
     """
     seed_everything(cfg.seed)
+    # data-parallel evaluation when launched with several processes (torchrun,
+    # accelerate launch); before loading the model so that it lands on this process's GPU
+    init_distributed()
+    execution = cfg.get("execution", None)
+    apply_execution_profile(execution)
     model_cfg = cfg.model
     template_args = model_cfg.template_args
     assert model_cfg is not None, "Invalid model yaml passed in train config."
-    model, tokenizer = get_model(model_cfg)
+    precision = cfg.get("precision", None)
+    attn_impl = execution.get("attn_implementation", None) if execution else None
+    model, tokenizer = get_model(model_cfg, attn_impl=attn_impl, precision=precision)
+    model = prepare_model(model, execution)
+    if execution is not None and execution.benchmark.enabled:
+        benchmark_throughput(model, tokenizer, execution.benchmark)
+        return
+    if precision is not None and precision.quantize and precision.drift_samples:
+        evaluate_precision_drift(cfg, model, tokenizer)
 
     eval_cfgs = cfg.eval
     evaluators = get_evaluators(eval_cfgs)
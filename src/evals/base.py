@@ -1,7 +1,17 @@
 import os
 import json
 import logging
+from evals.columnar_logs import (
+    ColumnarLogWriter,
+    columnar_logs_path,
+    load_logs,
+    stored_as_columnar,
+)
+from evals.distributed import barrier, is_main_process
 from evals.metrics import get_metrics
+from evals.metrics.checkpoint import clear_checkpoints
+from evals.metrics.scheduler import get_metric_scheduler
+from evals.metrics.token_stats import TokenStatsCache
 
 logger = logging.getLogger("evaluator")
 
@@ -12,6 +22,9 @@ class Evaluator:
         self.eval_cfg = eval_cfg
         self.metrics_cfg = self.eval_cfg.metrics
         self.metrics = self.load_metrics(self.metrics_cfg)
+        # forward-pass token statistics shared by all metrics of this evaluator
+        self.stats_cache = TokenStatsCache()
+        self._log_writers = {}
         logger.info(
             f"Evaluations stored in the experiment directory: {self.eval_cfg.output_dir}"
         )
@@ -22,16 +35,16 @@ class Evaluator:
         return logs_filename
 
     def load_logs_from_file(self, file):
-        """Returns the cache of existing results"""
-        logs = {}
-        if os.path.exists(file):
+        """Returns the cache of existing results, stored as json or columnar logs"""
+        logs = load_logs(file)
+        if logs is not None:
             logger.info(f"Loading existing evaluations from {file}")
-            with open(file, "r") as f:
-                logs = json.load(f)
-        return logs
+        return logs or {}
 
     def save_logs(self, logs, file):
-        """Save the logs in a json file"""
+        """Save the logs in a json file (on the main process only)"""
+        if not is_main_process():
+            return
         logs = dict(sorted(logs.items()))
         os.makedirs(os.path.dirname(file), exist_ok=True)
         try:
@@ -40,6 +53,17 @@ class Evaluator:
         except Exception as e:
             raise RuntimeError(f"Failed to save {file}: {e}")
 
+    def save_eval_logs(self, logs, file):
+        """Save the fine-grained logs, as json or (with `logs_format: columnar`) in a
+        columnar logs directory next to `file` that is appended one metric at a time"""
+        if self.eval_cfg.get("logs_format", "json") != "columnar":
+            return self.save_logs(logs, file)
+        if not is_main_process():
+            return
+        if file not in self._log_writers:
+            self._log_writers[file] = ColumnarLogWriter(columnar_logs_path(file), logs)
+        self._log_writers[file].write(logs)
+
     def prepare_model(self, model):
         """Prepare model for evaluation"""
         model.eval()
@@ -59,8 +83,39 @@ class Evaluator:
             agg_value = metric_results.get("agg_value", None)
             if agg_value is not None:
                 metric_summary[metric_name] = agg_value
+            agg_ci = metric_results.get("agg_ci", None)
+            if agg_ci is not None:
+                metric_summary[f"{metric_name}_agg_ci"] = agg_ci
         return metric_summary
 
+    def store_results(
+        self,
+        pending,
+        logs,
+        logs_file_path,
+        summary_file_path,
+        checkpoint_dir,
+        wait=False,
+    ):
+        """Move the results of finished metrics from `pending` to the logs and save them"""
+        finished = [
+            metric_name
+            for metric_name, future in pending.items()
+            if wait or future.done()
+        ]
+        if not finished:
+            return
+        for metric_name in finished:
+            result = pending.pop(metric_name).result()
+            logs[metric_name] = result
+            if metric_name in self.metrics and "agg_value" in result:
+                logger.info(f"Result for metric {metric_name}:\t{result['agg_value']}")
+        self.save_eval_logs(logs, logs_file_path)
+        self.save_logs(self.summarize(logs), summary_file_path)
+        if checkpoint_dir is not None and is_main_process():
+            # saved metrics (and their pre_compute metrics) need no checkpoint
+            clear_checkpoints(checkpoint_dir, logs.keys())
+
     def evaluate(self, model, output_dir=None, overwrite=None, **kwargs):
         # set flag to overwrite metrics
         overwrite = self.eval_cfg.overwrite if overwrite is None else overwrite
@@ -75,6 +130,21 @@ class Evaluator:
 
         # Load existing results from file if any.
         logs = self.load_logs_from_file(logs_file_path) if not overwrite else {}
+        # per-batch results of metrics interrupted before completion
+        checkpoint_dir = None
+        if self.eval_cfg.get("checkpoint_batches", False):
+            checkpoint_dir = self.get_logs_file_path(output_dir, suffix="PARTIAL")
+            checkpoint_dir = os.path.splitext(checkpoint_dir)[0]
+            if overwrite and is_main_process():
+                clear_checkpoints(checkpoint_dir)
+        if self.eval_cfg.get("logs_format", "json") == "columnar" and is_main_process():
+            # results loaded from the columnar logs are not written again
+            self._log_writers[logs_file_path] = ColumnarLogWriter(
+                columnar_logs_path(logs_file_path),
+                logs if stored_as_columnar(logs_file_path) else {},
+            )
+
+        barrier()  # all processes loaded the logs, checkpoints are cleared
 
         # print("DEBUG_2 HERE\n\n", self)
         logger.info(f"***** Running {self.name} evaluation suite *****")
@@ -82,6 +152,10 @@ class Evaluator:
         logger.info(
             f"Aggregated evaluations will be summarised in: {summary_file_path}"
         )
+        # metrics and their pre_compute metrics run as a dependency graph: results are
+        # shared by config across evaluators and CPU-only metrics run in the background
+        scheduler = get_metric_scheduler()
+        pending = {}  # futures of results not yet stored in the logs, by metric name
         for metric_name, metric_fn in self.metrics.items():
             if not overwrite and metric_name in logs and logs[metric_name]:
                 logger.info(f"Skipping {metric_name}, already evaluated.")
@@ -95,19 +169,29 @@ class Evaluator:
             kwargs = {
                 "tokenizer": kwargs.get("tokenizer", None),
                 "template_args": kwargs.get("template_args", None),
+                "stats_cache": self.stats_cache,
+                "batching": self.eval_cfg.get("batching", None),
+                "bootstrap": self.eval_cfg.get("bootstrap", None),
+                "checkpoint_dir": checkpoint_dir,
             }
             metrics_args = self.eval_cfg.metrics[metric_name]
-            _
-            result = metric_fn(
+            scheduler.schedule(
                 model,
-                metric_name=metric_name,
-                cache=logs,
+                metric_fn,
+                metric_name,
+                logs,
+                pending,
+                overlap=self.eval_cfg.get("overlap_cpu_metrics", True),
                 **kwargs,
                 **metrics_args,
             )
-            if "agg_value" in result:
-                logger.info(f"Result for metric {metric_name}:\t{result['agg_value']}")
-            self.save_logs(logs, logs_file_path)
-            self.save_logs(self.summarize(logs), summary_file_path)
+            self.store_results(
+                pending, logs, logs_file_path, summary_file_path, checkpoint_dir
+            )
+        self.store_results(
+            pending, logs, logs_file_path, summary_file_path, checkpoint_dir, wait=True
+        )
 
+        # under data-parallel evaluation, wait for the main process to write the logs
+        barrier()
         return self.summarize(logs)
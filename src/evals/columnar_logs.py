@@ -0,0 +1,200 @@
+"""
+Columnar storage of evaluation logs: one zstd-compressed Parquet file per metric,
+holding its `value_by_index` entries column by column, and a small JSON index holding
+everything else (e.g. `agg_value`). Metrics are written as they are evaluated, without
+rewriting the ones already stored.
+"""
+
+import os
+import json
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+INDEX_FILE = "index.json"
+FORMAT_VERSION = 1
+_NATIVE_TYPES = (bool, int, float, str)
+_JSON_ROWS = "__json__"  # single column of JSON-encoded entries
+
+
+def columnar_logs_path(file):
+    """Directory of the columnar logs standing in for the json logs file `file`."""
+    root, ext = os.path.splitext(file)
+    return root if ext == ".json" else file
+
+
+def _native_type(values):
+    """Arrow-storable python type of a column whose values all share one scalar type
+    (or are all lists of one scalar type), None otherwise. Columns mixing types (e.g.
+    ints and floats) are JSON-encoded so that they load back exactly as json would."""
+    kinds = set()
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            kinds.add(("list", *{type(v) for v in value}))
+        else:
+            kinds.add(type(value))
+    if len(kinds) != 1:
+        return None
+    kind = kinds.pop()
+    if isinstance(kind, tuple):
+        return kind if len(kind) == 2 and kind[1] in _NATIVE_TYPES else None
+    return kind if kind in _NATIVE_TYPES else None
+
+
+def _to_table(value_by_index):
+    """Arrow table of per-index entries: an `index` column and one column per stat."""
+    indices = [str(idx) for idx in value_by_index]
+    entries = list(value_by_index.values())
+    keys = list(entries[0].keys()) if isinstance(entries[0], dict) else None
+    if keys is None or any(
+        not isinstance(entry, dict) or list(entry.keys()) != keys for entry in entries
+    ):
+        # entries without a common set of stats are stored whole
+        rows = [json.dumps(entry) for entry in entries]
+        return pa.table({"index": indices, _JSON_ROWS: rows}), []
+    columns, json_columns = {"index": indices}, []
+    for key in keys:
+        values = [entry[key] for entry in entries]
+        if _native_type(values) is None:
+            values = [json.dumps(value) for value in values]
+            json_columns.append(key)
+        columns[key] = values
+    return pa.table(columns), json_columns
+
+
+def _from_table(table, json_columns):
+    columns = table.to_pydict()
+    indices = columns.pop("index")
+    if _JSON_ROWS in columns:
+        return {idx: json.loads(row) for idx, row in zip(indices, columns[_JSON_ROWS])}
+    for key in json_columns:
+        columns[key] = [json.loads(value) for value in columns[key]]
+    return {
+        idx: {key: values[i] for key, values in columns.items()}
+        for i, idx in enumerate(indices)
+    }
+
+
+def _atomic_write(path, write_fn):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    os.close(fd)
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_index(path):
+    index_file = os.path.join(path, INDEX_FILE)
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file, "r") as f:
+        return json.load(f)["metrics"]
+
+
+def load_columnar_logs(path):
+    """Logs dict stored in the columnar logs directory `path`, as json would load it."""
+    logs = {}
+    for metric_name, entry in _read_index(path).items():
+        result = entry["result"]
+        if entry["file"] is not None:
+            table = pq.read_table(os.path.join(path, entry["file"]))
+            value_by_index = _from_table(table, entry["json_columns"])
+            result = {
+                key: value_by_index if key == "value_by_index" else result[key]
+                for key in entry["keys"]
+            }
+        logs[metric_name] = result
+    return logs
+
+
+def stored_as_columnar(file):
+    """Whether the logs at `file` are read from its columnar logs directory: it exists
+    and is not older than the json file, if any."""
+    index_file = os.path.join(columnar_logs_path(file), INDEX_FILE)
+    return os.path.exists(index_file) and not (
+        os.path.isfile(file) and os.path.getmtime(file) > os.path.getmtime(index_file)
+    )
+
+
+def load_logs(file):
+    """Logs stored at `file`, a json file, or in its columnar logs directory. If both
+    exist, the most recently written one is loaded. Returns None if neither exists."""
+    if stored_as_columnar(file):
+        return load_columnar_logs(columnar_logs_path(file))
+    if os.path.isfile(file):
+        with open(file, "r") as f:
+            return json.load(f)
+    return None
+
+
+class ColumnarLogWriter:
+    """Writes a logs dict to a columnar logs directory, one metric at a time.
+
+    `write` stores the metrics added (or replaced) since its last call, drops the ones
+    removed from the logs and rewrites the JSON index; results already on disk are not
+    serialized again. Results of
+    `logs` that are in the directory's index are taken as already written, so the
+    writer must be given the logs loaded from it (or {} to start over)."""
+
+    def __init__(self, path, logs):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._index = _read_index(path)
+        self._written = {
+            metric_name: logs[metric_name]
+            for metric_name in self._index
+            if metric_name in logs
+        }
+
+    def _remove(self, file):
+        if file is not None and os.path.exists(os.path.join(self.path, file)):
+            os.remove(os.path.join(self.path, file))
+
+    def _write_metric(self, metric_name, result):
+        value_by_index = (
+            result.get("value_by_index") if isinstance(result, dict) else None
+        )
+        if not isinstance(value_by_index, dict) or not value_by_index:
+            return {"file": None, "json_columns": [], "result": result}
+        table, json_columns = _to_table(value_by_index)
+        file = f"{metric_name}.parquet"
+        _atomic_write(
+            os.path.join(self.path, file),
+            lambda tmp_path: pq.write_table(table, tmp_path, compression="zstd"),
+        )
+        return {
+            "file": file,
+            "json_columns": json_columns,
+            "keys": list(result.keys()),
+            "result": {k: v for k, v in result.items() if k != "value_by_index"},
+        }
+
+    def write(self, logs):
+        for metric_name, result in sorted(logs.items()):
+            if self._written.get(metric_name) is not result:
+                previous = self._index.get(metric_name)
+                self._index[metric_name] = self._write_metric(metric_name, result)
+                self._written[metric_name] = result
+                if previous and previous["file"] != self._index[metric_name]["file"]:
+                    self._remove(previous["file"])
+        for metric_name in list(self._index):
+            if metric_name not in logs:  # dropped from the logs, e.g. on overwrite
+                self._remove(self._index.pop(metric_name)["file"])
+                self._written.pop(metric_name, None)
+        index = {
+            "format_version": FORMAT_VERSION,
+            "metrics": dict(sorted(self._index.items())),
+        }
+
+        def write_index(tmp_path):
+            with open(tmp_path, "w") as f:
+                json.dump(index, f, indent=4)
+
+        _atomic_write(os.path.join(self.path, INDEX_FILE), write_index)
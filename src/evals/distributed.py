@@ -0,0 +1,60 @@
+"""
+Data-parallel evaluation. When torch.distributed is initialized with several processes
+(e.g. under `accelerate launch` or `torchrun`), every process evaluates a shard of the
+batches of each dataset and per-index results are gathered before aggregation.
+"""
+
+import os
+import logging
+
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger("evaluator")
+
+
+def get_world_size() -> int:
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size()
+    return 1
+
+
+def get_rank() -> int:
+    return dist.get_rank() if get_world_size() > 1 else 0
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def gather_objects(obj) -> list:
+    """The (picklable) `obj` of every process, in rank order, on every process."""
+    if get_world_size() == 1:
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def barrier():
+    if get_world_size() > 1:
+        dist.barrier()
+
+
+def init_distributed():
+    """Initialize the default process group from the environment variables set by
+    launchers (WORLD_SIZE, RANK, LOCAL_RANK, MASTER_ADDR/PORT): NCCL with one GPU per
+    process if GPUs are available, gloo on CPU otherwise."""
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1 or not dist.is_available() or dist.is_initialized():
+        return
+    if torch.cuda.is_available():
+        # "cuda" device maps (model, classifier) then resolve to this process's GPU
+        torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", 0)))
+        backend = "nccl"
+    else:
+        backend = "gloo"
+    dist.init_process_group(backend=backend)
+    logger.info(
+        f"Data-parallel evaluation: process {get_rank()} of {world_size} ({backend})"
+    )
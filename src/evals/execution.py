@@ -0,0 +1,215 @@
+"""
+Execution profiles of evaluation runs (`execution` config group). The `cpu` profile
+sizes torch's thread pools to the physical cores available to each process, pins each
+of several processes per machine to one NUMA node, runs forward passes under bf16
+autocast on CPUs with native bf16 support, compiles the transformer forward and uses
+SDPA attention. The benchmark mode measures the throughput of the probability and
+generation paths.
+"""
+
+import os
+import time
+import logging
+from functools import wraps
+
+import torch
+
+from model.quantization import is_quantized
+from evals.metrics.utils import evaluate_probability
+
+logger = logging.getLogger("evaluator")
+
+_NODE_DIR = "/sys/devices/system/node"
+_CPU_DIR = "/sys/devices/system/cpu"
+
+
+def _parse_cpulist(text):
+    """CPU ids of a sysfs cpulist, e.g. "0-3,8-11"."""
+    cpus = set()
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def _numa_nodes():
+    """CPU ids of each NUMA node, by node id (empty without sysfs NUMA information)."""
+    nodes = {}
+    if not os.path.isdir(_NODE_DIR):
+        return nodes
+    for name in os.listdir(_NODE_DIR):
+        if name.startswith("node") and name[4:].isdigit():
+            with open(os.path.join(_NODE_DIR, name, "cpulist")) as f:
+                nodes[int(name[4:])] = _parse_cpulist(f.read())
+    return nodes
+
+
+def _physical_cores(cpus):
+    """Number of physical cores among the logical CPUs `cpus`."""
+    cores = set()
+    for cpu in cpus:
+        topology = os.path.join(_CPU_DIR, f"cpu{cpu}", "topology")
+        try:
+            with open(os.path.join(topology, "physical_package_id")) as f:
+                package = f.read().strip()
+            with open(os.path.join(topology, "core_id")) as f:
+                cores.add((package, f.read().strip()))
+        except OSError:
+            cores.add(cpu)
+    return len(cores)
+
+
+def cpu_supports_bf16():
+    """Whether the CPU computes bf16 natively (AVX512-BF16 or AMX)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def _pin_numa_node(numa_node):
+    """Pin this process to the CPUs of `numa_node`. With "auto", processes launched
+    several per machine are pinned to one node each, by local rank, and a single
+    process keeps all its CPUs. Returns the number of processes sharing the node, or
+    None if the process was not pinned."""
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    if numa_node == "auto" and local_world_size == 1:
+        return None
+    nodes = _numa_nodes()
+    if not nodes or not hasattr(os, "sched_setaffinity"):
+        logger.warning("NUMA pinning is not available on this system")
+        return None
+    sharing = local_world_size
+    if numa_node == "auto":
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        numa_node = sorted(nodes)[local_rank % len(nodes)]
+        sharing = -(-local_world_size // len(nodes))
+    cpus = nodes[int(numa_node)] & os.sched_getaffinity(0)
+    if not cpus:
+        return None
+    os.sched_setaffinity(0, cpus)
+    logger.info(f"Pinned to the {len(cpus)} CPUs of NUMA node {numa_node}")
+    return sharing
+
+
+def apply_execution_profile(execution):
+    """Set up threads and CPU pinning of this process for the `execution` config,
+    before the model is loaded."""
+    if execution is None:
+        return
+    sharing = None
+    if execution.get("numa_node", None) is not None:
+        sharing = _pin_numa_node(execution.numa_node)
+    num_threads = execution.get("num_threads", None)
+    if num_threads == "auto":
+        # physical cores shared by the processes running on the same CPUs
+        cpus = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else None
+        cores = _physical_cores(cpus) if cpus else os.cpu_count()
+        if sharing is None:
+            sharing = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        num_threads = max(1, cores // sharing)
+    if num_threads is not None:
+        torch.set_num_threads(int(num_threads))
+    num_interop_threads = execution.get("num_interop_threads", None)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(int(num_interop_threads))
+        except RuntimeError as e:  # inter-op pool already started
+            logger.warning(f"Could not set inter-op threads: {e}")
+    logger.info(
+        f"Execution profile {execution.get('profile', 'default')}: "
+        f"{torch.get_num_threads()} intra-op, "
+        f"{torch.get_num_interop_threads()} inter-op threads"
+    )
+
+
+def _autocast_forward(module, dtype):
+    forward = module.forward
+
+    @wraps(forward)
+    def autocast_forward(*args, **kwargs):
+        with torch.autocast("cpu", dtype=dtype):
+            return forward(*args, **kwargs)
+
+    module.forward = autocast_forward
+
+
+def prepare_model(model, execution):
+    """Apply the `execution` config to a loaded model: bf16 autocast and compilation of
+    the transformer forward, which the probability, token statistics and generation
+    paths all run through (the language model head of chunked scoring runs outside
+    it)."""
+    if execution is None:
+        return model
+    base_model = getattr(model, "base_model", model)
+    if execution.get("compile", False):
+        base_model.forward = torch.compile(
+            base_model.forward,
+            dynamic=True,  # one graph for all batch shapes
+            mode=execution.get("compile_mode", None),
+        )
+        logger.info("Compiled the transformer forward with torch.compile")
+    bf16_autocast = execution.get("bf16_autocast", False)
+    if bf16_autocast == "auto":
+        bf16_autocast = model.device.type == "cpu" and cpu_supports_bf16()
+    if bf16_autocast and is_quantized(model):
+        # quantized layers take float32 activations only
+        logger.warning("bf16 autocast disabled for the quantized model")
+        bf16_autocast = False
+    if bf16_autocast:
+        for module in {id(m): m for m in (model, base_model)}.values():
+            _autocast_forward(module, torch.bfloat16)
+        logger.info("Forward passes run under bf16 autocast")
+    return model
+
+
+def _seconds_per_step(fn, steps):
+    fn()  # warm-up, e.g. compilation
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    return (time.perf_counter() - start) / steps
+
+
+def benchmark_throughput(model, tokenizer, benchmark):
+    """Tokens per second of the probability path (forward pass and per-example loss)
+    and of greedy generation (generated tokens, prompt processing included), on random
+    prompts of `benchmark.batch_size` x `benchmark.seq_len` tokens."""
+    batch_size, seq_len = benchmark.batch_size, benchmark.seq_len
+    max_new_tokens, steps = benchmark.max_new_tokens, benchmark.steps
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(
+        0, model.config.vocab_size, (batch_size, seq_len), generator=generator
+    )
+    batch = {
+        "input_ids": input_ids,
+        "attention_mask": torch.ones_like(input_ids),
+        "labels": input_ids.clone(),
+    }
+
+    def generate():
+        with torch.no_grad():
+            model.generate(
+                input_ids.to(model.device),
+                attention_mask=batch["attention_mask"].to(model.device),
+                do_sample=False,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                pad_token_id=tokenizer.eos_token_id,
+            )
+
+    results = {
+        "probability_tokens_per_sec": batch_size
+        * seq_len
+        / _seconds_per_step(lambda: evaluate_probability(model, batch), steps),
+        "generation_tokens_per_sec": batch_size
+        * max_new_tokens
+        / _seconds_per_step(generate, steps),
+    }
+    for name, value in results.items():
+        logger.info(f"Benchmark {name}: {value:.1f}")
+    return results
@@ -17,6 +17,7 @@ from evals.metrics.mia import (
     mia_gradnorm,
     mia_zlib,
     mia_reference,
+    mia_sweep,
 )
 from evals.metrics.utility import (
     hm_aggregate,
@@ -70,6 +71,7 @@ _register_metric(mia_min_k_plus_plus)
 _register_metric(mia_gradnorm)
 _register_metric(mia_zlib)
 _register_metric(mia_reference)
+_register_metric(mia_sweep)
 
 # Register Utility metrics
 _register_metric(classifier_prob)
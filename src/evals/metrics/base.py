@@ -1,8 +1,9 @@
 import os
-import json
 import logging
 from typing import Callable, Any, Dict
 from data import get_datasets, get_collators
+from evals.columnar_logs import load_logs
+from evals.metrics.checkpoint import MetricCheckpoint, checkpoint_signature
 
 logger = logging.getLogger("metrics")
 
@@ -12,9 +13,12 @@ class UnlearningMetric:
         self,
         name: str,
         metric_fn: Callable[..., Any],
+        cpu_only: bool = False,
     ):
         self.name = name
         self._metric_fn = metric_fn
+        # computed from pre_compute results and reference logs alone, without the model
+        self.cpu_only = cpu_only
         self.data = None
         self.collators = None
         self.pre_compute_metrics: Dict[str, Callable] = {}
@@ -48,19 +52,19 @@ class UnlearningMetric:
         return results
 
     def load_logs_from_file(self, file):
-        """Load a logs file, assumes json"""
-        logs = {}
-        if os.path.exists(file):
-            logger.info(f"Loading evaluations from {file}")
-            with open(file, "r") as f:
-                logs = json.load(f)
-        else:
+        """Load a logs file, json or its columnar logs directory"""
+        logs = load_logs(file)
+        if logs is None:
             raise ValueError(f"{file} doesn't exist!")
+        logger.info(f"Loading evaluations from {file}")
         return logs
 
-    def prepare_kwargs_evaluate_metric(self, model, metric_name, cache={}, **kwargs):
+    def prepare_kwargs_evaluate_metric(
+        self, model, metric_name, cache={}, pre_compute_results=None, **kwargs
+    ):
         """Prepare the kwargs required to call the metric_fn defined by user.
-        - Loads datasets, collators, results for pre_compute metrics
+        - Loads datasets, collators, results for pre_compute metrics (evaluated here
+          unless `pre_compute_results` are given, by access key)
         Returns:
             Dict: Updated kwargs with datasets, collators, pre_compute results loaded
         """
@@ -78,7 +82,9 @@ class UnlearningMetric:
 
         # Evaluate precompute and load results
         pre_compute_cfgs = kwargs.pop("pre_compute", {})
-        pre_metric_results = {}
+        pre_metric_results = dict(pre_compute_results or {})
+        if pre_compute_results is not None:
+            pre_compute_cfgs = {}
         for pre_metric_name, pre_metric_cfg in pre_compute_cfgs.items():
             access_name = pre_metric_cfg.get("access_key", pre_metric_name)
             _results = {}
@@ -127,15 +133,35 @@ class UnlearningMetric:
 
         return kwargs
 
+    def compute(self, model, metric_name, pre_compute_results=None, cache={}, **kwargs):
+        """Evaluates a metric, given the results of its pre_compute metrics by access
+        key, or evaluating them (reusing those in `cache`) if not given"""
+        # pre_compute metrics get the checkpoint_dir to checkpoint themselves
+        checkpoint_dir = kwargs.get("checkpoint_dir", None)
+        metric_kwargs = self.prepare_kwargs_evaluate_metric(
+            model, metric_name, cache, pre_compute_results=pre_compute_results, **kwargs
+        )
+        metric_kwargs.pop("checkpoint_dir", None)
+        if checkpoint_dir is not None:
+            signature = checkpoint_signature(
+                model, {k: v for k, v in kwargs.items() if k != "checkpoint_dir"}
+            )
+            if signature is None:
+                logger.warning(
+                    f"Not checkpointing {metric_name}: unresolved model revision"
+                )
+            else:
+                metric_kwargs["checkpoint"] = MetricCheckpoint(
+                    os.path.join(checkpoint_dir, metric_name), signature
+                )
+        return self.evaluate_metric(model, metric_name, **metric_kwargs)
+
     def evaluate(self, model, metric_name, cache, **kwargs):
         """Evaluates a metric including its pre_compute metrics"""
         if metric_name in cache:
             logger.info(f"Skipping {metric_name}, already evaluated.")
-
-        metric_kwargs = self.prepare_kwargs_evaluate_metric(
-            model, metric_name, cache, **kwargs
-        )
-        results = self.evaluate_metric(model, metric_name, **metric_kwargs)
+            return cache[metric_name]
+        results = self.compute(model, metric_name, cache=cache, **kwargs)
         cache.update({metric_name: results})
         return results
 
@@ -153,9 +179,10 @@ class UnlearningMetric:
 
 # decorator that wraps simple user-defined metric python functions into callable UnlearningMetric objects
 class unlearning_metric:
-    def __init__(self, name: str):
+    def __init__(self, name: str, cpu_only: bool = False):
         self.name = name
+        self.cpu_only = cpu_only
 
     def __call__(self, metric_fn: Callable[..., Any]) -> UnlearningMetric:
         name = self.name or metric_fn.__name__
-        return UnlearningMetric(name=name, metric_fn=metric_fn)
+        return UnlearningMetric(name=name, metric_fn=metric_fn, cpu_only=self.cpu_only)
@@ -0,0 +1,175 @@
+"""
+Evaluation batch sizes safe for GPU memory. With `batch_size: auto` in a metric config,
+the metric's pass uses the batch size found safe before for the same kind of pass,
+model and maximum sequence length (stored on disk). The first time, it is probed: the
+pass runs on copies of the longest item, doubling their number up to
+`batching.max_batch_size` until it runs out of GPU memory. Whatever the batch size, a
+batch running out of GPU memory is split in halves and retried instead of failing the
+evaluation, and the next batches of the pass are split likewise; `auto` batch sizes are
+then stored.
+"""
+
+import os
+import json
+import logging
+import tempfile
+from concurrent.futures import Future
+
+import torch
+
+from evals.distributed import gather_objects, get_world_size, is_main_process
+
+logger = logging.getLogger("metrics")
+
+DEFAULT_MAX_BATCH_SIZE = 64
+
+
+def _model_fingerprint(model):
+    """Model properties that bound the batch sizes that fit in memory."""
+    device = next(model.parameters()).device
+    fingerprint = [
+        type(model).__name__,
+        getattr(getattr(model, "config", None), "_name_or_path", None),
+        str(next(model.parameters()).dtype),
+        sum(param.numel() for param in model.parameters()),
+        device.type,
+    ]
+    if device.type == "cuda":
+        fingerprint.append(torch.cuda.get_device_properties(device).total_memory)
+    return fingerprint
+
+
+def probe_batch_size(probe, max_batch_size):
+    """Largest batch size, doubling from 1 up to `max_batch_size`, for which
+    `probe(batch_size)` does not run out of GPU memory (1 if none does)."""
+    size, safe = 1, 1
+    while True:
+        try:
+            probe(size)
+        except torch.cuda.OutOfMemoryError:
+            oom = True
+        else:
+            oom, safe = False, size
+        if oom:
+            # outside the except block: the failed pass's tensors are released
+            torch.cuda.empty_cache()
+            return safe
+        if size >= max_batch_size:
+            return safe
+        size = min(2 * size, max_batch_size)
+
+
+class AutoBatchSize:
+    """Batch size of a pass over a dataloader, in items, and after a batch ran out of
+    GPU memory, the number of rows (e.g. answers of flattened multi-answer items)
+    evaluated at once. With a `key` and a `cache_path`, the batch size is read from and
+    stored to the json file of safe batch sizes by key."""
+
+    def __init__(self, size, key=None, cache_path=None):
+        self.size = size
+        self.max_rows = None
+        self.batch_rows = 0  # rows of the largest batch
+        self.key = key
+        self.cache_path = cache_path
+        self.changed = False
+
+    @classmethod
+    def resolve(
+        cls, batch_size, model=None, kind=None, lengths=None, batching=None, probe=None
+    ):
+        """The batch size of a pass of `kind` (e.g. "token_stats") of `model` over data
+        of the given item `lengths`: `batch_size` itself unless it is "auto". Automatic
+        batch sizes not stored before are probed on GPU with `probe(batch_size)`, which
+        runs the pass on a batch of that many copies of the longest item."""
+        if batch_size != "auto":
+            return cls(int(batch_size))
+        if model is None:
+            raise ValueError(f"batch_size: auto is not supported by {kind} passes")
+        batching = batching or {}
+        cache_path = batching.get("batch_size_cache", None)
+        payload = [kind, _model_fingerprint(model), max(lengths, default=0)]
+        key = json.dumps(payload, sort_keys=True, default=str)
+        cached = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                cached = json.load(f)
+        size = cached.get(key, None)
+        if size is None:
+            size = batching.get("max_batch_size", DEFAULT_MAX_BATCH_SIZE)
+            if probe is not None and next(model.parameters()).device.type == "cuda":
+                logger.info(f"Probing the batch size for {kind}, up to {size}")
+                size = probe_batch_size(probe, size)
+                if get_world_size() > 1:  # all processes batch the data alike
+                    size = min(gather_objects(size))
+        auto = cls(size, key=key, cache_path=cache_path)
+        auto.changed = key not in cached
+        logger.info(f"Automatic batch size for {kind}: {auto.size}")
+        return auto
+
+    def backoff(self, rows):
+        """Evaluate fewer than `rows` rows at once, which ran out of memory."""
+        self.max_rows = max(1, rows // 2)
+        self.changed = True
+        logger.warning(
+            f"Out of GPU memory with {rows} rows, retrying with {self.max_rows} at once"
+        )
+
+    def save(self):
+        """Store the batch size found for an automatic batch size."""
+        if self.key is None or self.cache_path is None or not self.changed:
+            return
+        if not is_main_process():
+            return
+        cached = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, "r") as f:
+                cached = json.load(f)
+        size = self.size
+        if self.max_rows is not None:  # as many items as rows evaluated at once
+            size = max(1, size * self.max_rows // max(self.batch_rows, size))
+        cached[self.key] = size
+        cache_dir = os.path.dirname(os.path.abspath(self.cache_path))
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(cached, f, indent=4)
+        os.replace(tmp_path, self.cache_path)
+        self.changed = False
+
+
+def _rows(batch, start, end):
+    """Rows `start:end` of a collated batch."""
+    return {
+        key: value[start:end] if isinstance(value, (torch.Tensor, list)) else value
+        for key, value in batch.items()
+    }
+
+
+def evaluate_with_backoff(batch_fn, batch, auto):
+    """Evaluate `batch_fn`, which maps a batch to a list of per-row results (or a Future
+    of it), on sub-batches of at most `auto.max_rows` rows of `batch`. Sub-batches
+    running out of GPU memory are retried in halves (see `AutoBatchSize.backoff`)."""
+    num_rows = len(batch["input_ids"])
+    auto.batch_rows = max(auto.batch_rows, num_rows)
+    parts, start = [], 0
+    while start < num_rows:
+        end = min(start + (auto.max_rows or num_rows), num_rows)
+        try:
+            parts.append(batch_fn(_rows(batch, start, end)))
+        except torch.cuda.OutOfMemoryError:
+            if end - start == 1:
+                raise
+            oom = True
+        else:
+            oom, start = False, end
+        if oom:
+            # outside the except block: the failed pass's tensors are released
+            torch.cuda.empty_cache()
+            auto.backoff(end - start)
+    if len(parts) == 1:
+        return parts[0]
+    return [
+        row
+        for part in parts
+        for row in (part.result() if isinstance(part, Future) else part)
+    ]
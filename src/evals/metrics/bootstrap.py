@@ -0,0 +1,126 @@
+"""
+Bootstrap confidence intervals of aggregate metric values. The values of each item are
+resampled with replacement thousands of times; all resamples of a chunk are evaluated
+at once with array operations. Two-sample statistics (AUC, KS test) resample each
+sample separately, and are computed from the counts of every distinct value in each
+resample, so that no resampled array is sorted.
+"""
+
+import numpy as np
+from scipy.stats import ks_2samp
+
+# resampled entries held in memory at once
+_CHUNK_ENTRIES = 2**22
+
+
+def bootstrap_settings(kwargs):
+    """(num_samples, confidence, seed) of the `bootstrap` evaluator setting passed to
+    metrics, or None when confidence intervals are disabled."""
+    cfg = kwargs.get("bootstrap", None) or {}
+    num_samples = cfg.get("num_samples", 0)
+    if not num_samples:
+        return None
+    return num_samples, cfg.get("confidence", 0.95), cfg.get("seed", 0)
+
+
+def _chunks(num_samples, size):
+    """Sizes of chunks of resamples, each resample holding `size` entries."""
+    chunk = max(1, _CHUNK_ENTRIES // max(size, 1))
+    for start in range(0, num_samples, chunk):
+        yield min(chunk, num_samples - start)
+
+
+def _interval(stats, confidence):
+    """Percentile interval of the bootstrap distribution `stats`."""
+    alpha = (1 - confidence) / 2
+    low, high = np.percentile(stats, [100 * alpha, 100 * (1 - alpha)])
+    return [float(low), float(high)]
+
+
+def _resampled_counts(positions, num_values, rng, num_resamples):
+    """Counts (num_resamples, num_values) of each distinct value in resamples of a
+    sample, given the position of every entry of the sample among the distinct values."""
+    n = len(positions)
+    draws = positions[rng.integers(0, n, size=(num_resamples, n))]
+    draws += num_values * np.arange(num_resamples)[:, None]
+    counts = np.bincount(draws.ravel(), minlength=num_resamples * num_values)
+    return counts.reshape(num_resamples, num_values)
+
+
+def _two_sample_counts(x, y, settings):
+    """Yield the pooled distinct values of `x` and `y` and their counts in resamples of
+    each, one chunk of resamples at a time."""
+    num_samples, _, seed = settings
+    rng = np.random.default_rng(seed)
+    values = np.unique(np.concatenate([x, y]))
+    x_pos, y_pos = np.searchsorted(values, x), np.searchsorted(values, y)
+    for size in _chunks(num_samples, len(x) + len(y) + len(values)):
+        yield (
+            values,
+            _resampled_counts(x_pos, len(values), rng, size),
+            _resampled_counts(y_pos, len(values), rng, size),
+        )
+
+
+def mean_ci(values, settings):
+    """Confidence interval of the mean over items of `values` (items, ...); NaN bounds
+    without items, like their mean."""
+    num_samples, confidence, seed = settings
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return [float("nan"), float("nan")]
+    values = values.reshape(len(values), -1).mean(axis=1)
+    rng = np.random.default_rng(seed)
+    stats = np.concatenate(
+        [
+            values[rng.integers(0, len(values), size=(size, len(values)))].mean(axis=1)
+            for size in _chunks(num_samples, len(values))
+        ]
+    )
+    return _interval(stats, confidence)
+
+
+def mean_results(values, value_by_index, kwargs):
+    """Metric results aggregated as the mean of `values`, with its confidence interval
+    as `agg_ci` if bootstrapping is enabled in `kwargs`."""
+    results = {"agg_value": np.mean(values), "value_by_index": value_by_index}
+    settings = bootstrap_settings(kwargs)
+    if settings is not None:
+        results["agg_ci"] = mean_ci(values, settings)
+    return results
+
+
+def auc_ci(negative_scores, positive_scores, settings):
+    """Confidence interval of the ROC AUC of scores labeled 0 and 1, rank-based as
+    `roc_auc_score`: the fraction of (negative, positive) pairs ordered correctly, ties
+    counting half."""
+    _, confidence, _ = settings
+    negative_scores = np.asarray(negative_scores, dtype=np.float64)
+    positive_scores = np.asarray(positive_scores, dtype=np.float64)
+    num_pairs = len(negative_scores) * len(positive_scores)
+    stats = []
+    for _, neg, pos in _two_sample_counts(negative_scores, positive_scores, settings):
+        below = np.cumsum(neg, axis=1) - neg  # negatives under each distinct value
+        stats.append((pos * (below + 0.5 * neg)).sum(axis=1) / num_pairs)
+    return _interval(np.concatenate(stats), confidence)
+
+
+def ks_ci(x, y, settings):
+    """Confidence interval of the p-value of the two-sample KS test `ks_2samp(x, y)`.
+    For fixed sample sizes the p-value depends on the statistic only, so `ks_2samp` runs
+    once per distinct statistic, on a resample attaining it."""
+    _, confidence, _ = settings
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    # statistics are multiples of 1 / (len(x) * len(y)): exact integer keys
+    pvalues, stats = {}, []
+    for values, x_counts, y_counts in _two_sample_counts(x, y, settings):
+        x_cdf = np.cumsum(x_counts, axis=1) * len(y)
+        y_cdf = np.cumsum(y_counts, axis=1) * len(x)
+        keys = np.abs(x_cdf - y_cdf).max(axis=1)
+        for key, row in zip(*np.unique(keys, return_index=True)):
+            if key not in pvalues:
+                pvalues[key] = ks_2samp(
+                    np.repeat(values, x_counts[row]), np.repeat(values, y_counts[row])
+                ).pvalue
+        stats.append(np.array([pvalues[key] for key in keys]))
+    return _interval(np.concatenate(stats), confidence)
@@ -0,0 +1,135 @@
+"""
+Checkpoints of partially evaluated metrics. Batch-wise passes append the per-index
+results of every finished batch to a shard file, so that an interrupted evaluation
+resumes from its last finished batch instead of starting the metric over.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+from omegaconf import DictConfig, ListConfig, OmegaConf
+
+from model.checkpoint import checkpoint_fingerprint
+from evals.distributed import get_rank, get_world_size
+from evals.metrics.token_stats import _model_state
+
+logger = logging.getLogger("metrics")
+
+
+def _to_json(value):
+    if hasattr(value, "tolist"):  # numpy / torch scalars and arrays
+        return value.tolist()
+    raise TypeError(f"Cannot store a {type(value)} in a result shard")
+
+
+def model_fingerprint(model):
+    """Fingerprint of the weights of `model`: the fingerprint of the checkpoint it was
+    loaded from (the commit of a Hub model, or the files of a local directory) and the
+    in-place updates of its parameters since (see `_model_state`). None if the commit of
+    a Hub model cannot be resolved."""
+    path = getattr(model, "name_or_path", None)
+    checkpoint = None
+    if path:
+        commit = getattr(getattr(model, "config", None), "_commit_hash", None)
+        checkpoint = checkpoint_fingerprint(path, revision=commit)
+        if checkpoint is None:
+            return None
+    return [path, checkpoint, _model_state(model)]
+
+
+def checkpoint_signature(model, metric_kwargs):
+    """Fingerprint of a metric evaluation: the model's weights (see
+    `model_fingerprint`), the metric's configuration values (objects such as datasets or
+    tokenizers are left out) and the number of data-parallel processes, which decides
+    the batches of each process. None if the model's weights cannot be identified."""
+    weights = model_fingerprint(model)
+    if weights is None:
+        return None
+    config = {}
+    for key, value in metric_kwargs.items():
+        if isinstance(value, (DictConfig, ListConfig)):
+            config[key] = OmegaConf.to_container(value, resolve=True)
+        elif isinstance(value, (str, int, float, bool, list, dict, type(None))):
+            config[key] = value
+    payload = json.dumps(
+        [weights, config, get_world_size()],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultShard:
+    """Append-only JSON-lines file of the results of one batch-wise pass: a header with
+    the evaluation's signature, then a line of [intra_item_idx, index, result] rows per
+    finished batch. A shard written under another signature is started over."""
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.results = {}
+        lines = []
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                lines = f.read().split("\n")
+        if lines and lines[0] == json.dumps({"signature": signature}):
+            valid = 1
+            for line in lines[1:]:
+                try:
+                    rows = json.loads(line)
+                except json.JSONDecodeError:  # batch cut short by an interruption
+                    break
+                for intra_item_idx, idx, result in rows:
+                    self.results[(intra_item_idx, idx)] = result
+                valid += 1
+            lines = lines[:valid]
+        else:
+            lines = [json.dumps({"signature": signature})]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        if self.results:
+            logger.info(f"Resuming from {len(self.results)} results stored in {path}")
+
+    def done(self, keys) -> bool:
+        """Whether results of all (intra_item_idx, index) keys are stored."""
+        return all(key in self.results for key in keys)
+
+    def append(self, rows):
+        """Store the (intra_item_idx, index, result) rows of a finished batch."""
+        line = json.dumps([list(row) for row in rows], default=_to_json)
+        with open(self.path, "a") as f:
+            f.write(line + "\n")
+        for intra_item_idx, idx, result in json.loads(line):
+            self.results[(intra_item_idx, idx)] = result
+
+
+class MetricCheckpoint:
+    """Result shards of the batch-wise passes of one metric, stored in `directory` and
+    numbered in the order the metric runs them (or named, for passes that may or may
+    not run, e.g. token statistics served by a cache), one per data-parallel process."""
+
+    def __init__(self, directory, signature):
+        self.directory = directory
+        self.signature = signature
+        self._num_shards = 0
+
+    def shard(self, name=None) -> ResultShard:
+        if name is None:
+            name = str(self._num_shards)
+            self._num_shards += 1
+        if get_world_size() > 1:
+            name += f".rank{get_rank()}"
+        path = os.path.join(self.directory, f"{name}.jsonl")
+        return ResultShard(path, self.signature)
+
+
+def clear_checkpoints(checkpoint_dir, metric_names=None):
+    """Remove the checkpoints of the given metrics (all metrics by default)."""
+    if not os.path.isdir(checkpoint_dir):
+        return
+    for metric_name in os.listdir(checkpoint_dir):
+        if metric_names is None or metric_name in metric_names:
+            shutil.rmtree(os.path.join(checkpoint_dir, metric_name), ignore_errors=True)
@@ -0,0 +1,351 @@
+"""
+Continuous (in-flight) batching generation for evaluation metrics.
+"""
+
+import time
+import logging
+from collections import deque
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from omegaconf import OmegaConf
+from transformers import DynamicCache
+
+from evals.distributed import gather_objects, get_rank, get_world_size
+from evals.metrics.utils import (
+    cut_at_stopwords,
+    cut_ids_at_stopwords,
+    decode_inputs_and_ground_truths,
+    dict_transpose,
+    get_stop_sequence_matcher,
+    ground_truth_token_ids,
+    score_generations,
+)
+
+logger = logging.getLogger("metrics")
+
+# with a checkpoint, results are stored every this many batches of generation requests
+CHECKPOINT_CHUNK_BATCHES = 8
+
+
+class ContinuousBatchingGenerator:
+    """Greedy generation engine that keeps up to `max_batch_size` sequences decoding and
+    refills the slot of every finished sequence with the next waiting prompt.
+
+    Running sequences share one left-padded KV cache (HF DynamicCache). Newly admitted
+    prompts are prefilled together, left-aligned with the running cache and appended to
+    the batch; finished sequences are dropped from it, and cache columns that became pure
+    padding are trimmed. As with HF `generate` on a left-padded batch, each sequence
+    attends only to its own tokens with its own position ids, so greedy outputs match.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int,
+        max_new_tokens: int,
+        stopwords: Optional[List[str]] = None,
+        shared_prefix=None,
+    ):
+        self.model = model
+        self.shared_prefix = shared_prefix
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.stopwords = stopwords or []
+        eos_token_id = model.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        if not isinstance(eos_token_id, list):
+            eos_token_id = [eos_token_id]
+        self.eos_token_ids = set(eos_token_id)
+        self.stop_matchers = [
+            get_stop_sequence_matcher(tokenizer, word) for word in self.stopwords
+        ]
+        self.num_generated_tokens = 0
+        self.generation_time = 0.0
+
+    def _stop_flags(self, sequences: List[List[int]]) -> List[bool]:
+        """Whether each generated sequence ends with one of the stopwords."""
+        if not self.stop_matchers:
+            return [False] * len(sequences)
+        lookback = max(matcher.lookback for matcher in self.stop_matchers)
+        windows = torch.full((len(sequences), lookback), -1, dtype=torch.long)
+        for row, sequence in enumerate(sequences):
+            tail = sequence[-lookback:]
+            windows[row, lookback - len(tail) :] = torch.tensor(tail)
+        stopped = torch.zeros(len(sequences), dtype=torch.bool)
+        for matcher in self.stop_matchers:
+            stopped |= matcher(windows[:, -matcher.lookback :])
+        return stopped.tolist()
+
+    def _forward(self, input_ids, attention_mask, position_ids, cache):
+        output = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+        )
+        next_tokens = output.logits[:, -1].argmax(dim=-1)
+        return next_tokens, output.past_key_values.to_legacy_cache()
+
+    def _prefill(self, prompts: List[List[int]]):
+        """Encode new prompts as a left-padded batch and pick their first tokens. Prompts
+        continue the shared prefix, if any, whose cache becomes part of each row's."""
+        max_len = max(len(prompt) for prompt in prompts)
+        device = self.model.device
+        input_ids = torch.zeros(len(prompts), max_len, dtype=torch.long, device=device)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, prompt in enumerate(prompts):
+            input_ids[row, max_len - len(prompt) :] = torch.tensor(prompt)
+            attention_mask[row, max_len - len(prompt) :] = 1
+        cache = DynamicCache()
+        if self.shared_prefix is not None:
+            prefix_inputs = self.shared_prefix.model_inputs(self.model, attention_mask)
+            cache = prefix_inputs["past_key_values"]
+            attention_mask = prefix_inputs["attention_mask"]
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, -max_len:]
+        next_tokens, kv = self._forward(input_ids, attention_mask, position_ids, cache)
+        return next_tokens, kv, attention_mask
+
+    @staticmethod
+    def _left_pad(tensor, length, dim):
+        pad = length - tensor.shape[dim]
+        if pad == 0:
+            return tensor
+        # F.pad lists (left, right) amounts starting from the last dimension
+        pad_spec = [0, 0] * (tensor.dim() - 1 - dim % tensor.dim()) + [pad, 0]
+        return F.pad(tensor, pad_spec)
+
+    def _merge(self, kv, attention_mask, new_kv, new_attention_mask):
+        """Append new sequences to the running batch, aligning both caches on the right."""
+        if kv is None:
+            return new_kv, new_attention_mask
+        length = max(attention_mask.shape[1], new_attention_mask.shape[1])
+        merged_kv = tuple(
+            tuple(
+                torch.cat(
+                    [self._left_pad(t, length, -2), self._left_pad(new_t, length, -2)]
+                )
+                for t, new_t in zip(layer, new_layer)
+            )
+            for layer, new_layer in zip(kv, new_kv)
+        )
+        merged_mask = torch.cat(
+            [
+                self._left_pad(attention_mask, length, 1),
+                self._left_pad(new_attention_mask, length, 1),
+            ]
+        )
+        return merged_kv, merged_mask
+
+    @staticmethod
+    def _select(kv, attention_mask, rows):
+        """Keep `rows` of the running batch and trim leading all-padding columns."""
+        attention_mask = attention_mask[rows]
+        start = int(attention_mask.any(0).int().argmax())
+        kv = tuple(tuple(t[rows, :, start:] for t in layer) for layer in kv)
+        return kv, attention_mask[:, start:]
+
+    def generate(self, prompts: Dict[int, List[int]]) -> Dict[int, List[int]]:
+        """Greedily generate continuations of prompts (token id lists keyed by request id)."""
+        waiting = deque(prompts.items())
+        outputs = {}
+        request_ids, generated = [], []  # per running row
+        kv, attention_mask, next_tokens = None, None, None
+        start_time = time.perf_counter()
+        progress = tqdm(total=len(prompts), desc="Generating (continuous batching)")
+        with torch.no_grad():
+            while waiting or request_ids:
+                # rows that received a new token in this step
+                first_new_row = 0
+                free_slots = self.max_batch_size - len(request_ids)
+                if waiting and free_slots > 0:
+                    admitted = [
+                        waiting.popleft() for _ in range(min(free_slots, len(waiting)))
+                    ]
+                    prefill_tokens, new_kv, new_mask = self._prefill(
+                        [prompt for _, prompt in admitted]
+                    )
+                    kv, attention_mask = self._merge(
+                        kv, attention_mask, new_kv, new_mask
+                    )
+                    next_tokens = (
+                        prefill_tokens
+                        if next_tokens is None
+                        else torch.cat([next_tokens, prefill_tokens])
+                    )
+                    first_new_row = len(request_ids)
+                    request_ids += [request_id for request_id, _ in admitted]
+                    generated += [[] for _ in admitted]
+                else:
+                    # decode one token for every running sequence
+                    position_ids = attention_mask.sum(-1, keepdim=True)
+                    attention_mask = F.pad(attention_mask, (0, 1), value=1)
+                    next_tokens, kv = self._forward(
+                        next_tokens.unsqueeze(-1),
+                        attention_mask,
+                        position_ids,
+                        DynamicCache.from_legacy_cache(kv),
+                    )
+
+                # record the new token of each row, then release finished rows
+                keep = list(range(first_new_row))
+                new_tokens = next_tokens[first_new_row:].tolist()
+                for row, token in enumerate(new_tokens, start=first_new_row):
+                    generated[row].append(token)
+                self.num_generated_tokens += len(new_tokens)
+                stopped = self._stop_flags(generated[first_new_row:])
+                for row, token in enumerate(new_tokens, start=first_new_row):
+                    if (
+                        token in self.eos_token_ids
+                        or len(generated[row]) >= self.max_new_tokens
+                        or stopped[row - first_new_row]
+                    ):
+                        outputs[request_ids[row]] = generated[row]
+                        progress.update(1)
+                    else:
+                        keep.append(row)
+                if len(keep) < len(request_ids):
+                    rows = torch.tensor(
+                        keep, dtype=torch.long, device=next_tokens.device
+                    )
+                    request_ids = [request_ids[row] for row in keep]
+                    generated = [generated[row] for row in keep]
+                    next_tokens = next_tokens[rows]
+                    if keep:
+                        kv, attention_mask = self._select(kv, attention_mask, rows)
+                    else:
+                        kv, attention_mask, next_tokens = None, None, None
+        progress.close()
+        self.generation_time += time.perf_counter() - start_time
+        return outputs
+
+    def throughput(self) -> float:
+        """Generated tokens per second over all `generate` calls."""
+        return self.num_generated_tokens / max(self.generation_time, 1e-9)
+
+
+def eval_text_similarity_continuous(
+    model,
+    tokenizer,
+    data,
+    generation_args,
+    batch_size,
+    rouge_mode="text",
+    rouge_num_workers=0,
+    shared_prefix=None,
+    checkpoint=None,
+):
+    """Evaluate ROUGE of generations like `eval_text_similarity`, but generate for the
+    whole dataset (this process's share under data-parallel evaluation) with a
+    ContinuousBatchingGenerator of `batch_size` slots. With a
+    `MetricCheckpoint`, samples are generated and scored in chunks whose results are
+    stored, and samples with stored results are skipped.
+
+    Returns per-index evaluations laid out like `run_batchwise_evals`."""
+    generation_args = OmegaConf.to_container(generation_args, resolve=True)
+    if (
+        generation_args.get("do_sample", False)
+        or generation_args.get("num_beams", 1) > 1
+    ):
+        raise ValueError("Continuous batching generation supports greedy decoding only")
+    stopwords = generation_args.get("stopwords", None)
+    generator = ContinuousBatchingGenerator(
+        model,
+        tokenizer,
+        max_batch_size=batch_size,
+        max_new_tokens=generation_args["max_new_tokens"],
+        stopwords=stopwords,
+        shared_prefix=shared_prefix,
+    )
+    prefix_length = 0 if shared_prefix is None else shared_prefix.length
+
+    def generate_and_score(samples):
+        outputs = generator.generate(
+            {
+                request_id: s[2]["input_ids"][prefix_length:].tolist()
+                for request_id, s in enumerate(samples)
+            }
+        )
+        input_texts, ground_truths = decode_inputs_and_ground_truths(
+            tokenizer,
+            [s[2]["input_ids"] for s in samples],
+            [s[2]["labels"] for s in samples],
+        )
+        gen_ids = [outputs[request_id] for request_id in range(len(samples))]
+        gen_texts = tokenizer.batch_decode(
+            gen_ids,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=True,
+        )
+        gen_texts = cut_at_stopwords(tokenizer, gen_texts, stopwords)
+        ground_truth_ids = None
+        if rouge_mode == "token_ids":
+            ground_truth_ids = ground_truth_token_ids(
+                tokenizer,
+                [s[2]["input_ids"] for s in samples],
+                [s[2]["labels"] for s in samples],
+            )
+            gen_ids = cut_ids_at_stopwords(tokenizer, gen_ids, stopwords)
+        else:
+            gen_ids = None
+        return score_generations(
+            gen_texts,
+            input_texts,
+            ground_truths,
+            gen_ids=gen_ids,
+            ground_truth_ids=ground_truth_ids,
+            num_workers=rouge_num_workers,
+        )
+
+    # flatten items (and the answers of multi-answer items) into generation requests
+    samples = []
+    for i in range(len(data)):
+        item = data[i]
+        answers = {"0": item} if "input_ids" in item else item
+        for intra_item_idx, sample in answers.items():
+            samples.append((intra_item_idx, int(sample["index"]), sample))
+
+    # data-parallel evaluation: each process generates for its share of the samples
+    all_samples, samples = samples, samples[get_rank() :: get_world_size()]
+    if checkpoint is None:
+        scores = generate_and_score(samples)
+    else:
+        shard = checkpoint.shard()
+        pending = [s for s in samples if not shard.done([s[:2]])]
+        chunk_size = batch_size * CHECKPOINT_CHUNK_BATCHES
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start : start + chunk_size]
+            shard.append(
+                (intra_item_idx, idx, score)
+                for (intra_item_idx, idx, _), score in zip(
+                    chunk, generate_and_score(chunk)
+                )
+            )
+        scores = [shard.results[s[:2]] for s in samples]
+    logger.info(
+        f"Generated {generator.num_generated_tokens} tokens at "
+        f"{generator.throughput():.1f} tokens/s"
+    )
+
+    rows = [(intra_item_idx, idx) for intra_item_idx, idx, _ in samples]
+    scores_by_key = {
+        key: score
+        for part in gather_objects(list(zip(rows, scores)))
+        for key, score in part
+    }
+    evals = {}
+    for intra_item_idx, idx, _ in all_samples:
+        evals.setdefault(intra_item_idx, {})[idx] = scores_by_key[(intra_item_idx, idx)]
+    evals = {
+        intra_item_idx: dict(sorted(iidx_evals.items()))
+        for intra_item_idx, iidx_evals in evals.items()
+    }
+    if len(evals) == 1:  # normal single answer dataset, no need for list
+        return next(iter(evals.values()))
+    return dict_transpose(evals)
@@ -1,22 +1,59 @@
 import logging
 import torch
 import numpy as np
-from torch.utils.data import DataLoader
+from torch.nn.utils.rnn import pad_sequence
+from omegaconf import DictConfig, OmegaConf
 
 from evals.metrics.utils import (
     aggregate_to_1D,
-    evaluate_probability,
+    batchwise_probe,
     eval_text_similarity,
+    PostprocessWorker,
+    get_eval_dataloader,
     run_batchwise_evals,
-    tokenwise_vocab_logprobs,
 )
+from evals.metrics.token_stats import get_token_stats, map_token_stats
+from evals.metrics.generation import eval_text_similarity_continuous
+from evals.metrics.prefix_cache import get_shared_prefix
+from evals.metrics.model_pool import get_draft_model
+from evals.metrics.speculative import SpeculativeDecoding
 from evals.metrics.base import unlearning_metric
+from evals.metrics.bootstrap import mean_results
 
 # Supress the info messages logged while calculating rouge using rouge_scorer
 logging.getLogger("absl").setLevel(logging.WARNING)
 logger = logging.getLogger("evaluator")
 
 
+def _shared_prefix(data, kwargs):
+    """Prefix shared by all samples of `data`, if the metric config enables caching it."""
+    if not kwargs.get("shared_prefix_cache", False):
+        return None
+    return get_shared_prefix(data)
+
+
+def _speculative_decoding(model, kwargs):
+    """Speculative decoding with the draft model of the metric config, if any."""
+    cfg = kwargs.get("speculative_decoding", None) or {}
+    draft_model_args = cfg.get("draft_model_args", None)
+    if draft_model_args is None:
+        return None
+    if isinstance(draft_model_args, DictConfig):
+        draft_model_args = OmegaConf.to_container(draft_model_args, resolve=True)
+    draft_model = get_draft_model(draft_model_args, model.device)
+    if draft_model.config.vocab_size != model.config.vocab_size:
+        raise ValueError(
+            "The draft model of speculative decoding must share the tokenizer of the "
+            f"evaluated model, got vocabularies of {draft_model.config.vocab_size} "
+            f"and {model.config.vocab_size} tokens"
+        )
+    return SpeculativeDecoding(
+        draft_model,
+        num_assistant_tokens=cfg.get("num_assistant_tokens", 5),
+        verify_batches=cfg.get("verify_batches", 1),
+    )
+
+
 @unlearning_metric(name="probability")
 def probability(model, **kwargs):
     """Compute the probabilities by data points and report aggregated average"""
@@ -24,12 +61,22 @@ def probability(model, **kwargs):
     collator = kwargs["collators"]
     batch_size = kwargs["batch_size"]
 
-    dataloader = DataLoader(data, batch_size=batch_size, collate_fn=collator)
+    def _probability(stats):
+        avg_loss = -stats["target_log_probs"].mean().item()
+        return {"prob": float(np.exp(-avg_loss)), "avg_loss": avg_loss}
 
-    fun_args = {}
-    scores_by_index = run_batchwise_evals(
-        model, dataloader, evaluate_probability, fun_args, "Calculating loss"
+    token_stats = get_token_stats(
+        model,
+        data,
+        collator,
+        batch_size,
+        stats_cache=kwargs.get("stats_cache", None),
+        vocab_chunk_size=kwargs.get("vocab_chunk_size", None),
+        batching=kwargs.get("batching", None),
+        shared_prefix=_shared_prefix(data, kwargs),
+        checkpoint=kwargs.get("checkpoint", None),
     )
+    scores_by_index = map_token_stats(token_stats, _probability)
     prob_values = np.array(
         [
             evals["prob"]
@@ -38,10 +85,10 @@ def probability(model, **kwargs):
         ]
     )
     prob_values = aggregate_to_1D(prob_values)
-    return {"agg_value": np.mean(prob_values), "value_by_index": scores_by_index}
+    return mean_results(prob_values, scores_by_index, kwargs)
 
 
-@unlearning_metric(name="probability_w_options")
+@unlearning_metric(name="probability_w_options", cpu_only=True)
 def probability_w_options(model, **kwargs):
     """Normalize probabilities of correct answers against false answers for
     open-ended datasets, returning the aggregated value and per-index probabilities."""
@@ -69,7 +116,7 @@ def probability_w_options(model, **kwargs):
     probs = correct / (correct + wrong + 1e-10)
 
     value_by_index = dict(zip(correct_indices, [{"prob": val} for val in probs]))
-    return {"agg_value": np.mean(probs), "value_by_index": value_by_index}
+    return mean_results(probs, value_by_index, kwargs)
 
 
 @unlearning_metric(name="rouge")
@@ -80,16 +127,79 @@ def rouge(model, **kwargs):
     collator = kwargs["collators"]
     batch_size = kwargs["batch_size"]
     generation_args = kwargs["generation_args"]
-    dataloader = DataLoader(data, batch_size=batch_size, collate_fn=collator)
-
-    fun_args = {"tokenizer": tokenizer, "generation_args": generation_args}
-    scores_by_index = run_batchwise_evals(
-        model,
-        dataloader,
-        eval_text_similarity,
-        fun_args,
-        "Calculating text similarity",
-    )
+    generation_backend = kwargs.get("generation_backend", "static")
+    rouge_args = {
+        "rouge_mode": kwargs.get("rouge_mode", "text"),
+        "rouge_num_workers": kwargs.get("rouge_num_workers", 0),
+    }
+    if rouge_args["rouge_mode"] not in ["text", "token_ids"]:
+        raise ValueError(f"Unknown rouge_mode {rouge_args['rouge_mode']}")
+    shared_prefix = _shared_prefix(data, kwargs)
+    speculative = _speculative_decoding(model, kwargs)
+    if generation_backend == "continuous":
+        if batch_size == "auto":
+            raise ValueError("batch_size: auto needs generation_backend: static")
+        if speculative is not None:
+            raise ValueError("speculative_decoding needs generation_backend: static")
+        scores_by_index = eval_text_similarity_continuous(
+            model,
+            tokenizer,
+            data,
+            generation_args,
+            batch_size,
+            shared_prefix=shared_prefix,
+            checkpoint=kwargs.get("checkpoint", None),
+            **rouge_args,
+        )
+    elif generation_backend == "static":
+        if shared_prefix is not None:
+            collator = shared_prefix.collator(collator)
+        max_new_tokens = generation_args.get("max_new_tokens", None)
+        # batch sizes are probed generating all tokens, without stopping early
+        probe_generation_args = OmegaConf.to_container(generation_args, resolve=True)
+        probe_generation_args.pop("stopwords", None)
+        if max_new_tokens is not None:
+            probe_generation_args["min_new_tokens"] = max_new_tokens
+        fun_args = {
+            "tokenizer": tokenizer,
+            "generation_args": OmegaConf.create(probe_generation_args),
+            "shared_prefix": shared_prefix,
+            **rouge_args,
+        }
+        dataloader = get_eval_dataloader(
+            data,
+            collator,
+            batch_size,
+            batching=kwargs.get("batching", None),
+            model=model,
+            kind=["generation", max_new_tokens],
+            probe_fn=batchwise_probe(model, eval_text_similarity, fun_args),
+        )
+        # decode and score finished batches in a worker while the next ones generate
+        queue_depth = kwargs.get("postprocess_queue_depth", 2)
+        postprocess = PostprocessWorker(tokenizer) if queue_depth > 0 else None
+        fun_args.update(
+            {
+                "generation_args": generation_args,
+                "postprocess": postprocess,
+                "speculative": speculative,
+            }
+        )
+        try:
+            scores_by_index = run_batchwise_evals(
+                model,
+                dataloader,
+                eval_text_similarity,
+                fun_args,
+                "Calculating text similarity",
+                checkpoint=kwargs.get("checkpoint", None),
+                max_pending=queue_depth,
+            )
+        finally:
+            if postprocess is not None:
+                postprocess.shutdown()
+    else:
+        raise ValueError(f"Unknown generation_backend {generation_backend}")
     rouge_values = np.array(
         [
             evals[kwargs["rouge_type"]]
@@ -98,13 +208,14 @@ def rouge(model, **kwargs):
         ]
     )
     rouge_values = aggregate_to_1D(rouge_values)
-    return {
-        "agg_value": np.mean(rouge_values),
-        "value_by_index": scores_by_index,
-    }
+    results = mean_results(rouge_values, scores_by_index, kwargs)
+    if speculative is not None:
+        results["speculative_decoding"] = speculative.results()
+        logger.info(f"Speculative decoding: {results['speculative_decoding']}")
+    return results
 
 
-@unlearning_metric(name="truth_ratio")
+@unlearning_metric(name="truth_ratio", cpu_only=True)
 def truth_ratio(model, **kwargs):
     """Compute the truth ratio, aggregating false/true scores, and
     return the aggregated value."""
@@ -112,12 +223,12 @@ def truth_ratio(model, **kwargs):
     # Forget data: It is better if false and true are equally likely,
     # i.e., tr=false/true is closest to 1.
     def closer_to_1_better(arr):
-        return np.mean(np.minimum(arr, 1 / (arr + 1e-10)))
+        return np.minimum(arr, 1 / (arr + 1e-10))
 
     # Non-forget data: It is better if tr=false/true is lower, i.e.,
     # 1-tr is higher.
     def true_better(arr):
-        return np.mean(np.maximum(0, 1 - arr))
+        return np.maximum(0, 1 - arr)
 
     if kwargs["aggregator"] == "closer_to_1_better":
         aggregator = closer_to_1_better
@@ -158,43 +269,75 @@ def truth_ratio(model, **kwargs):
         zip(correct_indices, [{"score": val} for val in truth_ratios])
     )
     truth_ratio_stats = np.array([evals["score"] for evals in value_by_index.values()])
-    forget_tr_avg = aggregator(truth_ratio_stats)
-    return {"agg_value": forget_tr_avg, "value_by_index": value_by_index}
+    # the mean of per-item aggregator values
+    return mean_results(aggregator(truth_ratio_stats), value_by_index, kwargs)
+
+
+def memorization_scores(samples):
+    """Exact memorization (EM) and extraction strength (ES) of each sample, from the
+    argmax matches of its labeled tokens (ignoring the eos prediction), computed over
+    the padded matches of all samples at once.
+
+    ES is 1 - k/n for the smallest k from which all predictions match, i.e. n minus
+    the longest matching suffix, found by a cumulative product over reversed matches;
+    k = n - 1 when the last prediction does not match.
+
+    Returns:
+        (List, List): EM (None without labeled tokens) and ES (0 without labeled
+        tokens) of each sample.
+    """
+    if not samples:
+        return [], []
+    matches = [stats["argmax_match"][:-1] for stats in samples]  # ignore eos prediction
+    lengths = torch.tensor([len(sample_matches) for sample_matches in matches])
+    # padding matches, so that suffixes run through it up to the labeled tokens
+    padded = pad_sequence(matches, batch_first=True, padding_value=True).long()
+    num_padding = padded.shape[1] - lengths
+    num_matches = padded.sum(-1) - num_padding
+    suffix = padded.flip(-1).cumprod(-1).sum(-1) - num_padding
+    k = torch.where(suffix > 0, lengths - suffix, lengths - 1)
+    em = (num_matches.float() / lengths.float()).tolist()
+    es = (1 - k.double() / lengths.double()).tolist()
+    empty = (lengths == 0).tolist()
+    if any(empty):
+        # Rarely, tokenization can result in a mismatch with no valid target
+        # tokens for loss computation (see preprocess_chat_instance() for
+        # reference). Since this condition makes no sense in terms of
+        # computing EM and ES, we just choose to set EM=None and ES=0
+        logger.warning(
+            f"EM and ES scores of {sum(empty)} instances are marked None and 0, due "
+            "to tokenization issues that resulted in no valid target tokens."
+        )
+    em = [None if is_empty else score for score, is_empty in zip(em, empty)]
+    es = [0 if is_empty else score for score, is_empty in zip(es, empty)]
+    return em, es
 
 
-@unlearning_metric(name="exact_memorization")
-def exact_memorization(model, **kwargs):
+def _memorization_token_stats(model, kwargs):
+    """Token statistics for EM and ES: the shared ones, or with `argmax_only` in the
+    metric config, argmax matches alone from a lighter pass when none are cached."""
     data = kwargs["data"]
-    collator = kwargs["collators"]
-    batch_size = kwargs["batch_size"]
-    dataloader = DataLoader(data, batch_size=batch_size, collate_fn=collator)
+    return get_token_stats(
+        model,
+        data,
+        kwargs["collators"],
+        kwargs["batch_size"],
+        stats_cache=kwargs.get("stats_cache", None),
+        vocab_chunk_size=kwargs.get("vocab_chunk_size", None),
+        batching=kwargs.get("batching", None),
+        shared_prefix=_shared_prefix(data, kwargs),
+        checkpoint=kwargs.get("checkpoint", None),
+        argmax_only=kwargs.get("argmax_only", False),
+    )
 
-    def _exact_memorization(model, batch):
-        log_probs_batch, labels_batch = tokenwise_vocab_logprobs(
-            model, batch, grad=False, return_labels=True
-        )
-        em_batch = []
-        for log_probs, labels in zip(log_probs_batch, labels_batch):
-            valid_len = len(labels)
-            if valid_len == 0:
-                # Rarely, tokenization can result in a mismatch with no valid target
-                # tokens for loss computation (see preprocess_chat_instance() for
-                # reference). Since this condition makes no sense in terms of
-                # computing EM, we just choose to set EM=None
-                logger.warning(
-                    "EM score for an instance is marked None, due to "
-                    "tokenization issues that resulted in no valid target tokens."
-                )
-                em_batch.append({"score": None})
-            else:
-                preds = torch.argmax(log_probs, dim=-1)
-                em_score = (preds == labels).sum() / valid_len
-                em_batch.append({"score": em_score.item()})
-        return em_batch
-
-    fun_args = {}
-    scores_by_index = run_batchwise_evals(
-        model, dataloader, _exact_memorization, fun_args, "Calculating EM"
+
+@unlearning_metric(name="exact_memorization")
+def exact_memorization(model, **kwargs):
+    token_stats = _memorization_token_stats(model, kwargs)
+    scores_by_index = map_token_stats(
+        token_stats,
+        lambda samples: [{"score": em} for em in memorization_scores(samples)[0]],
+        batched=True,
     )
     em_values = np.array(
         [
@@ -204,47 +347,16 @@ def exact_memorization(model, **kwargs):
         ]
     )
     em_values = aggregate_to_1D(em_values)
-    return {"agg_value": np.mean(em_values), "value_by_index": scores_by_index}
+    return mean_results(em_values, scores_by_index, kwargs)
 
 
 @unlearning_metric(name="extraction_strength")
 def extraction_strength(model, **kwargs):
-    data = kwargs["data"]
-    collator = kwargs["collators"]
-    batch_size = kwargs["batch_size"]
-    dataloader = DataLoader(data, batch_size=batch_size, collate_fn=collator)
-
-    def _extraction_strength(model, batch):
-        log_probs_batch, labels_batch = tokenwise_vocab_logprobs(
-            model, batch, grad=False, return_labels=True
-        )
-        es_batch = []
-        for log_probs, labels in zip(log_probs_batch, labels_batch):
-            valid_len = len(labels)
-            preds = torch.argmax(log_probs, dim=-1)
-            for k in range(valid_len):
-                suff_preds = preds[k:]
-                suff_labels = labels[k:]
-                if torch.equal(suff_preds, suff_labels):
-                    break
-            if valid_len == 0:
-                # Rarely, tokenization can result in a mismatch with no valid target
-                # tokens for loss computation (see preprocess_chat_instance() for
-                # reference). Since this condition makes no sense in terms of
-                # computing ES, we just choose to set ES=None
-                logger.warning(
-                    "ES score for an instance is marked None, due to "
-                    "tokenization issues that resulted in no valid target tokens."
-                )
-                es_batch.append({"score": 0})
-            else:
-                es_score = 1 - (k / valid_len)
-                es_batch.append({"score": es_score})
-        return es_batch
-
-    fun_args = {}
-    scores_by_index = run_batchwise_evals(
-        model, dataloader, _extraction_strength, fun_args, "Calculating ES"
+    token_stats = _memorization_token_stats(model, kwargs)
+    scores_by_index = map_token_stats(
+        token_stats,
+        lambda samples: [{"score": es} for es in memorization_scores(samples)[1]],
+        batched=True,
     )
     es_values = np.array(
         [
@@ -254,4 +366,4 @@ def extraction_strength(model, **kwargs):
         ]
     )
     es_values = aggregate_to_1D(es_values)
-    return {"agg_value": np.mean(es_values), "value_by_index": scores_by_index}
+    return mean_results(es_values, scores_by_index, kwargs)
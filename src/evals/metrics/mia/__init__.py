@@ -2,17 +2,19 @@
 Attack implementations.
 """
 
-from transformers import AutoModelForCausalLM
+from omegaconf import DictConfig, OmegaConf
 
 from evals.metrics.base import unlearning_metric
+from evals.metrics.bootstrap import bootstrap_settings
 from evals.metrics.mia.loss import LOSSAttack
 from evals.metrics.mia.min_k import MinKProbAttack
 from evals.metrics.mia.min_k_plus_plus import MinKPlusPlusAttack
 from evals.metrics.mia.gradnorm import GradNormAttack
 from evals.metrics.mia.zlib import ZLIBAttack
 from evals.metrics.mia.reference import ReferenceAttack
+from evals.metrics.mia.reference_stats import get_reference_losses
 
-from evals.metrics.mia.utils import mia_auc
+from evals.metrics.mia.utils import mia_auc, mia_sweep_auc
 import logging
 
 logger = logging.getLogger("metrics")
@@ -29,6 +31,11 @@ def mia_loss(model, **kwargs):
         data=kwargs["data"],
         collator=kwargs["collators"],
         batch_size=kwargs["batch_size"],
+        batching=kwargs.get("batching", None),
+        checkpoint=kwargs.get("checkpoint", None),
+        vocab_chunk_size=kwargs.get("vocab_chunk_size", None),
+        stats_cache=kwargs.get("stats_cache", None),
+        bootstrap=bootstrap_settings(kwargs),
     )
 
 
@@ -40,7 +47,12 @@ def mia_min_k(model, **kwargs):
         data=kwargs["data"],
         collator=kwargs["collators"],
         batch_size=kwargs["batch_size"],
+        batching=kwargs.get("batching", None),
+        checkpoint=kwargs.get("checkpoint", None),
+        vocab_chunk_size=kwargs.get("vocab_chunk_size", None),
         k=kwargs["k"],
+        stats_cache=kwargs.get("stats_cache", None),
+        bootstrap=bootstrap_settings(kwargs),
     )
 
 
@@ -52,7 +64,12 @@ def mia_min_k_plus_plus(model, **kwargs):
         data=kwargs["data"],
         collator=kwargs["collators"],
         batch_size=kwargs["batch_size"],
+        batching=kwargs.get("batching", None),
+        checkpoint=kwargs.get("checkpoint", None),
+        vocab_chunk_size=kwargs.get("vocab_chunk_size", None),
         k=kwargs["k"],
+        stats_cache=kwargs.get("stats_cache", None),
+        bootstrap=bootstrap_settings(kwargs),
     )
 
 
@@ -64,7 +81,13 @@ def mia_gradnorm(model, **kwargs):
         data=kwargs["data"],
         collator=kwargs["collators"],
         batch_size=kwargs["batch_size"],
+        batching=kwargs.get("batching", None),
+        checkpoint=kwargs.get("checkpoint", None),
+        vocab_chunk_size=kwargs.get("vocab_chunk_size", None),
         p=kwargs["p"],
+        param_patterns=kwargs.get("param_patterns", None),
+        batched=kwargs.get("batched_grad_norms", True),
+        bootstrap=bootstrap_settings(kwargs),
     )
 
 
@@ -76,7 +99,12 @@ def mia_zlib(model, **kwargs):
         data=kwargs["data"],
         collator=kwargs["collators"],
         batch_size=kwargs["batch_size"],
+        batching=kwargs.get("batching", None),
+        checkpoint=kwargs.get("checkpoint", None),
+        vocab_chunk_size=kwargs.get("vocab_chunk_size", None),
         tokenizer=kwargs.get("tokenizer"),
+        stats_cache=kwargs.get("stats_cache", None),
+        bootstrap=bootstrap_settings(kwargs),
     )
 
 
@@ -84,11 +112,19 @@ def mia_zlib(model, **kwargs):
 def mia_reference(model, **kwargs):
     if "reference_model_path" not in kwargs:
         raise ValueError("Reference model must be provided in kwargs")
-    logger.info(f"Loading reference model from {kwargs['reference_model_path']}")
-    reference_model = AutoModelForCausalLM.from_pretrained(
+    # reference losses depend on the reference model and data only: stored and reused
+    # across target models, the reference model is loaded only when they are missing
+    reference_losses = get_reference_losses(
         kwargs["reference_model_path"],
+        data=kwargs["data"],
+        collator=kwargs["collators"],
+        batch_size=kwargs["batch_size"],
         torch_dtype=model.dtype,
-        device_map={"": model.device},
+        device=model.device,
+        stats_dir=kwargs.get("reference_stats_dir", None),
+        revision=kwargs.get("reference_model_revision", None),
+        vocab_chunk_size=kwargs.get("vocab_chunk_size", None),
+        batching=kwargs.get("batching", None),
     )
     return mia_auc(
         ReferenceAttack,
@@ -96,5 +132,35 @@ def mia_reference(model, **kwargs):
         data=kwargs["data"],
         collator=kwargs["collators"],
         batch_size=kwargs["batch_size"],
-        reference_model=reference_model,
+        batching=kwargs.get("batching", None),
+        checkpoint=kwargs.get("checkpoint", None),
+        vocab_chunk_size=kwargs.get("vocab_chunk_size", None),
+        stats_cache=kwargs.get("stats_cache", None),
+        bootstrap=bootstrap_settings(kwargs),
+        split_kwargs={
+            split: {"reference_losses": losses}
+            for split, losses in reference_losses.items()
+        },
+    )
+
+
+@unlearning_metric(name="mia_sweep")
+def mia_sweep(model, **kwargs):
+    attacks = kwargs["attacks"]
+    if isinstance(attacks, DictConfig):
+        attacks = OmegaConf.to_container(attacks, resolve=True)
+    return mia_sweep_auc(
+        model,
+        data=kwargs["data"],
+        collator=kwargs["collators"],
+        batch_size=kwargs["batch_size"],
+        attacks=attacks,
+        roc_points=kwargs.get("roc_points", 101),
+        primary_attack=kwargs.get("primary_attack", "loss"),
+        batching=kwargs.get("batching", None),
+        checkpoint=kwargs.get("checkpoint", None),
+        vocab_chunk_size=kwargs.get("vocab_chunk_size", None),
+        tokenizer=kwargs.get("tokenizer"),
+        stats_cache=kwargs.get("stats_cache", None),
+        bootstrap=bootstrap_settings(kwargs),
     )
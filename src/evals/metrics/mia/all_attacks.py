@@ -3,10 +3,17 @@ Enum class for attacks. Also contains the base attack class.
 """
 
 from enum import Enum
-from torch.utils.data import DataLoader
+import logging
 import numpy as np
 from tqdm import tqdm
 
+from evals.distributed import gather_objects, get_world_size, is_main_process
+from evals.metrics.token_stats import get_token_stats
+from evals.metrics.batch_size import evaluate_with_backoff
+from evals.metrics.utils import count_padding, get_eval_dataloader
+
+logger = logging.getLogger("metrics")
+
 
 # Attack definitions
 class AllAttacks(str, Enum):
@@ -21,10 +28,34 @@ class AllAttacks(str, Enum):
 
 # Base attack class
 class Attack:
-    def __init__(self, model, data, collator, batch_size, **kwargs):
-        """Initialize attack with model and create dataloader."""
+    # attacks that implement `values_from_token_stats` can be served by a shared
+    # TokenStatsCache instead of running their own pass over the data
+    uses_token_stats = False
+
+    def __init__(
+        self,
+        model,
+        data,
+        collator,
+        batch_size,
+        vocab_chunk_size=None,
+        stats_cache=None,
+        batching=None,
+        checkpoint=None,
+        **kwargs,
+    ):
+        """Initialize attack with model and data.
+        `vocab_chunk_size` enables selective, vocab-chunked scoring of labeled tokens.
+        With a `MetricCheckpoint`, scores are stored as batches finish and batches whose
+        scores are already stored are skipped."""
         self.model = model
-        self.dataloader = DataLoader(data, batch_size=batch_size, collate_fn=collator)
+        self.data = data
+        self.collator = collator
+        self.batch_size = batch_size
+        self.vocab_chunk_size = vocab_chunk_size
+        self.stats_cache = stats_cache
+        self.batching = batching
+        self.checkpoint = checkpoint
         self.setup(**kwargs)
 
     def setup(self, **kwargs):
@@ -35,26 +66,116 @@ class Attack:
         """Process a batch through model to get needed statistics."""
         raise NotImplementedError
 
+    def values_from_token_stats(self, token_stats):
+        """Derive a sample's statistics (as returned by `compute_batch_values`) from
+        its cached token statistics."""
+        raise NotImplementedError
+
     def compute_score(self, sample_stats):
         """Compute MIA score for a single sample."""
         raise NotImplementedError
 
-    def attack(self):
-        """Run full MIA attack."""
+    def compute_batch_scores(self, batch_values):
+        """Compute MIA scores for all samples of a batch. Attacks whose scoring can be
+        vectorized across samples override this."""
+        return [self.compute_score(values) for values in batch_values]
+
+    def attack_from_token_stats(self):
+        """Score all samples from token statistics shared through the stats cache."""
+        token_stats = get_token_stats(
+            self.model,
+            self.data,
+            self.collator,
+            self.batch_size,
+            stats_cache=self.stats_cache,
+            vocab_chunk_size=self.vocab_chunk_size,
+            batching=self.batching,
+            checkpoint=self.checkpoint,
+        )
+        return self.scores_from_token_stats(token_stats)
+
+    def scores_from_token_stats(self, token_stats):
+        """Score all samples from their token statistics (by data index)."""
+        all_indices = list(token_stats.keys())
+        all_scores = []
+        # scored on CPU: an automatic batch size scores all samples at once
+        chunk_size = self.batch_size if self.batch_size != "auto" else len(all_indices)
+        for start in range(0, len(all_indices), max(chunk_size, 1)):
+            batch_values = [
+                self.values_from_token_stats(token_stats[idx])
+                for idx in all_indices[start : start + chunk_size]
+            ]
+            all_scores.extend(self.compute_batch_scores(batch_values))
+        return all_indices, all_scores
+
+    def _probe(self, batch):
+        """Compute the values of a collated batch, to probe automatic batch sizes."""
+        batch.pop("index", None)
+        self.compute_batch_values(batch)
+
+    def attack_batchwise(self):
+        """Score all samples by running the attack's own pass over the dataloader."""
         all_scores = []
         all_indices = []
+        real_tokens, padded_tokens = 0, 0
+        dataloader = get_eval_dataloader(
+            self.data,
+            self.collator,
+            self.batch_size,
+            batching=self.batching,
+            model=self.model,
+            kind=[type(self).__name__, self.vocab_chunk_size],
+            probe_fn=self._probe,
+        )
+        shard = self.checkpoint.shard() if self.checkpoint is not None else None
 
-        for batch in tqdm(self.dataloader, total=len(self.dataloader)):
+        for batch in tqdm(
+            dataloader, total=len(dataloader), disable=not is_main_process()
+        ):
             indices = batch.pop("index").cpu().numpy().tolist()
-            batch_values = self.compute_batch_values(batch)
-            scores = [self.compute_score(values) for values in batch_values]
+            keys = [("0", idx) for idx in indices]
+            if shard is not None and shard.done(keys):
+                all_scores.extend(shard.results[key]["score"] for key in keys)
+                all_indices.extend(indices)
+                continue
+            real, padded = count_padding(batch)
+            real_tokens, padded_tokens = real_tokens + real, padded_tokens + padded
+            batch_values = evaluate_with_backoff(
+                self.compute_batch_values, batch, dataloader.auto_batch_size
+            )
+            scores = self.compute_batch_scores(batch_values)
+            if shard is not None:
+                shard.append(
+                    ("0", idx, {"score": float(score)})
+                    for idx, score in zip(indices, scores)
+                )
 
             all_scores.extend(scores)
             all_indices.extend(indices)
+        dataloader.auto_batch_size.save()
+        if get_world_size() > 1:
+            parts = gather_objects(
+                (all_indices, all_scores, real_tokens, padded_tokens)
+            )
+            all_indices = [idx for part in parts for idx in part[0]]
+            all_scores = [score for part in parts for score in part[1]]
+            real_tokens = sum(part[2] for part in parts)
+            padded_tokens = sum(part[3] for part in parts)
+        if padded_tokens:
+            logger.info(f"Padding efficiency: {real_tokens / padded_tokens:.1%}")
+        return all_indices, all_scores
+
+    def attack(self):
+        """Run full MIA attack."""
+        if self.uses_token_stats and self.stats_cache is not None:
+            all_indices, all_scores = self.attack_from_token_stats()
+        else:
+            all_indices, all_scores = self.attack_batchwise()
 
+        # restore data index order
         scores_by_index = {
             str(idx): {"score": float(score)}
-            for idx, score in zip(all_indices, all_scores)
+            for idx, score in sorted(zip(all_indices, all_scores))
         }
 
         return {
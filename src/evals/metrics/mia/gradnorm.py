@@ -5,29 +5,52 @@ experimented for pre-training data and LLMs in https://arxiv.org/abs/2402.17012
 
 import torch
 from evals.metrics.mia.all_attacks import Attack
+from evals.metrics.mia.per_sample_grads import PerSampleGradNorms, select_parameters
 from evals.metrics.utils import tokenwise_logprobs
 
 
-# DO NOT use gradnorm in a way so that it runs when your accumulated gradients during training aren't used yet
-# gradnorm zeros out the gradients of the model during its computation
+# With batched=False, DO NOT use gradnorm in a way so that it runs when your accumulated
+# gradients during training aren't used yet: it zeros out the gradients of the model
 class GradNormAttack(Attack):
-    def setup(self, p, **kwargs):
+    def setup(self, p, param_patterns=None, batched=True, **kwargs):
+        """`param_patterns` restricts the norms to parameters matching these fnmatch
+        patterns (e.g. LoRA adapters or the last layers); `batched` computes all
+        per-sample norms of a batch in one backward pass (see `PerSampleGradNorms`)."""
         if p not in [1, 2, float("inf")]:
             raise ValueError(f"Invalid p-norm value: {p}")
         self.p = p
+        self.params = select_parameters(self.model, param_patterns)
+        self.grad_norms = (
+            PerSampleGradNorms(self.model, self.params, p) if batched else None
+        )
 
     def compute_batch_values(self, batch):
         """Compute gradients of examples w.r.t model parameters. More grad norm => more loss."""
         self.model.train()
-        batch_log_probs = tokenwise_logprobs(self.model, batch, grad=True)
+        if self.grad_norms is not None:
+            # the norms are taken over full logits: hooks do not see vocab-chunked lm_head
+            def losses():
+                batch_log_probs = tokenwise_logprobs(self.model, batch, grad=True)
+                return torch.stack([-torch.mean(lps) for lps in batch_log_probs])
+
+            batch_grad_norms = list(self.grad_norms(losses))
+            self.model.eval()
+            return batch_grad_norms
+        batch_log_probs = tokenwise_logprobs(
+            self.model, batch, grad=True, vocab_chunk_size=self.vocab_chunk_size
+        )
         batch_loss = [-torch.mean(lps) for lps in batch_log_probs]
+        selected = {id(param) for param in self.params}
         batch_grad_norms = []
         for sample_loss in batch_loss:
+            if not sample_loss.requires_grad:  # no labeled tokens: NaN loss
+                batch_grad_norms.append(sample_loss.detach())
+                continue
             sample_grad_norms = []
             self.model.zero_grad()
-            sample_loss.backward()
+            sample_loss.backward(retain_graph=True)
             for param in self.model.parameters():
-                if param.grad is not None:
+                if param.grad is not None and id(param) in selected:
                     sample_grad_norms.append(param.grad.detach().norm(p=self.p))
             batch_grad_norms.append(torch.stack(sample_grad_norms).mean())
         self.model.eval()
@@ -7,9 +7,17 @@ from evals.metrics.utils import evaluate_probability
 
 
 class LOSSAttack(Attack):
+    uses_token_stats = True
+
     def compute_batch_values(self, batch):
         """Compute probabilities and losses for the batch."""
-        return evaluate_probability(self.model, batch)
+        return evaluate_probability(
+            self.model, batch, vocab_chunk_size=self.vocab_chunk_size
+        )
+
+    def values_from_token_stats(self, token_stats):
+        """Average loss over all labeled tokens."""
+        return {"avg_loss": -token_stats["target_log_probs"].mean().item()}
 
     def compute_score(self, sample_stats):
         """Return the average loss for the sample."""
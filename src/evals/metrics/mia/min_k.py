@@ -2,25 +2,61 @@
 Min-k % Prob Attack: https://arxiv.org/pdf/2310.16789.pdf
 """
 
-import numpy as np
+import torch
 from evals.metrics.mia.all_attacks import Attack
 from evals.metrics.utils import tokenwise_logprobs
 
 
+def min_k_mean(values_batch, k):
+    """Negative mean of the bottom k% values of each sample, computed for the whole batch
+    at once by padding samples with +inf and taking a single `topk`.
+
+    Args:
+        values_batch (List[Tensor]): Token-wise values of each sample (may differ in length)
+        k (float): Fraction of lowest values to average
+
+    Returns:
+        List[float]: One score per sample, 0 for samples without values
+    """
+    if len(values_batch) == 0:
+        return []
+    lengths = torch.tensor([len(values) for values in values_batch])
+    if lengths.max() == 0:
+        return [0.0] * len(values_batch)
+    device = values_batch[0].device
+    padded = torch.nn.utils.rnn.pad_sequence(
+        [values.float() for values in values_batch],
+        batch_first=True,
+        padding_value=float("inf"),
+    )
+    num_k = torch.clamp((lengths * k).long(), min=1).to(device)
+    bottom, _ = torch.topk(padded, int(num_k.max()), dim=-1, largest=False)
+    in_k = torch.arange(bottom.shape[-1], device=device) < num_k.unsqueeze(-1)
+    scores = -torch.where(in_k, bottom, 0.0).sum(-1) / num_k
+    scores = torch.where(lengths.to(device) > 0, scores, 0.0)
+    return scores.cpu().tolist()
+
+
 class MinKProbAttack(Attack):
+    uses_token_stats = True
+
     def setup(self, k=0.2, **kwargs):
         self.k = k
 
     def compute_batch_values(self, batch):
         """Get token-wise log probabilities for the batch."""
-        return tokenwise_logprobs(self.model, batch, grad=False)
+        return tokenwise_logprobs(
+            self.model, batch, grad=False, vocab_chunk_size=self.vocab_chunk_size
+        )
+
+    def values_from_token_stats(self, token_stats):
+        """Token-wise log probabilities, ignoring the eos prediction."""
+        return token_stats["target_log_probs"][:-1]
+
+    def compute_batch_scores(self, batch_values):
+        """Score all samples of a batch together using min-k negative log probs scores attack."""
+        return min_k_mean(batch_values, self.k)
 
     def compute_score(self, sample_stats):
         """Score single sample using min-k negative log probs scores attack."""
-        lp = sample_stats.cpu().numpy()
-        if lp.size == 0:
-            return 0
-
-        num_k = max(1, int(len(lp) * self.k))
-        sorted_vals = np.sort(lp)
-        return -np.mean(sorted_vals[:num_k])
+        return self.compute_batch_scores([sample_stats])[0]
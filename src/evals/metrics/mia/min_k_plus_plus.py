@@ -1,39 +1,24 @@
 import torch as torch
-import numpy as np
 from evals.metrics.mia.min_k import MinKProbAttack
-from evals.metrics.utils import tokenwise_vocab_logprobs, tokenwise_logprobs
+from evals.metrics.utils import tokenwise_logprob_stats
 
 
 class MinKPlusPlusAttack(MinKProbAttack):
     def compute_batch_values(self, batch):
-        """Get both token-wise and vocab-wise log probabilities for the batch."""
-        vocab_log_probs = tokenwise_vocab_logprobs(self.model, batch, grad=False)
-        token_log_probs = tokenwise_logprobs(self.model, batch, grad=False)
-        return [
-            {"vocab_log_probs": vlp, "token_log_probs": tlp}
-            for vlp, tlp in zip(vocab_log_probs, token_log_probs)
-        ]
-
-    def compute_score(self, sample_stats):
-        """Score using min-k negative log probs scores with vocab-wise normalization."""
-        all_probs = sample_stats["vocab_log_probs"]
-        target_prob = sample_stats["token_log_probs"]
-
-        if len(target_prob) == 0:
-            return 0
-
-        # Compute normalized scores using vocab distribution
-        mu = (torch.exp(all_probs) * all_probs).sum(-1)
-        sigma = (torch.exp(all_probs) * torch.square(all_probs)).sum(-1) - torch.square(
-            mu
+        """Get token-wise z-scores of target log probabilities under the vocab
+        distribution, computed on-device from a single forward pass."""
+        stats_batch = tokenwise_logprob_stats(
+            self.model, batch, vocab_chunk_size=self.vocab_chunk_size
         )
+        return [self.values_from_token_stats(stats) for stats in stats_batch]
 
+    def values_from_token_stats(self, token_stats):
+        """Per-token z-scores (target log-prob - mu) / sigma, where mu and sigma^2 are the
+        mean and variance of log probs under the vocab distribution. Ignores eos prediction."""
+        target_prob = token_stats["target_log_probs"][:-1]
+        mu = token_stats["mean_log_probs"][:-1]
         # Handle numerical stability
-        sigma = torch.clamp(sigma, min=1e-6)
-        scores = (target_prob.cpu().numpy() - mu.cpu().numpy()) / torch.sqrt(
-            sigma
-        ).cpu().numpy()
+        sigma = torch.clamp(token_stats["var_log_probs"][:-1], min=1e-6)
+        return (target_prob - mu) / torch.sqrt(sigma)
 
-        # Take bottom k% as the attack score
-        num_k = max(1, int(len(scores) * self.k))
-        return -np.mean(sorted(scores)[:num_k])
+    # Scoring is inherited from MinKProbAttack: the bottom k% of z-scores are averaged
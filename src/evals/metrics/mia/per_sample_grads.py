@@ -0,0 +1,202 @@
+"""
+Per-sample gradient norms of a batch in a single backward pass. Forward hooks keep the
+inputs of the modules owning the selected parameters and hooks on their outputs get
+the gradients flowing back, from which each sample's gradient norm is derived per
+parameter. Parameter `.grad` buffers are never filled, and the backward pass stops at
+the earliest module owning a selected parameter.
+"""
+
+import fnmatch
+from collections import Counter
+
+import torch
+from torch import nn
+from torch.func import functional_call, vjp, vmap
+
+
+def select_parameters(model, param_patterns=None):
+    """Trainable parameters of `model` (those backward fills a `.grad` of, e.g. not the
+    frozen base weights of a PEFT model) with a name (any name, for tied parameters)
+    matching one of the fnmatch `param_patterns`, e.g. `["*lora_*"]`; all trainable
+    parameters if None."""
+    params = {}
+    for name, param in model.named_parameters(remove_duplicate=False):
+        if not param.requires_grad:
+            continue
+        if param_patterns is None or any(
+            fnmatch.fnmatchcase(name, pattern) for pattern in param_patterns
+        ):
+            params[id(param)] = param
+    if not params:
+        patterns = "" if param_patterns is None else f" matching {list(param_patterns)}"
+        raise ValueError(f"No trainable parameters{patterns}")
+    return list(params.values())
+
+
+def _norms(per_sample, p):
+    """p-norm of each sample's entries of a (bsz, ...) tensor."""
+    return torch.linalg.vector_norm(per_sample.flatten(1).float(), ord=p, dim=1)
+
+
+def _linear_weight_norms(x, g, p):
+    """Norms of the per-sample weight gradients g_i^T x_i of a linear layer. 2-norms
+    are computed from the (T, T) Gram matrices of inputs and output gradients when
+    they are smaller than the gradient itself, without materializing it."""
+    x, g = x.float(), g.float()
+    seq_len, in_features, out_features = x.shape[1], x.shape[2], g.shape[2]
+    if p == 2 and seq_len * seq_len < in_features * out_features:
+        sq_norms = (
+            torch.bmm(x, x.transpose(1, 2)) * torch.bmm(g, g.transpose(1, 2))
+        ).sum(dim=(1, 2))
+        return sq_norms.clamp(min=0).sqrt()
+    # one sample at a time, so that a single per-sample gradient is materialized
+    return torch.stack([_norms((g_i.T @ x_i)[None], p)[0] for x_i, g_i in zip(x, g)])
+
+
+class PerSampleGradNorms:
+    """Per-sample gradient p-norms of the `params` of `model`.
+
+    Gradients are derived per module type: linear layers and embeddings from their
+    inputs and output gradients, other modules (e.g. norms) by a vmapped vector-Jacobian
+    product of the module alone. Parameters used by several modules or calls (e.g. tied
+    embeddings) accumulate per-sample gradients densely before taking norms."""
+
+    def __init__(self, model, params, p=2):
+        self.model = model
+        self.params = params
+        self.p = p
+        selected = {id(param) for param in params}
+        self.owners = []  # (module, {name: param}) of modules owning selected params
+        for module in model.modules():
+            own = {
+                name: param
+                for name, param in module.named_parameters(recurse=False)
+                if id(param) in selected
+            }
+            if own:
+                self.owners.append((module, own))
+
+    def _contributions(self, module, own, args, g):
+        """(dense, norms) functions of each parameter of the module, by parameter id:
+        `dense` gives per-sample gradients (bsz, *param.shape) and `norms`, if not None,
+        their p-norms (bsz,) computed without materializing them all."""
+        x = args[0]
+        bsz = g.shape[0]
+        grads = {}
+        if isinstance(module, nn.Linear):
+            x, g = x.reshape(bsz, -1, x.shape[-1]), g.reshape(bsz, -1, g.shape[-1])
+            for name, param in own.items():
+                if name == "weight":
+                    grads[id(param)] = (
+                        lambda x=x, g=g: torch.einsum("bto,bti->boi", g, x),
+                        lambda x=x, g=g: _linear_weight_norms(x, g, self.p),
+                    )
+                else:
+                    grads[id(param)] = (lambda g=g: g.sum(dim=1), None)
+        elif isinstance(module, nn.Embedding):
+            ids, g = x.reshape(bsz, -1), g.reshape(bsz, -1, g.shape[-1])
+            if module.padding_idx is not None:  # rows never updated by backward
+                g = g * (ids != module.padding_idx).unsqueeze(-1).to(g.dtype)
+            param = own["weight"]
+
+            def dense(ids=ids, g=g, param=param):
+                per_sample = g.new_zeros(bsz, *param.shape)
+                for i in range(bsz):
+                    per_sample[i].index_add_(0, ids[i], g[i])
+                return per_sample
+
+            def norms(ids=ids, g=g):
+                sample_norms = []
+                for ids_i, g_i in zip(ids, g):
+                    rows, inverse = ids_i.unique(return_inverse=True)
+                    sample_grad = g_i.new_zeros(len(rows), g_i.shape[-1])
+                    sample_grad.index_add_(0, inverse, g_i)
+                    sample_norms.append(_norms(sample_grad[None], self.p)[0])
+                return torch.stack(sample_norms)
+
+            grads[id(param)] = (dense, norms)
+        else:
+            names = list(own)
+
+            def sample_grads(x_i, g_i):
+                def forward(params):
+                    return functional_call(
+                        module, params, (x_i[None], *args[1:]), strict=False
+                    )
+
+                _, pullback = vjp(forward, {name: own[name] for name in names})
+                return pullback(g_i[None])[0]
+
+            per_sample = vmap(sample_grads)(x, g)
+            for name in names:
+                grads[id(own[name])] = (lambda t=per_sample[name]: t, None)
+        return grads
+
+    def __call__(self, loss_fn):
+        """Run `loss_fn`, which returns per-sample losses (bsz,), and backpropagate their
+        sum once. Returns each sample's mean over parameters of their gradient norms;
+        NaN for samples with a NaN loss (e.g. no labeled tokens)."""
+        owned = {module: own for module, own in self.owners}
+        calls = Counter()  # parameter uses; forward is over once gradients flow back
+        norms, dense = {}, {}
+
+        def accumulate(module, args, g):
+            grads = self._contributions(module, owned[module], args, g)
+            for pid, (dense_fn, norms_fn) in grads.items():
+                if calls[pid] > 1:
+                    dense[pid] = dense_fn().float() + dense.get(pid, 0)
+                elif norms_fn is not None:
+                    norms[pid] = norms_fn()
+                else:
+                    norms[pid] = _norms(dense_fn(), self.p)
+
+        deferred = []  # vmapped vector-Jacobian products cannot run inside backward
+
+        def backward_hook(g, module, saved):
+            # inputs are released as soon as the module's gradients are accounted for
+            if isinstance(module, (nn.Linear, nn.Embedding)):
+                accumulate(module, saved.pop(), g.detach())
+            else:
+                deferred.append((module, saved.pop(), g.detach()))
+
+        def forward_hook(module, args, output):
+            if not isinstance(output, torch.Tensor):
+                raise ValueError(
+                    f"Per-sample gradients of {type(module).__name__} outputs are not supported"
+                )
+            calls.update(id(param) for param in owned[module].values())
+            saved = [
+                tuple(a.detach() if isinstance(a, torch.Tensor) else a for a in args)
+            ]
+            if not output.requires_grad:  # no selected parameter upstream
+                output.requires_grad_()
+            output.register_hook(lambda g: backward_hook(g, module, saved))
+            return output
+
+        requires_grad = [
+            (param, param.requires_grad) for param in self.model.parameters()
+        ]
+        handles = [module.register_forward_hook(forward_hook) for module in owned]
+        try:
+            for param, _ in requires_grad:
+                param.requires_grad_(False)
+            losses = loss_fn()
+            valid = ~torch.isnan(losses)
+            total = losses[valid].sum()
+            if not total.requires_grad:
+                raise ValueError("None of the selected parameters is used by the model")
+            total.backward()
+        finally:
+            for handle in handles:
+                handle.remove()
+            for param, flag in requires_grad:
+                param.requires_grad_(flag)
+
+        for module, args, g in deferred:
+            accumulate(module, args, g)
+        for pid, per_sample in dense.items():
+            norms[pid] = _norms(per_sample, self.p)
+        sample_norms = torch.stack(list(norms.values())).mean(dim=0)
+        return torch.where(
+            valid, sample_norms, torch.full_like(sample_norms, float("nan"))
+        )
@@ -3,22 +3,34 @@ Reference-based attacks.
 """
 
 from evals.metrics.mia.all_attacks import Attack
-from evals.metrics.utils import evaluate_probability
 
 
 class ReferenceAttack(Attack):
-    def setup(self, reference_model, **kwargs):
-        """Setup reference model."""
-        self.reference_model = reference_model
+    # the target model's losses are read from token statistics, computed by its own
+    # pass if no stats cache is shared
+    uses_token_stats = True
 
-    def compute_batch_values(self, batch):
-        """Compute loss scores for both target and reference models."""
-        ref_results = evaluate_probability(self.reference_model, batch)
-        target_results = evaluate_probability(self.model, batch)
-        return [
-            {"target_loss": t["avg_loss"], "ref_loss": r["avg_loss"]}
-            for t, r in zip(target_results, ref_results)
+    def setup(self, reference_losses, **kwargs):
+        """Setup the reference model's per-example losses, by data index (see
+        `get_reference_losses`)."""
+        self.reference_losses = reference_losses
+
+    def attack_batchwise(self):
+        return self.attack_from_token_stats()
+
+    def scores_from_token_stats(self, token_stats):
+        """Score samples by the difference between target and reference model losses."""
+        all_indices = list(token_stats.keys())
+        all_scores = [
+            self.compute_score(
+                {
+                    "target_loss": -token_stats[idx]["target_log_probs"].mean().item(),
+                    "ref_loss": self.reference_losses[str(idx)],
+                }
+            )
+            for idx in all_indices
         ]
+        return all_indices, all_scores
 
     def compute_score(self, sample_stats):
         """Score using difference between target and reference model losses."""
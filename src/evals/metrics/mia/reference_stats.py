@@ -0,0 +1,120 @@
+"""
+Per-example losses of MIA reference models. They depend only on the reference model and
+the data, so they are computed once and stored under the fingerprints of both, to be
+reused for every target model evaluated against the same reference.
+"""
+
+import os
+import gc
+import json
+import hashlib
+import logging
+import tempfile
+
+import torch
+from transformers import AutoModelForCausalLM
+
+from data.tokenized_cache import dataset_fingerprint
+from model.checkpoint import checkpoint_fingerprint
+from evals.distributed import is_main_process
+from evals.metrics.token_stats import _fingerprint, compute_token_stats
+
+logger = logging.getLogger("metrics")
+
+# bump when the stored layout or the loss computation changes
+STATS_VERSION = 1
+
+
+def reference_model_fingerprint(model_path, revision=None):
+    """Fingerprint of a reference checkpoint (see `checkpoint_fingerprint`), or None if
+    the commit of a Hub revision cannot be resolved."""
+    state = checkpoint_fingerprint(model_path, revision)
+    if state is None:
+        return None
+    payload = json.dumps(state, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _avg_losses(token_stats):
+    """Average loss over the labeled tokens of each example, by data index."""
+    return {
+        str(idx): -stats["target_log_probs"].mean().item()
+        for idx, stats in token_stats.items()
+    }
+
+
+def get_reference_losses(
+    model_path,
+    data,
+    collator,
+    batch_size,
+    torch_dtype,
+    device,
+    stats_dir=None,
+    revision=None,
+    vocab_chunk_size=None,
+    batching=None,
+):
+    """Per-example average losses of the reference model at `model_path` on each split
+    of `data`, as {split: {index: loss}}.
+
+    With a `stats_dir`, losses are read from (and stored to) a file named after the
+    reference checkpoint (a Hub revision by its commit), the dataset, the collator and
+    the dtype, so that the reference model is only loaded for splits not computed
+    before."""
+    reference_key = reference_model_fingerprint(model_path, revision)
+    if reference_key is None and stats_dir is not None:
+        logger.warning(
+            f"Reference losses of {model_path} are not stored: unresolved revision"
+        )
+        stats_dir = None
+    paths, losses = {}, {}
+    for split, split_data in data.items():
+        payload = json.dumps(
+            [
+                STATS_VERSION,
+                reference_key,
+                dataset_fingerprint(split_data),
+                _fingerprint(collator),
+                str(torch_dtype),
+            ]
+        )
+        key = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        paths[split] = os.path.join(stats_dir, f"{key}.json") if stats_dir else None
+        if paths[split] is not None and os.path.exists(paths[split]):
+            with open(paths[split], "r") as f:
+                losses[split] = json.load(f)
+            logger.info(f"Loaded reference losses of {split} from {paths[split]}")
+
+    missing = [split for split in data if split not in losses]
+    if missing:
+        logger.info(f"Loading reference model from {model_path}")
+        reference_model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            revision=revision,
+            torch_dtype=torch_dtype,
+            device_map={"": device},
+        )
+        reference_model.eval()
+        for split in missing:
+            token_stats = compute_token_stats(
+                reference_model,
+                data[split],
+                collator,
+                batch_size,
+                vocab_chunk_size=vocab_chunk_size,
+                batching=batching,
+            )
+            losses[split] = _avg_losses(token_stats)
+            if paths[split] is not None and is_main_process():
+                os.makedirs(stats_dir, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=stats_dir, prefix=".tmp-")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(losses[split], f)
+                os.replace(tmp_path, paths[split])
+        # the reference model is not needed for the target model's pass
+        del reference_model
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    return losses
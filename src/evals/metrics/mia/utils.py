@@ -6,7 +6,10 @@ from evals.metrics.mia.min_k import MinKProbAttack
 from evals.metrics.mia.min_k_plus_plus import MinKPlusPlusAttack
 from evals.metrics.mia.gradnorm import GradNormAttack
 
-from sklearn.metrics import roc_auc_score
+from evals.metrics.bootstrap import auc_ci
+from evals.metrics.token_stats import get_token_stats
+
+from sklearn.metrics import roc_auc_score, roc_curve
 
 
 import numpy as np
@@ -27,7 +30,16 @@ def get_attacker(attack: str):
     return attack_cls
 
 
-def mia_auc(attack_cls, model, data, collator, batch_size, **kwargs):
+def mia_auc(
+    attack_cls,
+    model,
+    data,
+    collator,
+    batch_size,
+    split_kwargs=None,
+    bootstrap=None,
+    **kwargs,
+):
     """
     Compute the MIA AUC and accuracy.
 
@@ -37,7 +49,9 @@ def mia_auc(attack_cls, model, data, collator, batch_size, **kwargs):
       - data: a dict with keys "forget" and "holdout".
       - collator: data collator.
       - batch_size: batch size.
-      - kwargs: additional optional parameters (e.g. k, p, tokenizer, reference_model).
+      - split_kwargs: optional per-split attack parameters, e.g. {"forget": {...}}.
+      - bootstrap: optional bootstrap settings (see `bootstrap_settings`) for "agg_ci".
+      - kwargs: additional optional parameters (e.g. k, p, tokenizer, reference_losses).
 
     Returns a dict containing the attack outputs, including "acc" and "auc".
 
@@ -51,9 +65,12 @@ def mia_auc(attack_cls, model, data, collator, batch_size, **kwargs):
     }
     attack_args.update(kwargs)
 
+    split_kwargs = split_kwargs or {}
     output = {
-        "forget": attack_cls(data=data["forget"], **attack_args).attack(),
-        "holdout": attack_cls(data=data["holdout"], **attack_args).attack(),
+        split: attack_cls(
+            data=data[split], **attack_args, **split_kwargs.get(split, {})
+        ).attack()
+        for split in ["forget", "holdout"]
     }
     forget_scores = [
         elem["score"] for elem in output["forget"]["value_by_index"].values()
@@ -67,4 +84,107 @@ def mia_auc(attack_cls, model, data, collator, batch_size, **kwargs):
     )  # see note above
     auc_value = roc_auc_score(labels, scores)
     output["auc"], output["agg_value"] = auc_value, auc_value
+    if bootstrap is not None:
+        output["agg_ci"] = auc_ci(forget_scores, holdout_scores, bootstrap)
+    return output
+
+
+def downsampled_roc(labels, scores, num_points=101):
+    """ROC curve as true positive rates at `num_points` evenly spaced false positive
+    rates in [0, 1]."""
+    fpr, tpr, _ = roc_curve(labels, scores)
+    grid = np.linspace(0.0, 1.0, num_points)
+    return {"fpr": grid.tolist(), "tpr": np.interp(grid, fpr, tpr).tolist()}
+
+
+def mia_sweep_auc(
+    model,
+    data,
+    collator,
+    batch_size,
+    attacks,
+    roc_points=101,
+    primary_attack="loss",
+    bootstrap=None,
+    **kwargs,
+):
+    """
+    Compute the AUCs and ROC curves of several token-statistics attacks (e.g. LOSS,
+    zlib, Min-K and Min-K++ for several k) from a single pass over each split.
+
+    Parameters:
+      - attacks: a dict from attack names (see `AllAttacks`) to their setup args; a
+        list of `k` values expands to one attack per value, named e.g. "min_k@0.2".
+      - roc_points: number of points of the downsampled ROC curves.
+      - primary_attack: the attack (as named in the results) whose AUC is "agg_value".
+      - bootstrap: optional bootstrap settings (see `bootstrap_settings`) for the
+        "auc_ci" of every attack, and the "agg_ci" of the primary attack.
+      - kwargs: stats_cache, vocab_chunk_size, batching, checkpoint and tokenizer.
+
+    Returns a dict with the "auc" and "roc" of every attack, the AUC of the primary
+    attack as "agg_value", and the per-index scores of every attack under "forget" and
+    "holdout". Scores and labels follow the convention of `mia_auc`.
+    """
+    token_stats = {
+        split: get_token_stats(
+            model,
+            data[split],
+            collator,
+            batch_size,
+            stats_cache=kwargs.get("stats_cache", None),
+            vocab_chunk_size=kwargs.get("vocab_chunk_size", None),
+            batching=kwargs.get("batching", None),
+            checkpoint=kwargs.get("checkpoint", None),
+        )
+        for split in ["forget", "holdout"]
+    }
+    output = {
+        "forget": {"value_by_index": {}},
+        "holdout": {"value_by_index": {}},
+        "auc": {},
+        "roc": {},
+    }
+    for attack, attack_args in attacks.items():
+        attack_cls = get_attacker(attack)
+        if not attack_cls.uses_token_stats or attack == AllAttacks.REFERENCE_BASED:
+            raise ValueError(f"Attack {attack} is not supported by mia_sweep")
+        attack_args = dict(attack_args or {})
+        variants = {attack: attack_args}
+        if isinstance(attack_args.get("k"), list):
+            variants = {
+                f"{attack}@{k}": {**attack_args, "k": k} for k in attack_args["k"]
+            }
+        for name, args in variants.items():
+            split_scores = {}
+            for split, stats in token_stats.items():
+                attacker = attack_cls(
+                    model=model,
+                    data=data[split],
+                    collator=collator,
+                    batch_size=batch_size,
+                    tokenizer=kwargs.get("tokenizer", None),
+                    **args,
+                )
+                indices, scores = attacker.scores_from_token_stats(stats)
+                split_scores[split] = [float(score) for score in scores]
+                value_by_index = output[split]["value_by_index"]
+                for idx, score in zip(indices, split_scores[split]):
+                    value_by_index.setdefault(str(idx), {})[name] = score
+            scores = np.array(split_scores["forget"] + split_scores["holdout"])
+            labels = np.array(
+                [0] * len(split_scores["forget"]) + [1] * len(split_scores["holdout"])
+            )  # see note in mia_auc
+            output["auc"][name] = roc_auc_score(labels, scores)
+            output["roc"][name] = downsampled_roc(labels, scores, roc_points)
+            if bootstrap is not None:
+                output.setdefault("auc_ci", {})[name] = auc_ci(
+                    split_scores["forget"], split_scores["holdout"], bootstrap
+                )
+    if primary_attack not in output["auc"]:
+        raise ValueError(
+            f"primary_attack {primary_attack} is none of the attacks {list(output['auc'])}"
+        )
+    output["agg_value"] = output["auc"][primary_attack]
+    if bootstrap is not None:
+        output["agg_ci"] = output["auc_ci"][primary_attack]
     return output
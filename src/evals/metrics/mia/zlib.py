@@ -12,16 +12,27 @@ from evals.metrics.utils import (
 
 
 class ZLIBAttack(Attack):
+    uses_token_stats = True
+
     def setup(self, tokenizer=None, **kwargs):
         """Setup tokenizer."""
         self.tokenizer = tokenizer or self.model.tokenizer
 
     def compute_batch_values(self, batch):
         """Get loss and text for batch."""
-        eval_results = evaluate_probability(self.model, batch)
+        eval_results = evaluate_probability(
+            self.model, batch, vocab_chunk_size=self.vocab_chunk_size
+        )
         texts = extract_target_texts_from_processed_data(self.tokenizer, batch)
         return [{"loss": r["avg_loss"], "text": t} for r, t in zip(eval_results, texts)]
 
+    def values_from_token_stats(self, token_stats):
+        """Average loss and detokenized target text."""
+        text = self.tokenizer.decode(
+            token_stats["labels"].tolist(), skip_special_tokens=True
+        )
+        return {"loss": -token_stats["target_log_probs"].mean().item(), "text": text}
+
     def compute_score(self, sample_stats):
         """Score using loss normalized by compressed text length."""
         text = sample_stats["text"]
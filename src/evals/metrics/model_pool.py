@@ -0,0 +1,65 @@
+"""
+Process-wide pool of auxiliary models used by metrics (e.g. the classifier of
+`classifier_prob`, the draft model of speculative decoding). Models are loaded on first use and kept for the lifetime of the
+process, so that metrics evaluated repeatedly, e.g. at every evaluation step during
+training, do not load them again.
+"""
+
+import json
+import logging
+import threading
+
+import torch
+from torch import nn
+from omegaconf import DictConfig, ListConfig, OmegaConf
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    AutoModelForSequenceClassification,
+)
+
+logger = logging.getLogger("metrics")
+
+_pool = {}
+_lock = threading.Lock()
+
+
+def _pool_key(*args):
+    args = [
+        OmegaConf.to_container(arg, resolve=True)
+        if isinstance(arg, (DictConfig, ListConfig))
+        else arg
+        for arg in args
+    ]
+    return json.dumps(args, sort_keys=True, default=str)
+
+
+def get_classifier(model_args, tokenization_args, device="cuda", int8=False):
+    """(tokenizer, model) of a sequence classifier, by `from_pretrained` args and device.
+    With `int8`, linear layers run with dynamically quantized int8 weights, on CPU only."""
+    if int8 and torch.device(device).type != "cpu":
+        raise ValueError(f"int8 classifiers run on CPU only, got device {device}")
+    key = _pool_key("classifier", model_args, tokenization_args, device, int8)
+    with _lock:
+        if key not in _pool:
+            logger.info(f"Loading classifier {model_args}")
+            tokenizer = AutoTokenizer.from_pretrained(**tokenization_args)
+            model = AutoModelForSequenceClassification.from_pretrained(**model_args)
+            model = model.to(device).eval()
+            if int8:
+                model = torch.ao.quantization.quantize_dynamic(
+                    model, {nn.Linear}, dtype=torch.qint8
+                )
+            _pool[key] = (tokenizer, model)
+        return _pool[key]
+
+
+def get_draft_model(model_args, device):
+    """Draft causal LM of speculative decoding, by `from_pretrained` args and device."""
+    key = _pool_key("draft", model_args, str(device))
+    with _lock:
+        if key not in _pool:
+            logger.info(f"Loading draft model {model_args}")
+            model = AutoModelForCausalLM.from_pretrained(**model_args)
+            _pool[key] = model.to(device).eval()
+        return _pool[key]
@@ -0,0 +1,170 @@
+"""
+KV cache of a token prefix shared by all samples of a dataset (e.g. the in-context
+examples of few-shot QA), encoded once per model and reused by every batch.
+"""
+
+import logging
+import weakref
+
+import torch
+from transformers import DynamicCache
+
+from data.utils import IGNORE_INDEX
+from evals.metrics.token_stats import _fingerprint, _model_state
+
+logger = logging.getLogger("metrics")
+
+
+def _cacheable_length(sample):
+    """Length of the prefix of a sample that can be moved to a cache: at least one input
+    token must remain to score or generate from, and no labeled token may be predicted
+    from a prefix position."""
+    input_ids, labels = sample["input_ids"], sample["labels"]
+    length = len(input_ids) - 1
+    if len(labels) > len(input_ids):
+        # generation inputs: labels hold the entire conversation, prompt included, and
+        # are stripped of the prefix along with input_ids
+        same = (labels[: len(input_ids)] == input_ids).long()
+        length = min(length, int(same.cumprod(0).sum()))
+    else:
+        labeled = (labels != IGNORE_INDEX).nonzero()
+        if len(labeled):
+            length = min(length, int(labeled[0]) - 1)
+    return max(length, 0)
+
+
+def find_shared_prefix(data) -> torch.Tensor:
+    """Longest cacheable token prefix common to all samples of a dataset."""
+    prefix = None
+    for i in range(len(data)):
+        item = data[i]
+        samples = [item] if "input_ids" in item else list(item.values())
+        for sample in samples:
+            input_ids = sample["input_ids"][: _cacheable_length(sample)]
+            if prefix is None:
+                prefix = input_ids
+                continue
+            length = min(len(prefix), len(input_ids))
+            mismatches = (prefix[:length] != input_ids[:length]).nonzero()
+            prefix = prefix[: int(mismatches[0]) if len(mismatches) else length]
+            if len(prefix) == 0:
+                return prefix
+    return prefix
+
+
+class _PrefixStrippingCollator:
+    """Wraps a collator to collate samples without their first `length` tokens."""
+
+    def __init__(self, collator, length):
+        self.collator = collator
+        self.length = length
+
+    def _strip(self, sample):
+        if "input_ids" not in sample:
+            return {key: self._strip(value) for key, value in sample.items()}
+        return {
+            key: value[self.length :]
+            if key in ["input_ids", "labels", "attention_mask"]
+            else value
+            for key, value in sample.items()
+        }
+
+    def __call__(self, instances):
+        return self.collator([self._strip(instance) for instance in instances])
+
+
+class SharedPrefix:
+    """Token prefix shared by all samples of a dataset.
+
+    Batches are collated without the prefix (see `collator`) and model calls attend to
+    its KV cache instead (see `model_inputs` and `generate`). The cache is computed once
+    per model weights and expanded across the batch."""
+
+    def __init__(self, prefix_ids: torch.Tensor):
+        self.prefix_ids = prefix_ids
+        self.length = len(prefix_ids)
+        self._model_ref, self._model_state, self._kv = None, None, None
+
+    def collator(self, collator):
+        return _PrefixStrippingCollator(collator, self.length)
+
+    def kv(self, model):
+        """Legacy-format KV cache of the prefix under the current weights of `model`."""
+        state = _model_state(model)
+        if (
+            self._model_ref is None
+            or self._model_ref() is not model
+            or self._model_state != state
+        ):
+            with torch.no_grad():
+                output = model(
+                    input_ids=self.prefix_ids.unsqueeze(0).to(model.device),
+                    use_cache=True,
+                )
+            kv = output.past_key_values
+            self._kv = kv.to_legacy_cache() if isinstance(kv, DynamicCache) else kv
+            self._model_ref, self._model_state = weakref.ref(model), state
+        return self._kv
+
+    def cache(self, model, batch_size):
+        """Fresh DynamicCache holding the prefix for every sample of a batch."""
+        return DynamicCache.from_legacy_cache(
+            tuple(
+                tuple(t.expand(batch_size, -1, -1, -1) for t in layer)
+                for layer in self.kv(model)
+            )
+        )
+
+    def prepend(self, tensor):
+        """Prefix ids followed by the given (batch of) suffix ids."""
+        prefix = self.prefix_ids.to(tensor.device, tensor.dtype)
+        return torch.cat([prefix.expand(tensor.shape[0], -1), tensor], dim=1)
+
+    def model_inputs(self, model, attention_mask):
+        """Cache, attention mask and position ids to run a batch of suffixes (with
+        `attention_mask`) after the prefix."""
+        batch_size = attention_mask.shape[0]
+        attention_mask = torch.cat(
+            [attention_mask.new_ones(batch_size, self.length), attention_mask], dim=1
+        )
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+        return {
+            "past_key_values": self.cache(model, batch_size),
+            "attention_mask": attention_mask,
+            "position_ids": position_ids[:, self.length :],
+        }
+
+    def generate(self, model, input_ids, attention_mask, **generation_args):
+        """`model.generate` on a batch of suffixes, returning sequences without the
+        prefix. Stopping criteria see the prefixed sequences."""
+        batch_size = input_ids.shape[0]
+        attention_mask = torch.cat(
+            [attention_mask.new_ones(batch_size, self.length), attention_mask], dim=1
+        )
+        output = model.generate(
+            self.prepend(input_ids),
+            attention_mask=attention_mask,
+            past_key_values=self.cache(model, batch_size),
+            **generation_args,
+        )
+        return output[:, self.length :]
+
+
+_shared_prefixes = {}
+
+
+def get_shared_prefix(data):
+    """SharedPrefix of a dataset, or None if its samples share no cacheable prefix.
+    Datasets with the same prefix share one SharedPrefix, hence one KV cache."""
+    key = _fingerprint(data)
+    if key not in _shared_prefixes:
+        prefix_ids = find_shared_prefix(data)
+        shared_prefix = None
+        if prefix_ids is not None and len(prefix_ids):
+            prefix_key = tuple(prefix_ids.tolist())
+            shared_prefix = _shared_prefixes.setdefault(
+                prefix_key, SharedPrefix(prefix_ids)
+            )
+            logger.info(f"Caching a shared prefix of {len(prefix_ids)} tokens")
+        _shared_prefixes[key] = shared_prefix
+    return _shared_prefixes[key]
@@ -1,9 +1,10 @@
 import numpy as np
 from scipy.stats import ks_2samp
 from evals.metrics.base import unlearning_metric, logger
+from evals.metrics.bootstrap import bootstrap_settings, ks_ci
 
 
-@unlearning_metric(name="ks_test")
+@unlearning_metric(name="ks_test", cpu_only=True)
 def ks_test(model, **kwargs):
     """Compare two forget and retain model distributions with a 2-sample KS-test and report the p-value.
     Used in the TOFU benchmark as forget_quality when computed over the truth_ratio statistic."""
@@ -29,10 +30,14 @@ def ks_test(model, **kwargs):
             "retain_model_logs not provided in reference_logs, setting forget_quality to None"
         )
         pvalue = None
-    return {"agg_value": pvalue}
+    results = {"agg_value": pvalue}
+    settings = bootstrap_settings(kwargs)
+    if settings is not None and pvalue is not None:
+        results["agg_ci"] = ks_ci(forget_tr_stats, retain_tr_stats, settings)
+    return results
 
 
-@unlearning_metric(name="privleak")
+@unlearning_metric(name="privleak", cpu_only=True)
 def privleak(model, **kwargs):
     """Compare two forget and retain model scores using a relative comparison of a single statistic.
     To be used for MIA AUC scores in ensuring consistency and reproducibility of the MUSE benchmark.
@@ -52,7 +57,7 @@ def privleak(model, **kwargs):
     return {"agg_value": (score - ref) / (ref + 1e-10) * 100}
 
 
-@unlearning_metric(name="rel_diff")
+@unlearning_metric(name="rel_diff", cpu_only=True)
 def rel_diff(model, **kwargs):
     """Compare two forget and retain model scores using a relative comparison of a single statistic."""
     score = kwargs["pre_compute"]["forget"]["agg_value"]
@@ -0,0 +1,136 @@
+"""
+ROUGE scoring engine for generation metrics. Computes the same scores as
+`rouge_scorer.RougeScorer(["rouge1", "rougeL"], use_stemmer=True)`, with cached
+reference preprocessing and bit-parallel LCS.
+"""
+
+import multiprocessing
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, Sequence, Union
+
+from nltk.stem import porter
+from rouge_score import tokenize
+
+
+class _MemoizedStemmer:
+    """Porter stemmer remembering stems, as evaluation texts reuse a small vocabulary."""
+
+    def __init__(self):
+        self._stemmer = porter.PorterStemmer()
+        self._stems = {}
+
+    def stem(self, word):
+        stem = self._stems.get(word)
+        if stem is None:
+            stem = self._stems[word] = self._stemmer.stem(word)
+        return stem
+
+
+@lru_cache(maxsize=None)
+def _get_stemmer():
+    return _MemoizedStemmer()
+
+
+def tokenize_text(text: str) -> List[str]:
+    """ROUGE tokens of a text, as produced by rouge_score's stemming tokenizer."""
+    return tokenize.tokenize(text, _get_stemmer())
+
+
+class _Reference:
+    """Preprocessed reference: length, unigram counts and, for every token, the bitmask
+    of its positions (for bit-parallel LCS)."""
+
+    def __init__(self, tokens: Sequence):
+        self.length = len(tokens)
+        self.unigrams = Counter(tokens)
+        self.match_masks = {}
+        for position, token in enumerate(tokens):
+            self.match_masks[token] = self.match_masks.get(token, 0) | (1 << position)
+
+    def lcs_length(self, prediction: Sequence) -> int:
+        """LCS length with the bit-vector algorithm of Allison & Dix (1986): one big-int
+        update per prediction token instead of a row of the DP table."""
+        full = (1 << self.length) - 1
+        row = full
+        for token in prediction:
+            matches = row & self.match_masks.get(token, 0)
+            row = ((row + matches) | (row - matches)) & full
+        return self.length - row.bit_count()
+
+    def score(self, prediction: Sequence) -> Dict[str, float]:
+        overlap = sum(
+            min(count, self.unigrams[token])
+            for token, count in Counter(prediction).items()
+            if token in self.unigrams
+        )
+        scores = {"rouge1_recall": overlap / max(self.length, 1)}
+        if self.length == 0 or len(prediction) == 0:
+            return scores | {"rougeL_f1": 0, "rougeL_recall": 0}
+        lcs = self.lcs_length(prediction)
+        precision, recall = lcs / len(prediction), lcs / self.length
+        if precision + recall > 0:
+            f1 = 2 * precision * recall / (precision + recall)
+        else:
+            f1 = 0.0
+        return scores | {"rougeL_f1": f1, "rougeL_recall": recall}
+
+
+class RougeEngine:
+    """Scores generations against references with rouge1 recall and rougeL f1/recall.
+
+    References are tokenized, stemmed and preprocessed once and cached, so that repeated
+    evaluations of a dataset (e.g. of several checkpoints) only process generations.
+    With `num_workers > 0`, generation texts are tokenized in a process pool.
+
+    Generations and references can also be given as token id sequences, which are
+    scored as they are without detokenization. Scores then count model tokens instead
+    of stemmed words, and are not comparable to text scores."""
+
+    def __init__(self, num_workers: int = 0):
+        self.num_workers = num_workers
+        self._references = {}
+        self._pool = None
+
+    def _reference(self, reference: Union[str, Sequence[int]]) -> _Reference:
+        key = reference if isinstance(reference, str) else tuple(reference)
+        cached = self._references.get(key)
+        if cached is None:
+            tokens = tokenize_text(reference) if isinstance(reference, str) else key
+            cached = self._references[key] = _Reference(tokens)
+        return cached
+
+    def _tokenize(self, texts: List[str]) -> List[List[str]]:
+        if self.num_workers <= 0 or len(texts) < 2 * self.num_workers:
+            return [tokenize_text(text) for text in texts]
+        if self._pool is None:
+            # spawn: the pool must not inherit the parent's CUDA state
+            context = multiprocessing.get_context("spawn")
+            self._pool = context.Pool(self.num_workers)
+        chunksize = max(1, len(texts) // (4 * self.num_workers))
+        return self._pool.map(tokenize_text, texts, chunksize=chunksize)
+
+    def score(
+        self,
+        predictions: List[Union[str, Sequence[int]]],
+        references: List[Union[str, Sequence[int]]],
+    ) -> List[Dict[str, float]]:
+        texts = [p for p in predictions if isinstance(p, str)]
+        text_tokens = iter(self._tokenize(texts))
+        return [
+            self._reference(reference).score(
+                next(text_tokens) if isinstance(prediction, str) else prediction
+            )
+            for prediction, reference in zip(predictions, references)
+        ]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+
+@lru_cache(maxsize=None)
+def get_rouge_engine(num_workers: int = 0) -> RougeEngine:
+    """Process-wide engines, so that cached references outlive a single evaluation."""
+    return RougeEngine(num_workers=num_workers)
@@ -0,0 +1,152 @@
+"""
+Scheduling of metric evaluations. The metrics of an evaluator and their pre_compute
+metrics form a dependency graph whose nodes are identified by the content hash of
+their config, so that a node shared by several metrics or evaluators (e.g. the same
+probability metric under TOFU's truth ratio and model utility) runs once per model
+state. Nodes of CPU-only handlers, which aggregate the results of their pre_compute
+metrics, run in a background thread while the next metrics run on the model.
+"""
+
+import json
+import hashlib
+import logging
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from omegaconf import DictConfig, ListConfig, OmegaConf
+from transformers import PreTrainedTokenizerBase
+
+from evals.metrics.token_stats import _model_state
+
+logger = logging.getLogger("metrics")
+
+# evaluator settings that change how a metric is computed, not its results
+_EXECUTION_KWARGS = ("stats_cache", "batching", "checkpoint_dir")
+# metric config entries consumed by the metric itself, not passed to its pre_computes
+_NODE_KWARGS = ("datasets", "collators", "pre_compute")
+
+
+def node_key(metric, kwargs):
+    """Content hash of a metric evaluation: its handler and config, which includes the
+    configs of its pre_compute metrics, and the tokenizer and template args. None if
+    the kwargs hold objects that cannot be hashed by content."""
+    config = {}
+    for key, value in kwargs.items():
+        if key in _EXECUTION_KWARGS:
+            continue
+        if isinstance(value, (DictConfig, ListConfig)):
+            config[key] = OmegaConf.to_container(value, resolve=True)
+        elif isinstance(value, PreTrainedTokenizerBase):
+            config[key] = [type(value).__name__, value.name_or_path, len(value)]
+        elif isinstance(value, (str, int, float, bool, list, dict, type(None))):
+            config[key] = value
+        else:
+            return None
+    payload = json.dumps([metric.name, config], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _done(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class MetricScheduler:
+    """Evaluates metrics as nodes of a dependency graph.
+
+    `schedule` resolves a metric's pre_compute metrics first, reusing results by name
+    from the evaluator's logs and by node key from any earlier evaluation of the
+    current model weights. Model-backed nodes run in the calling thread, in order;
+    CPU-only nodes run in a worker thread once their pre_compute results are ready.
+    Memoized results of a model are dropped as soon as its weights change."""
+
+    def __init__(self):
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metrics")
+        self._model_ref = None
+        self._model_state = None
+        self._results = {}
+
+    def _memo(self, model):
+        state = _model_state(model)
+        if self._model_ref is None or self._model_ref() is not model:
+            self._model_ref, self._model_state, self._results = (
+                weakref.ref(model),
+                state,
+                {},
+            )
+        elif self._model_state != state:
+            self._model_state, self._results = state, {}
+        return self._results
+
+    def schedule(
+        self, model, metric, metric_name, cache, pending, overlap=True, **kwargs
+    ) -> Future:
+        """Future of the results of `metric_name`, scheduling it and those of its
+        pre_compute metrics that are not in `cache` (results by metric name). Futures
+        of all newly scheduled metrics are added to `pending` by name; the caller
+        moves them to `cache` once done. With `overlap=False`, CPU-only metrics also
+        run in the calling thread."""
+        if metric_name in cache:
+            logger.info(f"Skipping {metric_name}, already evaluated.")
+            return _done(cache[metric_name])
+        if metric_name in pending:
+            return pending[metric_name]
+        memo = self._memo(model)
+        key = node_key(metric, kwargs)
+        if key is not None and key in memo:
+            logger.info(
+                f"Reusing {metric_name}, evaluated earlier with the same config"
+            )
+            future = memo[key]
+        else:
+            future = self._submit(
+                model, metric, metric_name, cache, pending, overlap, kwargs
+            )
+            if key is not None:
+                memo[key] = future
+        pending[metric_name] = future
+        return future
+
+    def _submit(self, model, metric, metric_name, cache, pending, overlap, kwargs):
+        inherited = {k: v for k, v in kwargs.items() if k not in _NODE_KWARGS}
+        pre_compute = {}
+        for pre_metric_name, pre_metric_cfg in kwargs.get("pre_compute", {}).items():
+            pre_metric = metric.pre_compute_metrics.get(pre_metric_name, None)
+            assert pre_metric is not None, ValueError(
+                f"No pre_compute metric of name {pre_metric_name}"
+            )
+            access_name = pre_metric_cfg.get("access_key", pre_metric_name)
+            pre_metric_kwargs = inherited.copy()
+            pre_metric_kwargs.update(**pre_metric_cfg)
+            pre_compute[access_name] = self.schedule(
+                model,
+                pre_metric,
+                pre_metric_name,
+                cache,
+                pending,
+                overlap=overlap,
+                **pre_metric_kwargs,
+            )
+
+        def run():
+            pre_compute_results = {
+                access_name: future.result()
+                for access_name, future in pre_compute.items()
+            }
+            return metric.compute(model, metric_name, pre_compute_results, **kwargs)
+
+        if metric.cpu_only and overlap:
+            return self._pool.submit(run)
+        return _done(run())
+
+
+_SCHEDULER = None
+
+
+def get_metric_scheduler() -> MetricScheduler:
+    """Scheduler shared by all evaluators of the process."""
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        _SCHEDULER = MetricScheduler()
+    return _SCHEDULER
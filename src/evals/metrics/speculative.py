@@ -0,0 +1,233 @@
+"""
+Batched speculative greedy decoding for generation metrics. A small draft model sharing
+the target model's tokenizer proposes a few tokens for every row of a left-padded batch,
+and the target model checks them all in one forward pass. Each row matches a prefix of
+the drafted tokens against the target's own greedy choices; the batch keeps the
+shortest matched prefix among unfinished rows, followed by the target's next token, so
+that all rows stay aligned and both KV caches are cropped to the same length.
+
+Kept tokens are the target's argmax given the previous ones, as in greedy decoding, but
+computed by multi-token rather than one-token forward passes: floating-point
+differences can flip near-ties, so outputs may differ from plain greedy decoding. The
+first `verify_batches` batches (all of them if None) are also generated plainly, and
+their plain outputs are used; once a verified batch differs, the remaining batches are
+generated plainly only.
+"""
+
+import logging
+
+import torch
+from transformers import DynamicCache
+
+from evals.distributed import gather_objects
+
+logger = logging.getLogger("evaluator")
+
+# generation args of the metric configs that speculative decoding handles
+_GENERATION_ARGS = {
+    "do_sample",
+    "top_p",
+    "temperature",
+    "max_new_tokens",
+    "use_cache",
+    "pad_token_id",
+}
+_COUNTERS = (
+    "drafted",
+    "accepted",
+    "generated",
+    "forwards",
+    "verified",
+    "mismatched",
+    "plain",
+    "unverified",
+)
+
+
+def _forward(model, cache, tokens, attention_mask):
+    """Logits of `tokens`, which follow the tokens in `cache`; `attention_mask` covers
+    both. Positions skip left padding, as in `generate`."""
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+    return model(
+        input_ids=tokens,
+        attention_mask=attention_mask,
+        position_ids=position_ids[:, -tokens.shape[1] :],
+        past_key_values=cache,
+        use_cache=True,
+    ).logits
+
+
+def _eos_ids(model, device):
+    eos = model.generation_config.eos_token_id
+    if eos is None:
+        return None
+    return torch.tensor([eos] if isinstance(eos, int) else list(eos), device=device)
+
+
+class SpeculativeDecoding:
+    """Greedy generation of a target model with candidates from `draft_model`, and the
+    acceptance statistics of all generations. The number of drafted tokens per step
+    starts at `num_assistant_tokens`, grows by 2 when all are kept and shrinks by 1
+    otherwise. The first `verify_batches` batches (every batch if None) are also
+    generated without the draft model, whose outputs are used, and rows differing
+    between both are counted. After a batch with differing rows, later batches are
+    generated without the draft model."""
+
+    def __init__(self, draft_model, num_assistant_tokens=5, verify_batches=1):
+        self.draft_model = draft_model
+        self.num_assistant_tokens = num_assistant_tokens
+        self.verify_batches = verify_batches
+        self.counts = dict.fromkeys(_COUNTERS, 0)
+
+    def _draft(self, cache, sequences, attention_mask, num_tokens):
+        """`num_tokens` greedy tokens of the draft model after `sequences`."""
+        tokens = sequences[:, cache.get_seq_length() :]
+        drafts = []
+        for _ in range(num_tokens):
+            logits = _forward(self.draft_model, cache, tokens, attention_mask)
+            tokens = logits[:, -1:].argmax(-1)
+            drafts.append(tokens)
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones(len(tokens), 1)], dim=-1
+            )
+        return torch.cat(drafts, dim=-1)
+
+    @torch.no_grad()
+    def _speculate(
+        self, model, input_ids, attention_mask, max_new_tokens, pad_id, stop
+    ):
+        device = input_ids.device
+        eos_ids = _eos_ids(model, device)
+        target_cache, draft_cache = DynamicCache(), DynamicCache()
+        sequences, mask = input_ids, attention_mask
+        unfinished = torch.ones(len(input_ids), dtype=torch.bool, device=device)
+        num_draft = self.num_assistant_tokens
+        new_tokens = _forward(model, target_cache, sequences, mask)[:, -1:].argmax(-1)
+        while True:
+            # finished rows are padded; an eos ends its row within the kept tokens
+            new_tokens = torch.where(unfinished[:, None], new_tokens, pad_id)
+            for step in range(new_tokens.shape[1]):
+                sequences = torch.cat([sequences, new_tokens[:, step : step + 1]], -1)
+                mask = torch.cat([mask, mask.new_ones(len(mask), 1)], dim=-1)
+                if eos_ids is not None:
+                    ended = torch.isin(new_tokens[:, step], eos_ids)
+                    new_tokens[ended, step + 1 :] = pad_id
+                    unfinished &= ~ended
+                if stop is not None and stop(sequences, None).all():
+                    unfinished[:] = False
+                if not unfinished.any():
+                    break
+            remaining = max_new_tokens - (sequences.shape[1] - input_ids.shape[1])
+            if not unfinished.any() or remaining <= 0:
+                return sequences[:, input_ids.shape[1] :]
+            num_draft = max(1, min(num_draft, remaining - 1))
+            if remaining == 1:
+                num_draft = 0
+            drafts = sequences.new_zeros(len(sequences), 0)
+            if num_draft:
+                drafts = self._draft(draft_cache, sequences, mask, num_draft)
+            # the last kept token is not in the target cache yet
+            logits = _forward(
+                model,
+                target_cache,
+                torch.cat([sequences[:, -1:], drafts], dim=-1),
+                torch.cat([mask, mask.new_ones(len(mask), num_draft)], dim=-1),
+            )
+            selected = logits.argmax(-1)
+            matches = ((drafts != selected[:, :-1]).cumsum(-1) == 0).sum(-1)
+            kept = int(matches[unfinished].min())
+            rows = int(unfinished.sum())
+            self.counts["drafted"] += num_draft * rows
+            self.counts["accepted"] += kept * rows
+            self.counts["generated"] += (kept + 1) * rows
+            self.counts["forwards"] += rows
+            new_tokens = selected[:, : kept + 1]
+            length = sequences.shape[1] + kept
+            target_cache.crop(length)
+            draft_cache.crop(min(draft_cache.get_seq_length(), length))
+            if num_draft and kept == num_draft:
+                num_draft += 2
+            else:
+                num_draft = max(1, num_draft - 1)
+
+    def generate(self, model, input_ids, attention_mask, generation_args, stop_fn):
+        """Generated tokens (batch, new tokens) of the left-padded prompts `input_ids`,
+        padded with `generation_args["pad_token_id"]` as by batched `generate`.
+        `stop_fn(prompt_length, batch_size)` builds stopping criteria, if any."""
+        unsupported = set(generation_args) - _GENERATION_ARGS
+        if unsupported:
+            raise ValueError(
+                f"Speculative decoding does not support generation args {unsupported}"
+            )
+        if generation_args.get("do_sample", False):
+            raise ValueError(
+                "Speculative decoding is only supported for greedy decoding"
+            )
+        pad_id = generation_args["pad_token_id"]
+        prompt_length, batch_size = input_ids.shape[1], input_ids.shape[0]
+
+        def plain_generate():
+            args = dict(generation_args)
+            if stop_fn is not None:
+                args["stopping_criteria"] = stop_fn(prompt_length, batch_size)
+            output = model.generate(input_ids, attention_mask=attention_mask, **args)
+            return output[:, prompt_length:]
+
+        if self.counts["mismatched"]:
+            self.counts["plain"] += 1
+            return plain_generate()
+        outputs = self._speculate(
+            model,
+            input_ids,
+            attention_mask,
+            generation_args["max_new_tokens"],
+            pad_id,
+            stop_fn(prompt_length, batch_size) if stop_fn is not None else None,
+        )
+        if (
+            self.verify_batches is not None
+            and self.counts["verified"] >= self.verify_batches
+        ):
+            self.counts["unverified"] += 1
+            return outputs
+        self.counts["verified"] += 1
+        reference = plain_generate()
+        width = max(outputs.shape[1], reference.shape[1])
+        padded = [
+            torch.nn.functional.pad(tokens, (0, width - tokens.shape[1]), value=pad_id)
+            for tokens in (outputs, reference)
+        ]
+        mismatched = int((padded[0] != padded[1]).any(dim=1).sum())
+        if mismatched:
+            logger.warning(
+                f"Speculative decoding differs from greedy decoding in {mismatched} "
+                "rows, generating the next batches without the draft model"
+            )
+        self.counts["mismatched"] += mismatched
+        return reference
+
+    def results(self):
+        """Statistics of the generations of all processes: the fraction of drafted
+        tokens kept, the tokens kept per row and target forward pass, the rows of the
+        verified batches differing from plain greedy decoding, the batches then
+        generated without the draft model, and the batches whose speculative outputs
+        were used unverified (none if the outputs are those of greedy decoding)."""
+        counts = dict.fromkeys(_COUNTERS, 0)
+        for process_counts in gather_objects(self.counts):
+            for key, value in process_counts.items():
+                counts[key] += value
+        return {
+            "acceptance_rate": counts["accepted"] / counts["drafted"]
+            if counts["drafted"]
+            else None,
+            "tokens_per_forward": counts["generated"] / counts["forwards"]
+            if counts["forwards"]
+            else None,
+            "drafted_tokens": counts["drafted"],
+            "accepted_tokens": counts["accepted"],
+            "verified_batches": counts["verified"],
+            "mismatched_rows": counts["mismatched"],
+            "plain_batches": counts["plain"],
+            "unverified_batches": counts["unverified"],
+        }
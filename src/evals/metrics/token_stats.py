@@ -0,0 +1,256 @@
+"""
+Shared per-token statistics of a model over a dataset, computed in a single forward pass
+and reused by all metrics that only need labeled-token log-probs (probability, EM, ES,
+LOSS/zlib/Min-K/Min-K++ attacks).
+"""
+
+import json
+import hashlib
+import logging
+import weakref
+from typing import Callable, Dict
+
+import torch
+from transformers import PreTrainedTokenizerBase
+
+from evals.metrics.utils import (
+    batchwise_probe,
+    get_eval_dataloader,
+    run_batchwise_evals,
+    tokenwise_argmax,
+    tokenwise_logprob_stats,
+)
+
+logger = logging.getLogger("metrics")
+
+# dtypes of the statistics, restored from checkpointed JSON values
+_STAT_DTYPES = {
+    "target_log_probs": torch.float32,
+    "argmax_match": torch.bool,
+    "mean_log_probs": torch.float32,
+    "var_log_probs": torch.float32,
+    "labels": torch.long,
+}
+
+
+def batch_token_stats(model, batch, vocab_chunk_size=None, shared_prefix=None):
+    """Compute compact next-token statistics for every labeled token of each sample.
+
+    Returns:
+        List[Dict[str, Tensor]]: For each sample, CPU tensors of size N (labeled tokens,
+        including the final eos) with keys `target_log_probs`, `argmax_match`,
+        `mean_log_probs`, `var_log_probs` and `labels`.
+    """
+    stats_batch = tokenwise_logprob_stats(
+        model, batch, vocab_chunk_size=vocab_chunk_size, shared_prefix=shared_prefix
+    )
+    return [
+        {
+            "target_log_probs": stats["target_log_probs"].float().cpu(),
+            "argmax_match": (stats["argmax"] == stats["labels"]).cpu(),
+            "mean_log_probs": stats["mean_log_probs"].float().cpu(),
+            "var_log_probs": stats["var_log_probs"].float().cpu(),
+            "labels": stats["labels"].cpu(),
+        }
+        for stats in stats_batch
+    ]
+
+
+def batch_argmax_matches(model, batch, vocab_chunk_size=None, shared_prefix=None):
+    """The `argmax_match` and `labels` statistics of `batch_token_stats` alone, from
+    an argmax over the logits of labeled positions (see `tokenwise_argmax`)."""
+    argmax_batch = tokenwise_argmax(
+        model, batch, vocab_chunk_size=vocab_chunk_size, shared_prefix=shared_prefix
+    )
+    return [
+        {
+            "argmax_match": (stats["argmax"] == stats["labels"]).cpu(),
+            "labels": stats["labels"].cpu(),
+        }
+        for stats in argmax_batch
+    ]
+
+
+def _stats_from_json(stats):
+    return {
+        key: torch.tensor(values, dtype=_STAT_DTYPES[key])
+        for key, values in stats.items()
+    }
+
+
+def compute_token_stats(
+    model,
+    data,
+    collator,
+    batch_size,
+    vocab_chunk_size=None,
+    batching=None,
+    shared_prefix=None,
+    argmax_only=False,
+    checkpoint=None,
+):
+    """Run one pass over `data` and return token statistics by data index, laid out like
+    `run_batchwise_evals` results ({idx: {stat: [...]}} for multi-answer datasets).
+    A `shared_prefix` of all samples is read from its KV cache instead of recomputed.
+    With `argmax_only`, only `argmax_match` and `labels` are computed. With a
+    `MetricCheckpoint`, statistics are stored in a shard named after the dataset and
+    collator, since whether the pass runs depends on the statistics already cached."""
+    kind = "argmax" if argmax_only else "token_stats"
+    shard_name = f"{kind}-{_fingerprint(data)[:16]}-{_fingerprint(collator)[:16]}"
+    if shared_prefix is not None:
+        collator = shared_prefix.collator(collator)
+    batch_fn = batch_argmax_matches if argmax_only else batch_token_stats
+    fun_args = {"vocab_chunk_size": vocab_chunk_size, "shared_prefix": shared_prefix}
+    dataloader = get_eval_dataloader(
+        data,
+        collator,
+        batch_size,
+        batching=batching,
+        model=model,
+        kind=[kind, vocab_chunk_size],
+        probe_fn=batchwise_probe(model, batch_fn, fun_args),
+    )
+    return run_batchwise_evals(
+        model,
+        dataloader,
+        batch_fn,
+        fun_args,
+        "Calculating argmax" if argmax_only else "Calculating token statistics",
+        checkpoint=checkpoint,
+        shard_name=shard_name,
+        restore_fn=_stats_from_json,
+    )
+
+
+def map_token_stats(
+    stats_by_index: Dict, fn: Callable[[Dict], Dict], batched: bool = False
+) -> Dict:
+    """Apply `fn` to the token statistics of each item. Items of multi-answer datasets
+    are mapped per answer and regrouped as {stat: [...]}, the layout of `dict_transpose`.
+    With `batched`, `fn` maps the list of statistics of all samples (answers) at once
+    to the list of their results."""
+    samples = []
+    for stats in stats_by_index.values():
+        if isinstance(stats["labels"], list):
+            samples.extend(
+                {key: values[i] for key, values in stats.items()}
+                for i in range(len(stats["labels"]))
+            )
+        else:
+            samples.append(stats)
+    outputs = iter(fn(samples) if batched else map(fn, samples))
+    results = {}
+    for idx, stats in stats_by_index.items():
+        if isinstance(stats["labels"], list):
+            per_answer = [next(outputs) for _ in stats["labels"]]
+            results[idx] = {key: [r[key] for r in per_answer] for key in per_answer[0]}
+        else:
+            results[idx] = next(outputs)
+    return results
+
+
+def _fingerprint(obj):
+    """Content fingerprint of a dataset or collator from its configuration attributes."""
+    state = {}
+    for key, value in vars(obj).items():
+        if hasattr(value, "_fingerprint"):  # HF datasets.Dataset
+            state[key] = value._fingerprint
+        elif isinstance(value, PreTrainedTokenizerBase):
+            state[key] = [value.name_or_path, len(value)]
+        else:
+            state[key] = value
+    payload = json.dumps([type(obj).__name__, state], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _model_state(model):
+    """Cheap token identifying the current weights of a model: parameter version counters
+    are bumped by every in-place update (e.g. optimizer steps between in-training evals)."""
+    return sum(param._version for param in model.parameters())
+
+
+class TokenStatsCache:
+    """Cache of token statistics per (model state, dataset, collator).
+
+    Metrics request statistics through `get`; the first request runs the forward pass
+    and later requests for the same model weights, dataset and collator reuse it.
+    Statistics of a model are dropped as soon as its weights change."""
+
+    def __init__(self):
+        self._models = {}
+
+    def _model_entries(self, model):
+        state = _model_state(model)
+        slot = self._models.get(id(model))
+        if slot is None or slot["ref"]() is not model or slot["state"] != state:
+            slot = {"ref": weakref.ref(model), "state": state, "entries": {}}
+            self._models[id(model)] = slot
+        return slot["entries"]
+
+    def get(
+        self,
+        model,
+        data,
+        collator,
+        batch_size,
+        vocab_chunk_size=None,
+        batching=None,
+        shared_prefix=None,
+        argmax_only=False,
+        checkpoint=None,
+    ):
+        entries = self._model_entries(model)
+        key = (_fingerprint(data), _fingerprint(collator))
+        if key in entries:
+            logger.info("Reusing cached token statistics")
+            return entries[key]
+        # argmax-only statistics are kept apart: full statistics also serve them
+        if argmax_only:
+            key = key + ("argmax",)
+            if key in entries:
+                logger.info("Reusing cached argmax statistics")
+                return entries[key]
+        stats_by_index = compute_token_stats(
+            model,
+            data,
+            collator,
+            batch_size,
+            vocab_chunk_size=vocab_chunk_size,
+            batching=batching,
+            shared_prefix=shared_prefix,
+            argmax_only=argmax_only,
+            checkpoint=checkpoint,
+        )
+        entries[key] = stats_by_index
+        return stats_by_index
+
+    def clear(self):
+        self._models.clear()
+
+
+def get_token_stats(
+    model,
+    data,
+    collator,
+    batch_size,
+    stats_cache=None,
+    vocab_chunk_size=None,
+    batching=None,
+    shared_prefix=None,
+    argmax_only=False,
+    checkpoint=None,
+):
+    """Token statistics for `data`, served from `stats_cache` when one is provided. A
+    pass that runs is checkpointed with the metric's `checkpoint`, if any."""
+    compute_fn = compute_token_stats if stats_cache is None else stats_cache.get
+    return compute_fn(
+        model,
+        data,
+        collator,
+        batch_size,
+        vocab_chunk_size=vocab_chunk_size,
+        batching=batching,
+        shared_prefix=shared_prefix,
+        argmax_only=argmax_only,
+        checkpoint=checkpoint,
+    )
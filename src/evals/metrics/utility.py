@@ -3,14 +3,15 @@ import numpy as np
 import scipy as sc
 from tqdm import tqdm
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
 
-from evals.metrics.utils import aggregate_to_1D
+from evals.distributed import gather_objects, is_main_process
+from evals.metrics.utils import aggregate_to_1D, get_eval_dataloader
 from evals.metrics.base import unlearning_metric
+from evals.metrics.bootstrap import mean_results
+from evals.metrics.model_pool import get_classifier
 
 
-@unlearning_metric(name="hm_aggregate")
+@unlearning_metric(name="hm_aggregate", cpu_only=True)
 def hm_aggregate(model, **kwargs):
     values = [result["agg_value"] for _, result in kwargs["pre_compute"].items()]
     return {"agg_value": sc.stats.hmean(values)}
@@ -26,34 +27,49 @@ def classifier_prob(model, **kwargs):
     classifier_tokenization_args = kwargs["classifier_tokenization_args"]
     device = kwargs.get("device", "cuda")
 
-    tokenizer = AutoTokenizer.from_pretrained(**classifier_tokenization_args)
-    classifier = AutoModelForSequenceClassification.from_pretrained(
-        **classifier_model_args
-    ).to(device)
+    tokenizer, classifier = get_classifier(
+        classifier_model_args,
+        classifier_tokenization_args,
+        device=device,
+        int8=kwargs.get("int8", False),
+    )
 
     data = kwargs["pre_compute"]["text"]["value_by_index"]
+    texts = {int(key): entry[text_key] for key, entry in data.items()}
+    encodings = tokenizer(list(texts.values()), truncation=True, max_length=max_length)[
+        "input_ids"
+    ]
     data_list = [
-        {"text": entry[text_key], "index": int(key)} for key, entry in data.items()
+        {"input_ids": input_ids, "index": idx}
+        for idx, input_ids in zip(texts, encodings)
     ]
 
-    # Create DataLoader
-    dataloader = DataLoader(data_list, batch_size=batch_size, shuffle=False)
-
-    scores_by_index = {}
-    for batch in tqdm(dataloader):
-        batch_texts = batch["text"]
-        batch_indices = batch["index"].tolist()
-
-        # Tokenize the batch of texts
-        inputs = tokenizer(
-            batch_texts,
+    def collate(items):
+        batch = tokenizer.pad(
+            {"input_ids": [item["input_ids"] for item in items]},
             return_tensors="pt",
-            padding=True,
-            truncation=True,
-            max_length=max_length,
             return_attention_mask=True,
         )
-        inputs = {k: v.to(device) for k, v in inputs.items()}
+        batch["index"] = torch.tensor([item["index"] for item in items])
+        return batch
+
+    # batches of texts of similar token lengths, always: results are keyed by index
+    batching = {
+        "length_bucketing": True,
+        "max_tokens": (kwargs.get("batching", None) or {}).get("max_tokens", None),
+    }
+    dataloader = get_eval_dataloader(
+        data_list,
+        collate,
+        batch_size,
+        batching=batching,
+        lengths=[len(input_ids) for input_ids in encodings],
+    )
+
+    scores_by_index = {}
+    for batch in tqdm(dataloader, disable=not is_main_process()):
+        batch_indices = batch.pop("index").tolist()
+        inputs = {k: v.to(device) for k, v in batch.items()}
 
         # Run the classifier
         with torch.no_grad():
@@ -62,9 +78,16 @@ def classifier_prob(model, **kwargs):
         scores = F.softmax(outputs.logits, dim=-1)[:, class_id].cpu().numpy().tolist()
 
         # Map predictions to labels
-        for idx, prob, text in zip(batch_indices, scores, batch_texts):
+        for idx, prob in zip(batch_indices, scores):
             # Add the prediction to the original data
-            scores_by_index[idx] = {"score": prob, text_key: text}
+            scores_by_index[idx] = {"score": prob, text_key: texts[idx]}
+    # merge the scores of all data-parallel processes and restore index order
+    scores_by_index = {
+        idx: scores
+        for part in gather_objects(scores_by_index)
+        for idx, scores in part.items()
+    }
+    scores_by_index = dict(sorted(scores_by_index.items()))
     class_scores = np.array(
         [
             evals["score"]
@@ -73,4 +96,4 @@ def classifier_prob(model, **kwargs):
         ]
     )
     class_scores = aggregate_to_1D(class_scores)
-    return {"agg_value": np.mean(class_scores), "value_by_index": scores_by_index}
+    return mean_results(class_scores, scores_by_index, kwargs)
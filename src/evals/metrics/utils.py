@@ -1,16 +1,31 @@
+import copy
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, partial
 from typing import List
 from tqdm import tqdm
-from rouge_score import rouge_scorer
-from collections import defaultdict
+from collections import defaultdict, deque
 from omegaconf import OmegaConf
 import numpy as np
 import scipy as sc
 from torch import nn
 import torch
+from torch.utils.data import BatchSampler, DataLoader, SequentialSampler
 from transformers import StoppingCriteria, StoppingCriteriaList, PreTrainedTokenizer
 from data.utils import IGNORE_INDEX
+from data.samplers import (
+    LengthBucketedBatchSampler,
+    ShardedBatchSampler,
+    get_lengths,
+    get_sizes,
+)
+from evals.distributed import gather_objects, get_rank, get_world_size, is_main_process
+from evals.metrics.batch_size import AutoBatchSize, evaluate_with_backoff
+from evals.metrics.rouge_scoring import get_rouge_engine
 import warnings
 
+logger = logging.getLogger("metrics")
+
 
 def dict_transpose(evals):
     """Transpose a nested dictionary structure to group statistics by item indices."""
@@ -41,15 +56,176 @@ def get_forget_quality(model_tr, reference_tr):
     return {"agg_value": test_res.pvalue}
 
 
-def run_batchwise_evals(model, dataloader, batch_eval_fn, batch_eval_fn_args, eval_msg):
+class FlattenedAnswersCollator:
+    """Wraps a collator to collate multi-answer items ({intra_item_idx: sample}) into a
+    single batch holding every answer of every item, instead of one batch per
+    intra_item_idx. `batch["intra_item_idx"]` lists the intra_item_idx of each row."""
+
+    def __init__(self, collator):
+        self.collator = collator
+
+    def __call__(self, instances):
+        if not all(
+            isinstance(sample, dict) and "input_ids" in sample
+            for sample in instances[0].values()
+        ):  # single-sample items, or anything else than answer variants
+            return self.collator(instances)
+        samples, intra_item_idxs = [], []
+        for instance in instances:
+            for intra_item_idx, sample in instance.items():
+                samples.append(sample)
+                intra_item_idxs.append(intra_item_idx)
+        batch = self.collator(samples)
+        batch["intra_item_idx"] = intra_item_idxs
+        return batch
+
+
+def get_eval_dataloader(
+    data,
+    collator,
+    batch_size,
+    batching=None,
+    lengths=None,
+    model=None,
+    kind=None,
+    probe_fn=None,
+):
+    """Build the DataLoader used by evaluation metrics.
+
+    `batching` (the evaluator's `batching` config) optionally enables length bucketing:
+    `{"length_bucketing": true, "max_tokens": 16384}` groups items of similar length
+    into batches of at most `batch_size` items and `max_tokens` padded tokens.
+    Bucketed batches do not follow dataset order, so results must be keyed by index.
+    Under data-parallel evaluation, each process gets a share of the batches.
+    `{"flatten_answers": true}` collates all answers of multi-answer items into one
+    batch (see `FlattenedAnswersCollator`), counted sample by sample in `max_tokens`.
+    `lengths` overrides the token lengths of items (computed from `data` otherwise).
+    `batch_size: auto` picks the batch size for the pass of `kind` of `model` (see
+    `AutoBatchSize`), attached to the dataloader as `auto_batch_size`. It is probed
+    with `probe_fn`, which runs the pass on a collated batch, if given."""
+    batching = batching or {}
+    if batch_size == "auto" and lengths is None:
+        lengths = get_lengths(data)
+    flatten_answers = batching.get("flatten_answers", False)
+    if flatten_answers:
+        collator = FlattenedAnswersCollator(collator)
+    probe = None
+    if probe_fn is not None and batch_size == "auto" and lengths:
+        longest = data[int(np.argmax(lengths))]
+
+        def probe(size):
+            probe_fn(collator([longest] * size))
+
+    auto = AutoBatchSize.resolve(
+        batch_size,
+        model=model,
+        kind=kind,
+        lengths=lengths,
+        batching=batching,
+        probe=probe,
+    )
+    batch_size = auto.size
+    if batching.get("length_bucketing", False):
+        max_tokens = batching.get("max_tokens", None)
+        batch_sampler = LengthBucketedBatchSampler(
+            lengths if lengths is not None else get_lengths(data),
+            batch_size=batch_size,
+            max_tokens=max_tokens,
+            sizes=get_sizes(data) if flatten_answers and max_tokens else None,
+        )
+        logger.info(
+            f"Length-bucketed batching: {len(batch_sampler)} batches, "
+            f"expected padding efficiency {batch_sampler.padding_efficiency():.1%}"
+        )
+    else:
+        batch_sampler = BatchSampler(
+            SequentialSampler(data), batch_size=batch_size, drop_last=False
+        )
+    if get_world_size() > 1:
+        # data-parallel evaluation: each process runs its share of the batches
+        batch_sampler = ShardedBatchSampler(batch_sampler, get_world_size(), get_rank())
+    dataloader = DataLoader(data, batch_sampler=batch_sampler, collate_fn=collator)
+    dataloader.auto_batch_size = auto
+    return dataloader
+
+
+def count_padding(batch):
+    """Return (non-padding tokens, padded tokens) of a collated batch."""
+    attention_mask = batch["attention_mask"]
+    return int(attention_mask.sum()), attention_mask.numel()
+
+
+def batchwise_probe(model, batch_eval_fn, batch_eval_fn_args):
+    """Probe function (see `get_eval_dataloader`) running `batch_eval_fn` on every
+    mini-batch of a collated batch, as `run_batchwise_evals` does."""
+
+    def probe(batch):
+        if "input_ids" in batch:
+            batch.pop("intra_item_idx", None)
+            batch = {"0": batch}
+        for mini_batch in batch.values():
+            mini_batch.pop("index", None)
+            result = batch_eval_fn(model=model, batch=mini_batch, **batch_eval_fn_args)
+            if isinstance(result, Future):
+                result.result()
+
+    return probe
+
+
+def run_batchwise_evals(
+    model,
+    dataloader,
+    batch_eval_fn,
+    batch_eval_fn_args,
+    eval_msg,
+    checkpoint=None,
+    max_pending=0,
+    shard_name=None,
+    restore_fn=None,
+):
     """Run batch-wise evaluations on a dataset using a specified evaluation function. Handles
-    multi-answer datasets by organizing evaluations by answer indices and aggregating results."""
+    multi-answer datasets by organizing evaluations by answer indices and aggregating results.
+    Results are returned in data index order, whatever order the dataloader batches in.
+    With a `MetricCheckpoint`, results are stored as batches finish (in the shard named
+    `shard_name`, if given) and batches whose results are already stored are skipped;
+    `restore_fn` converts a stored result back from its JSON values. Under data-parallel
+    evaluation, results of all processes are gathered on every process.
+    `batch_eval_fn` may return a Future of a batch's results (e.g. post-processed in a
+    worker thread); the next batches are then evaluated while up to `max_pending` of
+    them are unfinished, and results are stored in batch order.
+    Batches running out of GPU memory are evaluated again in smaller parts (see
+    `evaluate_with_backoff`)."""
     evals = defaultdict(dict)
-    for batch in tqdm(dataloader, desc=eval_msg, total=len(dataloader)):
+    auto = getattr(dataloader, "auto_batch_size", None)
+    shard = checkpoint.shard(shard_name) if checkpoint is not None else None
+    real_tokens, padded_tokens = 0, 0
+    pending = deque()  # (keys, results or Future of results) of each batch, in order
+
+    def store(keys, batch_evals, new):
+        if isinstance(batch_evals, Future):
+            batch_evals = batch_evals.result()
+        if new and shard is not None:
+            shard.append(
+                (iidx, idx, row_evals)
+                for (iidx, idx), row_evals in zip(keys, batch_evals)
+            )
+        for (iidx, idx), row_evals in zip(keys, batch_evals):
+            assert (
+                idx not in evals[iidx]
+            ), "Data indices repeated while iterating dataloader"
+            evals[iidx][idx] = row_evals
+
+    for batch in tqdm(
+        dataloader, desc=eval_msg, total=len(dataloader), disable=not is_main_process()
+    ):
         # if data arrives in normal format we convert the batch to multiple answer-style
         # like in tofu_perturbed by adding a fake intra_item_index
         if "input_ids" in batch:
+            # flattened multi-answer batches tag each row with its intra_item_idx
+            intra_item_idxs = batch.pop("intra_item_idx", None)
             batch = {"0": batch}
+        else:
+            intra_item_idxs = None
         # Assume batch like {"0": {"input_ids": [[]]..., "index": [453, 454..]},
         #                    "1": {"input_ids": [[]]..., "index": [453, 454..]}..}
         assert isinstance(next(iter(batch.values())), dict) and "input_ids" in next(
@@ -59,14 +235,49 @@ def run_batchwise_evals(model, dataloader, batch_eval_fn, batch_eval_fn_args, ev
             data_indices = (
                 mini_batch.pop("index").cpu().numpy().tolist()
             )  # data item indices
-            batch_evals = batch_eval_fn(
-                model=model, batch=mini_batch, **batch_eval_fn_args
-            )
-            indexwise_batch_evals = dict(zip(data_indices, batch_evals))
-            assert not (
-                evals[intra_item_idx].keys() & indexwise_batch_evals.keys()
-            ), "Data indices repeated while iterating dataloader"
-            evals[intra_item_idx] |= indexwise_batch_evals
+            row_iidxs = intra_item_idxs or [intra_item_idx] * len(data_indices)
+            keys = list(zip(row_iidxs, data_indices))
+            if shard is not None and shard.done(keys):
+                stored = [shard.results[key] for key in keys]
+                if restore_fn is not None:
+                    stored = [restore_fn(result) for result in stored]
+                pending.append((keys, stored, False))
+            else:
+                real, padded = count_padding(mini_batch)
+                real_tokens, padded_tokens = real_tokens + real, padded_tokens + padded
+                batch_evals = evaluate_with_backoff(
+                    lambda rows: batch_eval_fn(
+                        model=model, batch=rows, **batch_eval_fn_args
+                    ),
+                    mini_batch,
+                    auto or AutoBatchSize(len(data_indices)),
+                )
+                pending.append((keys, batch_evals, True))
+            # store finished batches, and wait for the oldest beyond max_pending
+            while pending and (
+                len(pending) > max_pending
+                or not isinstance(pending[0][1], Future)
+                or pending[0][1].done()
+            ):
+                store(*pending.popleft())
+    while pending:
+        store(*pending.popleft())
+    if auto is not None:
+        auto.save()
+    if get_world_size() > 1:
+        parts = gather_objects((dict(evals), real_tokens, padded_tokens))
+        evals, real_tokens, padded_tokens = defaultdict(dict), 0, 0
+        for part_evals, real, padded in parts:
+            for intra_item_idx, iidx_evals in part_evals.items():
+                evals[intra_item_idx] |= iidx_evals
+            real_tokens, padded_tokens = real_tokens + real, padded_tokens + padded
+    if padded_tokens:
+        logger.info(f"Padding efficiency: {real_tokens / padded_tokens:.1%}")
+    # restore data index order
+    evals = {
+        intra_item_idx: dict(sorted(iidx_evals.items()))
+        for intra_item_idx, iidx_evals in evals.items()
+    }
     # evals looks like {iidx0: {idx453: {prob: 0.1, loss: 1}},
     #                   iidx1: {idx453: {prob: 0.2, loss: 2}}}
     if len(evals) == 1:  # normal single answer dataset, no need for list
@@ -79,20 +290,238 @@ def run_batchwise_evals(model, dataloader, batch_eval_fn, batch_eval_fn_args, ev
     return evals
 
 
-def evaluate_probability(model, batch):
-    """Evaluate model probabilities and average token-level loss for a given batch."""
+def _supports_selective_projection(model):
+    """Selective scoring needs access to the decoder stack and a plain linear lm_head."""
+    if not (hasattr(model, "get_decoder") and hasattr(model, "get_output_embeddings")):
+        return False
+    config = getattr(model, "config", None)
+    if getattr(config, "final_logit_softcapping", None) is not None:
+        return False
+    return isinstance(model.get_output_embeddings(), nn.Linear)
+
+
+def labeled_hidden_states(model, batch, shared_prefix=None):
+    """Run only the decoder stack and gather final hidden states at positions whose
+    next token is labeled. Batches collated without a `SharedPrefix` attend to its cache.
+
+    Returns:
+        hidden (Tensor): (P, H) hidden states, P being the number of labeled targets in the batch
+        targets (Tensor): (P,) next-token ids predicted from each hidden state
+        counts (Tensor): (bsz,) number of labeled targets in each sample
+    """
+    decoder = model.get_decoder()
+    model_inputs = {"attention_mask": batch.get("attention_mask")}
+    if shared_prefix is not None:
+        model_inputs = shared_prefix.model_inputs(model, batch["attention_mask"])
+    outputs = decoder(input_ids=batch["input_ids"], **model_inputs)
+    shifted_labels = batch["labels"][:, 1:]
+    mask = shifted_labels != IGNORE_INDEX
+    hidden = outputs[0][:, :-1][mask]
+    return hidden, shifted_labels[mask], mask.sum(-1)
+
+
+def chunked_lm_head_stats(hidden, lm_head, targets, vocab_chunk_size):
+    """Project hidden states through lm_head one vocab chunk at a time, combining chunks
+    with a streaming logsumexp so that the full (P, V) logits are never materialized.
+
+    Each chunk contributes its logsumexp, the mean and variance of its logits under the
+    chunk-normalized distribution, and its max logit. Chunk statistics are merged
+    with the softmax weights of the chunk logsumexps. The combination is differentiable,
+    so this also serves gradient-based metrics.
+
+    Returns:
+        Dict[str, Tensor]: (P,) tensors `target_log_probs`, `mean_log_probs` (i.e.
+        sum_v p_v log p_v, the negative entropy), `var_log_probs` (variance of log p_v
+        under p) and `argmax`.
+    """
+    weight, bias = lm_head.weight, lm_head.bias
+    vocab_size = weight.shape[0]
+    target_logits = hidden.new_zeros(hidden.shape[0], dtype=torch.float32)
+    chunk_lses, chunk_means, chunk_vars, chunk_maxes, chunk_argmaxes = (
+        [],
+        [],
+        [],
+        [],
+        [],
+    )
+    for start in range(0, vocab_size, vocab_chunk_size):
+        end = min(start + vocab_chunk_size, vocab_size)
+        logits = nn.functional.linear(
+            hidden, weight[start:end], None if bias is None else bias[start:end]
+        ).float()
+        lse = torch.logsumexp(logits, dim=-1)
+        probs = torch.exp(logits - lse.unsqueeze(-1))
+        mean = (probs * logits).sum(-1)
+        var = (probs * torch.square(logits - mean.unsqueeze(-1))).sum(-1)
+        max_logits, max_idx = logits.max(dim=-1)
+        in_chunk = (targets >= start) & (targets < end)
+        local_targets = (targets - start).clamp(0, end - start - 1).unsqueeze(-1)
+        gathered = logits.gather(1, local_targets).squeeze(-1)
+        target_logits = target_logits + torch.where(
+            in_chunk, gathered, torch.zeros_like(gathered)
+        )
+        chunk_lses.append(lse)
+        chunk_means.append(mean)
+        chunk_vars.append(var)
+        chunk_maxes.append(max_logits)
+        chunk_argmaxes.append(max_idx + start)
+
+    chunk_lses = torch.stack(chunk_lses, dim=-1)  # P x n_chunks
+    lse = torch.logsumexp(chunk_lses, dim=-1)
+    chunk_weights = torch.exp(chunk_lses - lse.unsqueeze(-1))
+    chunk_means = torch.stack(chunk_means, dim=-1)
+    mean = (chunk_weights * chunk_means).sum(-1)
+    # law of total variance, written around the global mean for numerical stability
+    var = (
+        chunk_weights
+        * (
+            torch.stack(chunk_vars, dim=-1)
+            + torch.square(chunk_means - mean.unsqueeze(-1))
+        )
+    ).sum(-1)
+    # first chunk attaining the max, matching torch.argmax over the full vocab
+    best_chunk = torch.stack(chunk_maxes, dim=-1).argmax(dim=-1, keepdim=True)
+    argmax = torch.stack(chunk_argmaxes, dim=-1).gather(1, best_chunk).squeeze(-1)
+    return {
+        "target_log_probs": target_logits - lse,
+        "mean_log_probs": mean - lse,
+        "var_log_probs": var,
+        "argmax": argmax,
+    }
+
+
+def _full_logits_stats(model, batch, shared_prefix=None):
+    """Reference path computing the same statistics as `chunked_lm_head_stats` from
+    the full logits of a regular model forward."""
+    model_inputs = {k: v for k, v in batch.items() if k != "labels"}
+    if shared_prefix is not None:
+        model_inputs |= shared_prefix.model_inputs(model, batch["attention_mask"])
+    logits = model(**model_inputs).logits[:, :-1]
+    shifted_labels = batch["labels"][:, 1:]
+    mask = shifted_labels != IGNORE_INDEX
+    targets = shifted_labels[mask]
+    # only labeled positions go through log_softmax
+    log_probs = torch.nn.functional.log_softmax(logits[mask].float(), dim=-1)
+    probs = torch.exp(log_probs)
+    mean = (probs * log_probs).sum(-1)
+    var = (probs * torch.square(log_probs - mean.unsqueeze(-1))).sum(-1)
+    stats = {
+        "target_log_probs": log_probs.gather(1, targets.unsqueeze(-1)).squeeze(-1),
+        "mean_log_probs": mean,
+        "var_log_probs": var,
+        "argmax": log_probs.argmax(dim=-1),
+    }
+    return stats, targets, mask.sum(-1)
+
+
+def tokenwise_logprob_stats(
+    model, batch, vocab_chunk_size=None, grad=False, shared_prefix=None
+):
+    """Compute next-token statistics at every labeled position of each sample in a batch.
+
+    With `vocab_chunk_size` set (and a model exposing its decoder and a linear lm_head),
+    hidden states are gathered at labeled positions only and projected through lm_head
+    in vocab chunks (see `chunked_lm_head_stats`). Otherwise the statistics are derived
+    from the full logits of a regular forward pass. Batches collated without a
+    `shared_prefix` (see `SharedPrefix.collator`) attend to its KV cache.
+
+    Returns:
+        stats_batch (List[Dict[str, Tensor]]): For each sample, tensors of size N (number
+        of labeled tokens, including the final eos) with keys `target_log_probs`,
+        `mean_log_probs`, `var_log_probs`, `argmax` and `labels`.
+    """
+    batch = {k: v.to(model.device) for k, v in batch.items()}
+    with torch.set_grad_enabled(grad):
+        if vocab_chunk_size and _supports_selective_projection(model):
+            hidden, targets, counts = labeled_hidden_states(
+                model, batch, shared_prefix=shared_prefix
+            )
+            stats = chunked_lm_head_stats(
+                hidden, model.get_output_embeddings(), targets, vocab_chunk_size
+            )
+        else:
+            stats, targets, counts = _full_logits_stats(
+                model, batch, shared_prefix=shared_prefix
+            )
+    stats["labels"] = targets
+    counts = counts.tolist()
+    split_stats = {k: torch.split(v, counts) for k, v in stats.items()}
+    return [{k: split_stats[k][i] for k in split_stats} for i in range(len(counts))]
+
+
+def tokenwise_argmax(model, batch, vocab_chunk_size=None, shared_prefix=None):
+    """Argmax next-token prediction at every labeled position of each sample in a batch,
+    taken on the logits of labeled positions directly, without normalizing them.
+    With `vocab_chunk_size`, labeled hidden states are projected one vocab chunk at a
+    time as in `tokenwise_logprob_stats`.
+
+    Returns:
+        List[Dict[str, Tensor]]: For each sample, tensors of size N (number of labeled
+        tokens, including the final eos) with keys `argmax` and `labels`.
+    """
     batch = {k: v.to(model.device) for k, v in batch.items()}
     with torch.no_grad():
-        output = model(**batch)
-    logits = output.logits
-    labels = batch["labels"]
-    shifted_labels = labels[..., 1:].contiguous()
-    logits = logits[..., :-1, :].contiguous()
-    loss_function = nn.CrossEntropyLoss(ignore_index=IGNORE_INDEX, reduction="none")
-    # agg loss across tokens
-    losses = loss_function(logits.transpose(-1, -2), shifted_labels).sum(dim=-1)
-    num_token_gt = (batch["labels"] != IGNORE_INDEX).sum(-1)
-    avg_losses = losses / num_token_gt
+        if vocab_chunk_size and _supports_selective_projection(model):
+            hidden, targets, counts = labeled_hidden_states(
+                model, batch, shared_prefix=shared_prefix
+            )
+            lm_head = model.get_output_embeddings()
+            weight, bias = lm_head.weight, lm_head.bias
+            max_logits, argmax = None, None
+            for start in range(0, weight.shape[0], vocab_chunk_size):
+                end = min(start + vocab_chunk_size, weight.shape[0])
+                chunk_max, chunk_argmax = nn.functional.linear(
+                    hidden, weight[start:end], None if bias is None else bias[start:end]
+                ).max(dim=-1)
+                if max_logits is None:
+                    max_logits, argmax = chunk_max, chunk_argmax
+                else:
+                    # strictly greater: the first chunk attaining the max wins
+                    better = chunk_max > max_logits
+                    max_logits = torch.where(better, chunk_max, max_logits)
+                    argmax = torch.where(better, chunk_argmax + start, argmax)
+        else:
+            model_inputs = {k: v for k, v in batch.items() if k != "labels"}
+            if shared_prefix is not None:
+                model_inputs |= shared_prefix.model_inputs(
+                    model, batch["attention_mask"]
+                )
+            logits = model(**model_inputs).logits[:, :-1]
+            shifted_labels = batch["labels"][:, 1:]
+            mask = shifted_labels != IGNORE_INDEX
+            targets, counts = shifted_labels[mask], mask.sum(-1)
+            argmax = logits[mask].argmax(dim=-1)
+    counts = counts.tolist()
+    return [
+        {"argmax": sample_argmax, "labels": sample_labels}
+        for sample_argmax, sample_labels in zip(
+            torch.split(argmax, counts), torch.split(targets, counts)
+        )
+    ]
+
+
+def evaluate_probability(model, batch, vocab_chunk_size=None):
+    """Evaluate model probabilities and average token-level loss for a given batch."""
+    if vocab_chunk_size:
+        stats_batch = tokenwise_logprob_stats(
+            model, batch, vocab_chunk_size=vocab_chunk_size
+        )
+        avg_losses = torch.stack(
+            [-stats["target_log_probs"].mean() for stats in stats_batch]
+        )
+    else:
+        batch = {k: v.to(model.device) for k, v in batch.items()}
+        with torch.no_grad():
+            output = model(**batch)
+        logits = output.logits
+        labels = batch["labels"]
+        shifted_labels = labels[..., 1:].contiguous()
+        logits = logits[..., :-1, :].contiguous()
+        loss_function = nn.CrossEntropyLoss(ignore_index=IGNORE_INDEX, reduction="none")
+        # agg loss across tokens
+        losses = loss_function(logits.transpose(-1, -2), shifted_labels).sum(dim=-1)
+        num_token_gt = (batch["labels"] != IGNORE_INDEX).sum(-1)
+        avg_losses = losses / num_token_gt
     normalized_probs = torch.exp(-avg_losses)
 
     avg_losses = avg_losses.cpu().numpy().tolist()
@@ -103,24 +532,32 @@ def evaluate_probability(model, batch):
     ]
 
 
-def tokenwise_logprobs(model, batch, grad=False, return_labels=False):
+def tokenwise_logprobs(
+    model, batch, grad=False, return_labels=False, vocab_chunk_size=None
+):
     """
     Compute token-wise next token prediction logprobs for all labeled tokens for each sample in a batch.
     `grad` decides whether gradients are turned on
+    `vocab_chunk_size` enables selective, vocab-chunked scoring (see `tokenwise_logprob_stats`)
     Returns
     log_probs_batch (List[Tensor]): Tensors of size seq_len where seq_len is length of labeled tokens
     labels_batch (List[Tensor]): List of tensors of length N. Returned only if return_labels is True
     """
+    if vocab_chunk_size:
+        stats_batch = tokenwise_logprob_stats(
+            model, batch, vocab_chunk_size=vocab_chunk_size, grad=grad
+        )
+        # [:-1] to ignore eos prediction
+        log_probs_batch = [stats["target_log_probs"][:-1] for stats in stats_batch]
+        labels_batch = [stats["labels"][:-1] for stats in stats_batch]
+        return (log_probs_batch, labels_batch) if return_labels else log_probs_batch
+
     batch = {k: v.to(model.device) for k, v in batch.items()}
     with torch.set_grad_enabled(grad):
         output = model(**batch)
 
     logits = output.logits
     bsz, seq_len, V = logits.shape
-    log_probs = torch.nn.functional.log_softmax(logits, dim=-1)[:, :-1, :]
-    # ^ we don't predict next token for last token, bsz x seq_len-1 x V
-    next_tokens = batch["input_ids"][:, 1:].unsqueeze(-1)  # bsz x seq_len-1 x 1
-    target_log_probs = torch.gather(log_probs, dim=2, index=next_tokens).squeeze(-1)
     log_probs_batch = []
     labels_batch = []
     for i in range(bsz):
@@ -140,7 +577,14 @@ def tokenwise_logprobs(model, batch, grad=False, return_labels=False):
                 "Index 0 in a datapoint's input_ids must not have loss (unignored labels) on it",
                 UserWarning,
             )
-        log_probs_batch.append(target_log_probs[i, start_idx - 1 : end_idx])
+        # log_softmax only over the labeled span, bsz x seq_len-1 x V is never built
+        log_probs = torch.nn.functional.log_softmax(
+            logits[i, start_idx - 1 : end_idx], dim=-1
+        )
+        next_tokens = batch["input_ids"][i, start_idx : end_idx + 1].unsqueeze(-1)
+        log_probs_batch.append(
+            torch.gather(log_probs, dim=1, index=next_tokens).squeeze(-1)
+        )
         labels_batch.append(labels[actual_indices])
 
     return (log_probs_batch, labels_batch) if return_labels else log_probs_batch
@@ -160,9 +604,6 @@ def tokenwise_vocab_logprobs(model, batch, grad=False, return_labels=False):
 
     logits = output.logits
     bsz, seq_len, V = logits.shape
-    log_probs = torch.nn.functional.log_softmax(logits, dim=-1)[
-        :, :-1, :
-    ]  # Don't predict for last token
 
     # Process each sequence in batch separately
     log_probs_batch = []
@@ -183,13 +624,111 @@ def tokenwise_vocab_logprobs(model, batch, grad=False, return_labels=False):
                 "Index 0 in a datapoint's input_ids must not have loss (unignored labels) on it",
                 UserWarning,
             )
-        # Return full distribution for each position: shape (N, V)
-        log_probs_batch.append(log_probs[i, start_idx - 1 : end_idx])
+        # Return full distribution for each position: shape (N, V), normalized
+        # only over the labeled span
+        log_probs_batch.append(
+            torch.nn.functional.log_softmax(logits[i, start_idx - 1 : end_idx], dim=-1)
+        )
         labels_batch.append(labels[actual_indices])
 
     return (log_probs_batch, labels_batch) if return_labels else log_probs_batch
 
 
+@lru_cache(maxsize=None)
+def _vocab_texts(tokenizer):
+    """Decoded text of every token of a tokenizer's vocabulary."""
+    return tokenizer.batch_decode([[token_id] for token_id in range(len(tokenizer))])
+
+
+def _stop_sequence_variants(tokenizer, sequence):
+    """Token id sequences that decode to `sequence`: its tokenization on its own and after
+    common left contexts, which often merge differently with its first characters."""
+    variants = set()
+    for prefix in ["", " ", "\n", "a"]:
+        prefix_ids = tokenizer.encode(prefix, add_special_tokens=False)
+        ids = tokenizer.encode(prefix + sequence, add_special_tokens=False)
+        if ids[: len(prefix_ids)] != prefix_ids:
+            continue
+        variant = tuple(ids[len(prefix_ids) :])
+        if variant and sequence in tokenizer.decode(variant):
+            variants.add(variant)
+    return sorted(variants)
+
+
+class StopSequenceMatcher:
+    """Detects generations ending with a stop string directly on token ids.
+
+    A generation ends with the stop string when its last token contains it, or when its
+    last tokens are one of the precomputed tokenizations of it; both checks run on the
+    ids' device. Otherwise, a match can only complete at the last token if that token's
+    text starts with a suffix of the stop string (or is a partial UTF-8 byte): only such
+    ambiguous windows are decoded and searched, as `MultiTokenEOSCriteria` used to do at
+    every step."""
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, sequence: str):
+        self.tokenizer = tokenizer
+        self.sequence = sequence
+        # same lookback window as MultiTokenEOSCriteria, see the comments there
+        self.lookback = len(tokenizer.encode(sequence, add_special_tokens=False)) + 2
+        token_texts = _vocab_texts(tokenizer)
+        suffixes = [sequence[i:] for i in range(1, len(sequence))]
+        self.contains = torch.tensor([sequence in text for text in token_texts])
+        self.ambiguous = torch.tensor(
+            [
+                "\ufffd" in text
+                or any(
+                    candidate.startswith(suffix)
+                    for candidate in (text, text.lstrip(), " " + text)
+                    for suffix in suffixes
+                )
+                for text in token_texts
+            ]
+        )
+        self.variant_ids = _stop_sequence_variants(tokenizer, sequence)
+        self.variants = [torch.tensor(variant) for variant in self.variant_ids]
+        self.contains_ids = set(self.contains.nonzero().flatten().tolist())
+
+    def _to(self, device):
+        if self.contains.device != device:
+            self.contains = self.contains.to(device)
+            self.ambiguous = self.ambiguous.to(device)
+            self.variants = [variant.to(device) for variant in self.variants]
+
+    def __call__(self, lookback_ids: torch.Tensor) -> torch.Tensor:
+        """Whether each row of `lookback_ids` (batch x lookback, left-padded with -1)
+        ends with the stop string."""
+        self._to(lookback_ids.device)
+        last = lookback_ids[:, -1]
+        in_vocab = (last >= 0) & (last < len(self.contains))
+        last = torch.where(in_vocab, last, 0)
+        done = in_vocab & self.contains[last]
+        for variant in self.variants:
+            if len(variant) <= lookback_ids.shape[1]:
+                done |= (lookback_ids[:, -len(variant) :] == variant).all(-1)
+        unresolved = ~done & (~in_vocab | self.ambiguous[last])
+        for row in unresolved.nonzero().flatten().tolist():
+            ids = lookback_ids[row]
+            done[row] = self.sequence in self.tokenizer.decode(ids[ids >= 0])
+        return done
+
+    def find(self, ids: List[int]) -> int:
+        """Start of the first occurrence of the stop string in `ids` (len(ids) if none),
+        only considering tokens containing it and its precomputed tokenizations."""
+        for start in range(len(ids)):
+            if ids[start] in self.contains_ids:
+                return start
+            for variant in self.variant_ids:
+                if tuple(ids[start : start + len(variant)]) == variant:
+                    return start
+        return len(ids)
+
+
+@lru_cache(maxsize=None)
+def get_stop_sequence_matcher(tokenizer, sequence):
+    """Matchers are built once per tokenizer and stop string and reused across batches."""
+    return StopSequenceMatcher(tokenizer, sequence)
+
+
 class MultiTokenEOSCriteria(StoppingCriteria):
     """Criteria to stop on the specified multi-token sequence. Stopping Criteria forked
     and modified from [lm-evaluation-harness](https://github.com/EleutherAI/lm-evaluation-harness/blob/27924d77953491f66a038a09892807065e469358/lm_eval/models/utils.py#L208)"""
@@ -202,8 +741,9 @@ class MultiTokenEOSCriteria(StoppingCriteria):
         batch_size: int,
     ) -> None:
         self.initial_decoder_input_length = initial_decoder_input_length
-        self.done_tracker = [False] * batch_size
+        self.done_tracker = np.zeros(batch_size, dtype=bool)
         self.sequence = sequence
+        self.matcher = get_stop_sequence_matcher(tokenizer, sequence)
         self.sequence_ids = tokenizer.encode(sequence, add_special_tokens=False)
         # we look back for 2 more tokens than it takes to encode our stop sequence
         # because tokenizers suck, and a model might generate `['\n', '\n']` but our `sequence` is `['\n\n']`
@@ -221,13 +761,11 @@ class MultiTokenEOSCriteria(StoppingCriteria):
         lookback_ids_batch = input_ids[:, self.initial_decoder_input_length :]
 
         lookback_ids_batch = lookback_ids_batch[:, -self.sequence_id_len :]
+        if lookback_ids_batch.shape[1] == 0:
+            return False
 
-        lookback_tokens_batch = self.tokenizer.batch_decode(lookback_ids_batch)
-
-        for i, done in enumerate(self.done_tracker):
-            if not done:
-                self.done_tracker[i] = self.sequence in lookback_tokens_batch[i]
-        return False not in self.done_tracker
+        self.done_tracker |= self.matcher(lookback_ids_batch).tolist()
+        return bool(self.done_tracker.all())
 
 
 def stop_sequences_criteria(
@@ -248,26 +786,14 @@ def stop_sequences_criteria(
     )
 
 
-def eval_text_similarity(model, tokenizer, batch, generation_args):
-    """Evaluate text similarity between model-generated outputs and ground truth using ROUGE scores."""
-
-    def eval_rouge_recall_batch(gen_outputs, ground_truths):
-        scorer = rouge_scorer.RougeScorer(["rouge1", "rougeL"], use_stemmer=True)
-        evals = []
-        for gen, gt in zip(gen_outputs, ground_truths):
-            rouge_scores = scorer.score(gt, gen)
-            evals.append(
-                {
-                    "rouge1_recall": rouge_scores["rouge1"].recall,
-                    "rougeL_f1": rouge_scores["rougeL"].fmeasure,
-                    "rougeL_recall": rouge_scores["rougeL"].recall,
-                }
-            )
-        return evals
+def eval_rouge_recall_batch(gen_outputs, ground_truths, num_workers=0):
+    """ROUGE scores of generations against their ground truths."""
+    return get_rouge_engine(num_workers).score(gen_outputs, ground_truths)
 
-    batch = {k: v.to(model.device) for k, v in batch.items()}
-    input_ids = batch["input_ids"]
-    labels = batch["labels"]
+
+def decode_inputs_and_ground_truths(tokenizer, input_ids, labels):
+    """Decode generation prompts and recover ground truths from the labels, which
+    hold the entire conversation (see `preprocess_chat_instance`)."""
     input_texts = tokenizer.batch_decode(
         input_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True
     )
@@ -279,44 +805,71 @@ def eval_text_similarity(model, tokenizer, batch, generation_args):
         full_text.replace(input_text, "").strip()
         for input_text, full_text in zip(input_texts, full_texts)
     ]
+    return input_texts, ground_truths
 
-    attention_mask = batch["attention_mask"]
 
-    # convert to a simple dict from DictConfig
-    generation_args = OmegaConf.to_container(generation_args, resolve=True)
-    stopwords = generation_args.pop("stopwords", None)
-    if stopwords is not None:
-        assert isinstance(stopwords, list)
-        sc = stop_sequences_criteria(
-            tokenizer, stopwords, input_ids.shape[1], input_ids.shape[0]
-        )
-        generation_args["stopping_criteria"] = sc
-    output = model.generate(
-        input_ids,
-        attention_mask=attention_mask,
-        **generation_args,
-        pad_token_id=tokenizer.eos_token_id,
-    )
-    gen_texts = tokenizer.batch_decode(
-        output[:, input_ids.shape[-1] :],
-        skip_special_tokens=True,
-        clean_up_tokenization_spaces=True,
-    )
-
-    # cut off at stopwords
+def cut_at_stopwords(tokenizer, gen_texts, stopwords=None):
+    """Cut off decoded generations at the first eos or stopword."""
     if stopwords is None:
         stopwords = []
     stopwords = [tokenizer.decode([tokenizer.eos_token_id])] + stopwords
-    for i in range(len(gen_texts)):
-        raw_text = gen_texts[i]
+    cut_texts = []
+    for raw_text in gen_texts:
         for word in stopwords:
             if word and word in raw_text:
                 raw_text = raw_text.split(word)[0]
-        raw_text = raw_text.strip()
-        gen_texts[i] = raw_text
+        cut_texts.append(raw_text.strip())
+    return cut_texts
+
+
+def ground_truth_token_ids(tokenizer, prompt_ids, labels):
+    """Token-id counterpart of `decode_inputs_and_ground_truths`: label tokens following
+    the (unpadded) prompt ids, without special tokens."""
+    special_ids = set(tokenizer.all_special_ids)
+    ground_truth_ids = []
+    for prompt, label in zip(prompt_ids, labels):
+        prompt, tokens = prompt.tolist(), label[label != IGNORE_INDEX].tolist()
+        if tokens[: len(prompt)] == prompt:
+            tokens = tokens[len(prompt) :]
+        ground_truth_ids.append([token for token in tokens if token not in special_ids])
+    return ground_truth_ids
+
+
+def cut_ids_at_stopwords(tokenizer, gen_ids, stopwords=None):
+    """Token-id counterpart of `cut_at_stopwords`: cut generations before the first eos
+    or stopword tokens (see `StopSequenceMatcher.find`) and drop special tokens."""
+    matchers = [get_stop_sequence_matcher(tokenizer, word) for word in stopwords or []]
+    special_ids = set(tokenizer.all_special_ids)
+    cut_ids = []
+    for ids in gen_ids:
+        ids = [int(token) for token in ids]
+        end = (
+            ids.index(tokenizer.eos_token_id)
+            if tokenizer.eos_token_id in ids
+            else len(ids)
+        )
+        for matcher in matchers:
+            end = matcher.find(ids[:end])
+        cut_ids.append([token for token in ids[:end] if token not in special_ids])
+    return cut_ids
+
 
-    scores = eval_rouge_recall_batch(gen_texts, ground_truths)
-    scores = [
+def score_generations(
+    gen_texts,
+    input_texts,
+    ground_truths,
+    gen_ids=None,
+    ground_truth_ids=None,
+    num_workers=0,
+):
+    """ROUGE scores of generations, along with the texts they were computed on. Scores
+    are computed on token ids instead of texts if `gen_ids` and `ground_truth_ids` are
+    given."""
+    if gen_ids is not None:
+        scores = get_rouge_engine(num_workers).score(gen_ids, ground_truth_ids)
+    else:
+        scores = eval_rouge_recall_batch(gen_texts, ground_truths, num_workers)
+    return [
         {
             **rouge_evals,
             "input": input_text,
@@ -327,7 +880,156 @@ def eval_text_similarity(model, tokenizer, batch, generation_args):
             scores, input_texts, ground_truths, gen_texts
         )
     ]
-    return scores
+
+
+@lru_cache(maxsize=8)
+def _worker_tokenizer(tokenizer):
+    """Copy of a tokenizer for post-processing threads, kept (like the stop sequence
+    matchers built for it) for later evaluations."""
+    return copy.deepcopy(tokenizer)
+
+
+class PostprocessWorker:
+    """Worker thread running the CPU post-processing of generated batches (decoding,
+    stopword cutting, ROUGE scoring) while the next batches generate. It decodes with
+    its own copy of the tokenizer, as fast tokenizers are not safe to share between
+    threads."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = _worker_tokenizer(tokenizer)
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="postprocess"
+        )
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self._executor.submit(fn, self.tokenizer, *args, **kwargs)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def score_text_batch(
+    tokenizer, generated, stopwords=None, rouge_mode="text", rouge_num_workers=0
+):
+    """CPU post-processing of a batch generated by `eval_text_similarity`: decode the
+    prompts, ground truths and generations, cut generations off at stopwords and
+    compute their ROUGE scores."""
+    input_texts, ground_truths = decode_inputs_and_ground_truths(
+        tokenizer, generated["prompt_ids"], generated["prompt_labels"]
+    )
+    gen_texts = tokenizer.batch_decode(
+        generated["output_ids"],
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=True,
+    )
+
+    # cut off at stopwords
+    gen_texts = cut_at_stopwords(tokenizer, gen_texts, stopwords)
+    gen_ids, ground_truth_ids = None, None
+    if rouge_mode == "token_ids":
+        prompt_ids = [
+            ids[mask.bool()]
+            for ids, mask in zip(generated["input_ids"], generated["attention_mask"])
+        ]
+        ground_truth_ids = ground_truth_token_ids(
+            tokenizer, prompt_ids, generated["labels"]
+        )
+        gen_ids = cut_ids_at_stopwords(
+            tokenizer, generated["output_ids"].tolist(), stopwords
+        )
+    return score_generations(
+        gen_texts,
+        input_texts,
+        ground_truths,
+        gen_ids=gen_ids,
+        ground_truth_ids=ground_truth_ids,
+        num_workers=rouge_num_workers,
+    )
+
+
+def eval_text_similarity(
+    model,
+    tokenizer,
+    batch,
+    generation_args,
+    rouge_mode="text",
+    rouge_num_workers=0,
+    shared_prefix=None,
+    postprocess=None,
+    speculative=None,
+):
+    """Evaluate text similarity between model-generated outputs and ground truth using ROUGE scores.
+    With `rouge_mode="token_ids"`, ROUGE is computed on token ids instead of decoded texts.
+    Batches collated without a `shared_prefix` generate from its KV cache. With a
+    `SpeculativeDecoding`, greedy generation is assisted by its draft model. With a
+    `PostprocessWorker`, returns a Future of the scores, computed by the worker."""
+    batch = {k: v.to(model.device) for k, v in batch.items()}
+    input_ids = batch["input_ids"]
+    labels = batch["labels"]
+    prompt_length = input_ids.shape[1]
+    if shared_prefix is None:
+        prompt_ids, prompt_labels = input_ids, labels
+    else:
+        prompt_length += shared_prefix.length
+        prompt_ids = shared_prefix.prepend(input_ids)
+        prompt_labels = shared_prefix.prepend(labels)
+
+    attention_mask = batch["attention_mask"]
+
+    # convert to a simple dict from DictConfig
+    generation_args = OmegaConf.to_container(generation_args, resolve=True)
+    stopwords = generation_args.pop("stopwords", None)
+    if speculative is not None:
+        if shared_prefix is not None:
+            raise ValueError(
+                "Speculative decoding does not support shared_prefix_cache"
+            )
+        stopping_criteria_fn = None
+        if stopwords is not None:
+            assert isinstance(stopwords, list)
+            stopping_criteria_fn = partial(
+                stop_sequences_criteria, tokenizer, stopwords
+            )
+        output_ids = speculative.generate(
+            model,
+            input_ids,
+            attention_mask,
+            {**generation_args, "pad_token_id": tokenizer.eos_token_id},
+            stopping_criteria_fn,
+        )
+    else:
+        if stopwords is not None:
+            assert isinstance(stopwords, list)
+            sc = stop_sequences_criteria(
+                tokenizer, stopwords, prompt_length, input_ids.shape[0]
+            )
+            generation_args["stopping_criteria"] = sc
+        generate_fn = model.generate
+        if shared_prefix is not None:
+            generate_fn = partial(shared_prefix.generate, model)
+        output = generate_fn(
+            input_ids,
+            attention_mask=attention_mask,
+            **generation_args,
+            pad_token_id=tokenizer.eos_token_id,
+        )
+        output_ids = output[:, input_ids.shape[-1] :]
+    generated = {
+        "input_ids": input_ids.cpu(),
+        "labels": labels.cpu(),
+        "attention_mask": attention_mask.cpu(),
+        "prompt_ids": prompt_ids.cpu(),
+        "prompt_labels": prompt_labels.cpu(),
+        "output_ids": output_ids.cpu(),
+    }
+    score_args = {
+        "stopwords": stopwords,
+        "rouge_mode": rouge_mode,
+        "rouge_num_workers": rouge_num_workers,
+    }
+    if postprocess is not None:
+        return postprocess.submit(score_text_batch, generated, **score_args)
+    return score_text_batch(tokenizer, generated, **score_args)
 
 
 def extract_target_texts_from_processed_data(tokenizer, batch):
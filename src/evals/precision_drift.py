@@ -0,0 +1,135 @@
+"""
+Metric drift of quantized evaluation (see `model.quantization`): every evaluator runs on
+the first items of each of its datasets with the full-precision and the quantized model,
+and the aggregate values of both are reported side by side with their difference.
+"""
+
+import os
+import gc
+import copy
+import json
+import logging
+
+from omegaconf import DictConfig, open_dict
+
+from model import get_model
+from evals import get_evaluators
+from evals.distributed import is_main_process
+
+logger = logging.getLogger("evaluator")
+
+
+def _limit_splits(node, num_samples):
+    """Limit the split of every dataset loaded through `hf_args` under `node` to its
+    first `num_samples` items, in place. Returns whether any dataset was limited."""
+    limited = False
+    if not isinstance(node, DictConfig):
+        return limited
+    for key, value in node.items():
+        if key == "hf_args" and isinstance(value, DictConfig) and "split" in value:
+            split = value.split
+            if "[" not in split:
+                with open_dict(value):
+                    value.split = f"{split}[:{num_samples}]"
+            limited = True
+        else:
+            limited = _limit_splits(value, num_samples) or limited
+    return limited
+
+
+def sample_eval_cfgs(cfg, num_samples):
+    """Evaluator configs of `cfg` evaluating the first `num_samples` items of every
+    dataset. Evaluators without datasets loaded through `hf_args` are left out."""
+    cfg = copy.deepcopy(cfg)
+    eval_cfgs = cfg.eval
+    with open_dict(eval_cfgs):
+        for name in list(eval_cfgs.keys()):
+            if not _limit_splits(eval_cfgs[name], num_samples):
+                logger.info(f"Precision drift: skipping {name}, no sampled datasets")
+                del eval_cfgs[name]
+    return eval_cfgs
+
+
+def _flatten(summary, prefix=""):
+    """Numeric aggregate values of a summary, nested values keyed by path."""
+    values = {}
+    for key, value in summary.items():
+        if isinstance(value, dict):
+            values.update(_flatten(value, prefix=f"{prefix}{key}/"))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f"{prefix}{key}"] = float(value)
+    return values
+
+
+def _evaluate_sample(eval_cfgs, model, output_dir, **kwargs):
+    """Summaries of every evaluator on the sampled data, by evaluator name."""
+    summaries = {}
+    for name, evaluator in get_evaluators(eval_cfgs).items():
+        summaries[name] = _flatten(
+            evaluator.evaluate(
+                model=model, output_dir=output_dir, overwrite=True, **kwargs
+            )
+        )
+    return summaries
+
+
+def drift_report(reference, quantized, label, tolerance=None):
+    """Aggregate values of the full-precision (`reference`) and quantized summaries, by
+    evaluator and metric, with their absolute difference."""
+    report = {}
+    for name, values in reference.items():
+        report[name] = {}
+        for metric, value in values.items():
+            if metric not in quantized.get(name, {}):
+                continue
+            diff = abs(quantized[name][metric] - value)
+            report[name][metric] = {
+                "fp32": value,
+                label: quantized[name][metric],
+                "abs_diff": diff,
+            }
+            if tolerance is not None and diff > tolerance:
+                logger.warning(
+                    f"Precision drift of {name}/{metric}: {diff:.4g} > {tolerance}"
+                )
+    return report
+
+
+def evaluate_precision_drift(cfg, model, tokenizer):
+    """Evaluate the drift of the quantized `model` against the float32 model of
+    `cfg.model` on the first `precision.drift_samples` items of each dataset, and store
+    the report as PRECISION_DRIFT.json in `precision.drift_output_dir`."""
+    precision = cfg.precision
+    eval_cfgs = sample_eval_cfgs(cfg, precision.drift_samples)
+    output_dir = precision.drift_output_dir
+    kwargs = {"tokenizer": tokenizer, "template_args": cfg.model.template_args}
+
+    logger.info("Precision drift: evaluating the float32 model")
+    model_cfg = copy.deepcopy(cfg.model)
+    with open_dict(model_cfg):
+        model_cfg.model_args.torch_dtype = "float32"
+    reference_model, _ = get_model(model_cfg)
+    reference = _evaluate_sample(
+        eval_cfgs, reference_model, os.path.join(output_dir, "fp32"), **kwargs
+    )
+    # the float32 model is not needed for the quantized model's passes
+    del reference_model
+    gc.collect()
+
+    logger.info(f"Precision drift: evaluating the {precision.quantize} model")
+    quantized = _evaluate_sample(
+        eval_cfgs, model, os.path.join(output_dir, precision.quantize), **kwargs
+    )
+    report = drift_report(
+        reference,
+        quantized,
+        precision.quantize,
+        tolerance=precision.get("drift_tolerance", None),
+    )
+    if is_main_process():
+        os.makedirs(output_dir, exist_ok=True)
+        report_path = os.path.join(output_dir, "PRECISION_DRIFT.json")
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=4)
+        logger.info(f"Precision drift report stored in {report_path}")
+    return report
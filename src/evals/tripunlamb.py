@@ -1,5 +1,6 @@
 from evals.base import Evaluator
 
+
 class tripunlambEvaluator(Evaluator):
     def __init__(self, eval_cfg, **kwargs):
-        super().__init__("tripunlamb", eval_cfg, **kwargs)
\ No newline at end of file
+        super().__init__("tripunlamb", eval_cfg, **kwargs)
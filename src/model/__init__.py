@@ -3,6 +3,7 @@ from omegaconf import DictConfig, OmegaConf
 from typing import Dict, Any
 import os, torch, logging
 from model.probe import ProbedLlamaForCausalLM
+from model.quantization import load_quantized_model
 
 logger  = logging.getLogger(__name__)
 hf_home = os.getenv("HF_HOME", None)
@@ -14,7 +15,12 @@ def _register_model(cls):
 _register_model(AutoModelForCausalLM)
 _register_model(ProbedLlamaForCausalLM)
 
-def get_model(model_cfg: DictConfig, *, attn_impl: str | None = None):
+def get_model(
+    model_cfg: DictConfig,
+    *,
+    attn_impl: str | None = None,
+    precision: DictConfig | None = None,
+):
     m_args = OmegaConf.to_container(model_cfg.model_args, resolve=True)
     t_args = OmegaConf.to_container(model_cfg.tokenizer_args, resolve=True)
 
@@ -38,13 +44,26 @@ def get_model(model_cfg: DictConfig, *, attn_impl: str | None = None):
 
     handler   = model_cfg.get("model_handler", "AutoModelForCausalLM")
     model_cls = MODEL_REGISTRY[handler]
+    quantize  = (precision or {}).get("quantize", None)
     try:
-        model = model_cls.from_pretrained(
-            model_path,
-            torch_dtype=torch_dtype,
-            **m_args,
-            cache_dir=hf_home,
-        )
+        if quantize is not None:
+            # weight-only quantized Linear layers, on CPU (see model.quantization)
+            model = load_quantized_model(
+                model_cls,
+                model_path,
+                m_args,
+                quantize,
+                group_size=precision.get("group_size", 128),
+                cache_dir=precision.get("cache_dir", None),
+                hf_home=hf_home,
+            )
+        else:
+            model = model_cls.from_pretrained(
+                model_path,
+                torch_dtype=torch_dtype,
+                **m_args,
+                cache_dir=hf_home,
+            )
     except Exception as e:
         logger.error("Failed to load model %r: %s", model_path, e)
         raise
@@ -0,0 +1,60 @@
+"""
+Fingerprints of model checkpoints, keying results stored on disk that depend only on the
+weights (e.g. reference-model losses, quantized weights).
+"""
+
+import os
+import re
+import glob
+import logging
+
+from huggingface_hub import constants, model_info, try_to_load_from_cache
+from huggingface_hub.utils import HfHubHTTPError
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILES = ["*.safetensors", "*.bin", "*.pt", "config.json"]
+_COMMIT_SHA = re.compile(r"[0-9a-f]{40}")
+
+
+def resolve_commit(model_id, revision=None, cache_dir=None):
+    """Commit sha of `revision` of a Hub model: asked to the Hub, or read from the local
+    snapshot of the revision when offline. None if it cannot be resolved."""
+    if revision is not None and _COMMIT_SHA.fullmatch(revision):
+        return revision
+    if not constants.HF_HUB_OFFLINE:
+        try:
+            return model_info(model_id, revision=revision).sha
+        except (HfHubHTTPError, OSError, ValueError) as e:
+            logger.warning(f"Could not resolve {model_id}@{revision} on the Hub: {e}")
+    # snapshots are stored in directories named after their commit
+    try:
+        cached = try_to_load_from_cache(
+            model_id, "config.json", cache_dir=cache_dir, revision=revision
+        )
+    except ValueError:  # not a Hub model id, e.g. a missing local directory
+        return None
+    if isinstance(cached, str):
+        return os.path.basename(os.path.dirname(cached))
+    return None
+
+
+def checkpoint_fingerprint(model_path, revision=None, cache_dir=None):
+    """Fingerprint of a checkpoint: for a local directory, the names, sizes and
+    modification times of its weight and config files; for a Hub model id, the id and
+    the commit of the revision. None if the commit cannot be resolved, in which case
+    nothing should be stored under the fingerprint."""
+    if os.path.isdir(model_path):
+        files = sorted(
+            path
+            for pattern in CHECKPOINT_FILES
+            for path in glob.glob(os.path.join(model_path, pattern))
+        )
+        return [
+            [os.path.basename(path), os.path.getsize(path), os.path.getmtime(path)]
+            for path in files
+        ]
+    commit = resolve_commit(model_path, revision, cache_dir)
+    if commit is None:
+        return None
+    return [model_path, commit]
@@ -0,0 +1,243 @@
+"""
+Quantized evaluation of causal LMs on CPU. The weights of the Linear layers are
+quantized after loading, either to int8 (dynamic quantization: int8 weights, activations
+quantized per batch, int8 matrix products) or to group-wise int4 (packed 4-bit weights,
+dequantized at each forward, saving memory rather than time). Quantized weights are
+stored under the fingerprint of the checkpoint, and later runs load them instead of the
+full-precision checkpoint.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+from torch.ao.nn.quantized import dynamic as nnqd
+from accelerate import init_empty_weights
+from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+from model.checkpoint import checkpoint_fingerprint
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_DTYPES = ("int8", "int4")
+# bump when the stored layout or the quantization changes
+QUANTIZATION_VERSION = 1
+# from_pretrained args that also apply to the checkpoint's config
+_CONFIG_ARGS = ("revision", "trust_remote_code", "attn_implementation")
+
+
+class Int4Linear(nn.Module):
+    """Linear layer with weights quantized to 4 bits, asymmetrically (min-max) per group
+    of `group_size` input features, packed two per byte."""
+
+    def __init__(self, in_features, out_features, bias=True, group_size=128):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        if in_features % group_size:
+            group_size = in_features
+        self.group_size = group_size
+        num_groups = in_features // group_size
+        self.register_buffer(
+            "qweight", torch.zeros(out_features, in_features // 2, dtype=torch.uint8)
+        )
+        self.register_buffer("scales", torch.ones(out_features, num_groups))
+        self.register_buffer("zeros", torch.zeros(out_features, num_groups))
+        if bias:
+            self.bias = nn.Parameter(torch.zeros(out_features), requires_grad=False)
+        else:
+            self.register_parameter("bias", None)
+
+    @classmethod
+    def from_float(cls, linear, group_size=128):
+        module = cls(
+            linear.in_features, linear.out_features, linear.bias is not None, group_size
+        )
+        weight = linear.weight.detach().float()
+        weight = weight.view(module.out_features, -1, module.group_size)
+        low, high = weight.amin(dim=-1), weight.amax(dim=-1)
+        scales = (high - low).clamp(min=1e-8) / 15
+        q = torch.round((weight - low[..., None]) / scales[..., None]).clamp(0, 15)
+        q = q.to(torch.uint8).view(module.out_features, module.in_features)
+        module.qweight.copy_(q[:, ::2] | (q[:, 1::2] << 4))
+        module.scales.copy_(scales)
+        module.zeros.copy_(low)
+        if linear.bias is not None:
+            module.bias.data.copy_(linear.bias.detach().float())
+        return module
+
+    def dequantize(self):
+        """The float32 weight (out_features, in_features)."""
+        q = torch.stack([self.qweight & 15, self.qweight >> 4], dim=-1)
+        q = q.view(self.out_features, -1, self.group_size).float()
+        weight = q * self.scales[..., None] + self.zeros[..., None]
+        return weight.view(self.out_features, self.in_features)
+
+    def forward(self, x):
+        return F.linear(x, self.dequantize().to(x.dtype), self.bias)
+
+    def extra_repr(self):
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, "
+            f"bias={self.bias is not None}, group_size={self.group_size}"
+        )
+
+
+def _quantizable(module):
+    # int4 weights are packed by pairs of input features
+    return type(module) is nn.Linear and module.in_features % 2 == 0
+
+
+def _swap_linears(model, make):
+    """Replace every quantizable Linear layer of `model` by `make(linear)`."""
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if _quantizable(child):
+                setattr(parent, name, make(child))
+    return model
+
+
+def quantize_model(model, dtype, group_size=128):
+    """Quantize the Linear layers of a float model on CPU, in place."""
+    model = model.float()
+    if dtype == "int8":
+        return _swap_linears(
+            model,
+            lambda linear: torch.ao.quantization.quantize_dynamic(
+                nn.Sequential(linear), {nn.Linear}, dtype=torch.qint8, inplace=True
+            )[0],
+        )
+    return _swap_linears(
+        model, lambda linear: Int4Linear.from_float(linear, group_size=group_size)
+    )
+
+
+def is_quantized(model):
+    """Whether `model` has quantized Linear layers."""
+    return any(isinstance(m, (nnqd.Linear, Int4Linear)) for m in model.modules())
+
+
+def _empty_quantized(linear, dtype, group_size):
+    """Quantized layer of the shape of `linear`, to load stored weights into."""
+    bias = linear.bias is not None
+    if dtype == "int8":
+        return nnqd.Linear(
+            linear.in_features, linear.out_features, bias_=bias, dtype=torch.qint8
+        )
+    return Int4Linear(linear.in_features, linear.out_features, bias, group_size)
+
+
+def quantized_weights_path(
+    cache_dir, model_path, model_args, dtype, group_size, hf_home=None
+):
+    """Path of the stored quantized weights of a checkpoint, or None if the commit of
+    a Hub revision cannot be resolved."""
+    fingerprint = checkpoint_fingerprint(
+        model_path, model_args.get("revision"), cache_dir=hf_home
+    )
+    if fingerprint is None:
+        return None
+    payload = json.dumps(
+        [
+            QUANTIZATION_VERSION,
+            torch.__version__,  # layout of packed int8 weights
+            fingerprint,
+            dtype,
+            group_size if dtype == "int4" else None,
+        ]
+    )
+    key = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{key}.pt")
+
+
+def _load_stored(path, model_path, model_args, dtype, group_size, hf_home):
+    """The quantized model at `model_path`, its weights read from `path`: the model is
+    built without weights, its Linear layers swapped for empty quantized ones."""
+    config_args = {key: model_args[key] for key in _CONFIG_ARGS if key in model_args}
+    config = AutoConfig.from_pretrained(model_path, cache_dir=hf_home, **config_args)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(
+            config,
+            torch_dtype=torch.float32,
+            **{key: value for key, value in config_args.items() if key != "revision"},
+        )
+    _swap_linears(model, lambda linear: _empty_quantized(linear, dtype, group_size))
+    # remaining parameters (embeddings, norms), tied ones kept tied
+    materialized = {}
+    for module in model.modules():
+        for name, param in module._parameters.items():
+            if param is not None and param.is_meta:
+                if id(param) not in materialized:
+                    materialized[id(param)] = nn.Parameter(
+                        torch.empty_like(param, device="cpu"),
+                        requires_grad=param.requires_grad,
+                    )
+                module._parameters[name] = materialized[id(param)]
+    model.load_state_dict(torch.load(path, map_location="cpu", weights_only=True))
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(
+            model_path, cache_dir=hf_home, **config_args
+        )
+    except OSError:
+        pass  # no generation config in the checkpoint
+    return model
+
+
+def load_quantized_model(
+    model_cls,
+    model_path,
+    model_args,
+    dtype,
+    group_size=128,
+    cache_dir=None,
+    hf_home=None,
+):
+    """The model at `model_path`, loaded with `model_cls.from_pretrained(model_path,
+    **model_args)` on CPU and quantized to `dtype` ("int8" or "int4").
+
+    With a `cache_dir`, the quantized weights are stored there and read back by later
+    runs instead of loading and quantizing the full-precision checkpoint. Stored weights
+    are only used for models loaded with `AutoModelForCausalLM`."""
+    if dtype not in QUANTIZATION_DTYPES:
+        raise ValueError(
+            f"Unknown quantization {dtype!r}, expected one of {QUANTIZATION_DTYPES}"
+        )
+    device_map = model_args.get("device_map", None)
+    if device_map not in (None, "cpu"):
+        raise ValueError(
+            f"Quantized models run on CPU only, got device_map={device_map!r}"
+        )
+    path = None
+    if cache_dir is not None and model_cls is AutoModelForCausalLM:
+        path = quantized_weights_path(
+            cache_dir, model_path, model_args, dtype, group_size, hf_home=hf_home
+        )
+        if path is None:
+            logger.warning(
+                f"{dtype} weights of {model_path} are not stored: unresolved revision"
+            )
+        elif os.path.exists(path):
+            logger.info(f"Loading {dtype} weights of {model_path} from {path}")
+            model = _load_stored(
+                path, model_path, model_args, dtype, group_size, hf_home
+            )
+            return model.eval()
+
+    model = model_cls.from_pretrained(
+        model_path, torch_dtype=torch.float32, **model_args, cache_dir=hf_home
+    )
+    logger.info(f"Quantizing the Linear layers of {model_path} to {dtype}")
+    model = quantize_model(model.eval(), dtype, group_size=group_size)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            torch.save(model.state_dict(), f)
+        os.replace(tmp_path, path)
+        logger.info(f"Stored {dtype} weights of {model_path} in {path}")
+    return model
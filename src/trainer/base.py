@@ -5,6 +5,7 @@ from typing import Dict, List, Optional, Union
 import os
 import logging
 from transformers import Trainer
+from transformers.integrations.deepspeed import is_deepspeed_zero3_enabled
 from torch.utils.data import Dataset
 from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
 from typing import Any
@@ -27,30 +28,32 @@ class FinetuneTrainer(Trainer):
     ) -> Dict[str, float]:
         # Run a custom evaluator and save results
         if self.evaluators:
-            if self.accelerator.is_local_main_process:
-                eval_metrics = {}
-                if self.accelerator.num_processes == 1:
-                    run_dir = self._get_output_dir(trial=trial)
-                    checkpoint_folder = (
-                        f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}"
-                    )
-                    output_dir = os.path.join(run_dir, checkpoint_folder, "evals")
-                    os.makedirs(output_dir, exist_ok=True)
-                    eval_metrics = {}
-                    for _, evaluator in self.evaluators.items():
-                        eval_args = {
-                            "output_dir": output_dir,
-                            "template_args": self.template_args,
-                            "model": self.model,
-                            "tokenizer": self.tokenizer,
-                        }
-                        eval_metrics.update(evaluator.evaluate(**eval_args))
-                    self.log(eval_metrics)
-                else:
-                    logger.warning(
-                        "Custom evaluator can be run with this Trainer only when a single accelerator process is running."
-                    )
-                return eval_metrics
+            if self.accelerator.num_processes > 1 and (
+                is_deepspeed_zero3_enabled() or self.is_fsdp_enabled
+            ):
+                # sharded parameters would need every process in every forward pass,
+                # while evaluators shard the data across processes
+                logger.warning(
+                    "Custom evaluators are not run with ZeRO-3 or FSDP sharded models."
+                )
+                return {}
+            # with several processes, each evaluates a share of the data (see
+            # evals/distributed.py) and the main process writes the logs
+            run_dir = self._get_output_dir(trial=trial)
+            checkpoint_folder = f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}"
+            output_dir = os.path.join(run_dir, checkpoint_folder, "evals")
+            os.makedirs(output_dir, exist_ok=True)
+            eval_metrics = {}
+            for _, evaluator in self.evaluators.items():
+                eval_args = {
+                    "output_dir": output_dir,
+                    "template_args": self.template_args,
+                    "model": self.model,
+                    "tokenizer": self.tokenizer,
+                }
+                eval_metrics.update(evaluator.evaluate(**eval_args))
+            self.log(eval_metrics)
+            return eval_metrics
 
         if eval_dataset is None:
             return {}